@@ -0,0 +1,32 @@
+"""
+SQLite backend with per-connection PRAGMAs and IMMEDIATE transactions.
+
+OPTIONS accepts two keys on top of the ones of Django's SQLite backend:
+
+- 'pragmas': mapping of PRAGMA names to values, applied to every new connection.
+- 'transaction_mode': 'IMMEDIATE' (or 'EXCLUSIVE') makes atomic blocks take the write lock when they start. A
+  deferred transaction that reads first and writes later cannot wait for the lock when another connection holds it
+  and fails with "database is locked" right away; an immediate one waits up to busy_timeout instead.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = params.pop('pragmas', {})
+        self.transaction_mode = params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
+        else:
+            super()._start_transaction_under_autocommit()
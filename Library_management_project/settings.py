@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
+from datetime import timedelta
 from pathlib import Path
 import environ
 from celery.schedules import crontab
@@ -45,16 +46,21 @@ INSTALLED_APPS = [
     'users',  # New
     'library',  # New
     'web',  # New
+    'monitoring',  # New
 ]
 
 MIDDLEWARE = [
+    'monitoring.middleware.MetricsMiddleware',  # New
+    'monitoring.middleware.QueryInstrumentationMiddleware',  # New
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'library.replicas.PrimaryPinMiddleware',  # New
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'monitoring.middleware.ProfilingMiddleware',  # New
 ]
 
 ROOT_URLCONF = 'Library_management_project.urls'
@@ -87,6 +93,47 @@ DATABASES = {
     }
 }
 
+# Production SQLite profile, enabled with DATABASE_PROFILE=production in the environment.
+# WAL lets readers work while a writer commits, write transactions take the lock up front and wait for it up to
+# busy_timeout instead of failing with "database is locked", and connections are kept open between requests.
+SQLITE_PRODUCTION_DATABASE = {
+    'ENGINE': 'Library_management_project.db.sqlite3',
+    'NAME': BASE_DIR / 'db.sqlite3',
+    'CONN_MAX_AGE': 600,
+    'CONN_HEALTH_CHECKS': True,
+    'OPTIONS': {
+        'transaction_mode': 'IMMEDIATE',
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',  # Durable across application crashes; WAL keeps the database consistent
+            'cache_size': -64000,  # 64 MB page cache per connection
+            'mmap_size': 268435456,  # 256 MB memory-mapped I/O
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY',
+        },
+    },
+}
+
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'development')
+if DATABASE_PROFILE == 'production':
+    DATABASES['default'] = SQLITE_PRODUCTION_DATABASE
+
+# Read replicas, e.g. DATABASE_REPLICAS=replica1,replica2 for the files db.replica1.sqlite3 and db.replica2.sqlite3
+# next to the primary. They are refreshed with `python manage.py sync_replicas` and share the primary's test database.
+DATABASE_REPLICAS = [alias for alias in os.environ.get('DATABASE_REPLICAS', '').split(',') if alias]
+for _alias in DATABASE_REPLICAS:
+    DATABASES[_alias] = {
+        **DATABASES['default'],
+        'NAME': BASE_DIR / f'db.{_alias}.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['library.replicas.ReplicaRouter']
+
+# Seconds a user's reads stay on the primary after a write, so they see their own changes before the replicas sync
+REPLICA_STICKY_SECONDS = 30
+REPLICA_PIN_CACHE = 'shared'
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -129,12 +176,21 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'users.CustomUser'  # New
 
+# Sessions are read from the cache and written through to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# ModelBackend stays listed so sessions that stored it as their backend remain logged in
+AUTHENTICATION_BACKENDS = ['users.backends.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend']
+USER_CACHE_TIMEOUT = 60  # Seconds a session's user is cached per process, 0 disables the cache
+USER_CACHE_MAX_ENTRIES = 10000
+
 LOGIN_URL = 'login'  # new
 LOGIN_REDIRECT_URL = "home"  # new
 LOGOUT_REDIRECT_URL = "home"  # new
 
 REST_FRAMEWORK = {  # New
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'users.authentication.RevocableJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
@@ -149,10 +205,110 @@ REST_FRAMEWORK = {  # New
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 5,
+    # Token buckets per user, see library.throttling: "N/period" allows bursts of N refilled at N per period
+    'DEFAULT_THROTTLE_RATES': {
+        'circulation_write': '20/min',
+        'search': '60/min',
+        'book_status': '120/min',
+    },
+}
+THROTTLE_CACHE = 'default'  # Throttle buckets are shared between processes when this is a redis cache
+
+SIMPLE_JWT = {
+    # Claims such as is_staff are trusted until the access token expires, keep it short
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=5),
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'users.serializers.LibraryTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'users.serializers.RevocableTokenRefreshSerializer',
 }
+JWT_DENY_LIST_CACHE = 'shared'  # Revoked tokens, must be shared by all processes, see users.tokens
+JWT_DENY_LIST_LOCAL_SECONDS = 5  # Deny list answers kept per process, bounds how late other processes see a revocation
+JWT_DENY_LIST_LOCAL_MAX_ENTRIES = 10000
 
 API_URL = 'http://127.0.0.1:8000/api'  # New
 
+BORROW_PERIOD_DAYS = 14  # Loan period of circulation desk checkouts
+BORROW_EXTENSION_DAYS = 14  # Default extension of the bulk extend admin action and API, and of desk renewals
+ARCHIVE_HORIZON_DAYS = 730  # Age of closed borrows and reservations moved to the archive, at least 365
+
+# Overdue fines accrued nightly, in cents, see library.fines
+FINE_DAILY_RATE = 25  # Per day overdue beyond the grace period
+FINE_MAX_AMOUNT = 2000  # Cap per borrow
+FINE_GRACE_DAYS = 2  # Days after the due date without a fine
+FINE_RETURN_LOOKBACK_DAYS = 2  # Returned borrows whose fines are still finalized, at least the accrual interval
+
+# Per-request SQL instrumentation, see monitoring.middleware.QueryInstrumentationMiddleware
+SQL_INSTRUMENTATION = False
+SQL_N_PLUS_ONE_THRESHOLD = 5  # Identical query shapes per request before it is logged as a possible N+1
+SQL_QUERY_BUDGET = None  # Maximum queries per request, None disables the check
+SQL_QUERY_BUDGET_RAISE = False  # Fail the request instead of logging when the budget is exceeded (for tests)
+
+# Metrics registry exposed at /metrics/, see monitoring.metrics
+# MetricsMiddleware costs about 12 us per request, three histogram observations and the SQL timer, see
+# `benchmark --suite metrics`
+METRICS_ENABLED = True
+# Bearer token scrapers send to read /metrics/ without a staff session, None leaves it to staff users
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Celery workers dump their registries here after each task for /metrics/ to add, None disables. Must be shared by
+# the workers and the web processes, i.e. on the same host or a shared volume
+METRICS_DUMP_DIR = BASE_DIR / 'metrics'
+
+# On-demand request profiling for staff, see monitoring.middleware.ProfilingMiddleware
+PROFILING_ENABLED = False
+PROFILING_SAMPLE_RATE = 1.0  # Share of the requested profiles that are actually captured
+PROFILING_HEADER = 'X-Profile'
+PROFILING_QUERY_PARAM = 'profile'
+PROFILING_DIR = BASE_DIR / 'profiles'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'monitoring.cache.InstrumentedLocMemCache',
+    },
+    # State every web and worker process must see, e.g. replica pins, revoked tokens and fragment versions, kept in a
+    # table of the primary database.
+    # Create it with `python manage.py createcachetable`
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'shared_cache',
+    },
+}
+
+# Live availability updates over Server-Sent Events, see library.live. Streams need an ASGI server, e.g. uvicorn
+LIVE_UPDATES_BACKEND = 'library.live.LocalBackend'  # library.live.RedisBackend shares updates between processes
+LIVE_UPDATES_REDIS_URL = 'redis://localhost:6379/1'
+LIVE_UPDATES_CHANNEL = 'library:availability'
+LIVE_MAX_SUBSCRIBERS = 10000  # Open streams per process, further clients are told to retry later
+LIVE_MAX_BOOKS = 100  # Books per stream
+LIVE_HEARTBEAT_SECONDS = 15
+
+# Rendered fragments of the web views, keyed on catalog and book versions, see web.fragments
+WEB_FRAGMENT_CACHE = 'default'
+WEB_FRAGMENT_VERSION_CACHE = 'shared'  # Must be shared by all processes, or changes only invalidate their own process
+WEB_FRAGMENT_CACHE_SECONDS = 600  # Also bounds how stale time-dependent counts, e.g. borrows last year, can get
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'monitoring.logging.JSONFormatter',
+        },
+    },
+    'handlers': {
+        'structured': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'monitoring': {
+            'handlers': ['structured'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 
 #  New code for celery automation
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
@@ -167,13 +323,48 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'library.tasks.send_reminder_emails',
         'schedule': crontab(hour=0, minute=0),  # Every day at midnight
     },
+    'accrue-overdue-fines-every-day': {
+        'task': 'library.tasks.accrue_overdue_fines',
+        'schedule': crontab(hour=0, minute=30),  # Every day at 0:30 AM
+    },
+    'refresh-book-popularity-every-day': {
+        'task': 'library.tasks.refresh_book_popularity',
+        'schedule': crontab(hour=1, minute=0),  # Every day at 1 AM
+    },
+    'rebuild-book-neighbours-every-day': {
+        'task': 'library.tasks.rebuild_book_neighbours',
+        'schedule': crontab(hour=2, minute=0),  # Every day at 2 AM
+    },
+    'export-analytics-snapshot-every-day': {
+        'task': 'library.tasks.export_analytics_snapshot',
+        'schedule': crontab(hour=3, minute=0),  # Every day at 3 AM
+    },
+    'refresh-table-statistics-every-day': {
+        'task': 'library.tasks.refresh_table_statistics',
+        'schedule': crontab(hour=4, minute=0),  # Every day at 4 AM
+    },
+    'relay-circulation-events-every-minute': {
+        'task': 'library.tasks.relay_circulation_events',
+        'schedule': crontab(),  # Every minute
+    },
 }
 
+# Consumers of the circulation event log run by the relay task, name -> dotted path, see library.events
+CIRCULATION_EVENT_CONSUMERS = {
+    'recommendations': 'library.recommendations.apply_events',
+}
+
+RECOMMENDATION_NEIGHBOURS = 10  # Similar books stored per book, see library.recommendations
+
+# Columnar snapshots of the circulation data served by the analytics API, see library.snapshot
+ANALYTICS_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+ANALYTICS_SNAPSHOTS_KEPT = 3
+
 # Email settings
 env = environ.Env()
 environ.Env.read_env(env_file=os.path.join(BASE_DIR, '.env'))
 
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_BACKEND = 'monitoring.mail.EmailBackend'  # SMTP backend recording send latency
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
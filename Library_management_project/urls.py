@@ -16,11 +16,18 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+
+from users.views import TokenRevokeView
 
 urlpatterns = [
+    path('', include('monitoring.urls')),  # Before the admin, which would swallow admin/profiles/
     path('admin/', admin.site.urls),
 
     path('', include('web.urls')),
     path('users/', include('users.urls')),
     path('api/library/', include('library.urls')),
+    path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/token/revoke/', TokenRevokeView.as_view(), name='token_revoke'),
 ]
@@ -1,10 +1,16 @@
+from django.conf import settings
 from django.contrib import admin
 from django import forms
-from django.shortcuts import render
+from django.db.models import Q
+from django.shortcuts import render, get_object_or_404
+from django.utils.dateparse import parse_datetime
 from django.utils.html import format_html
 from django.urls import reverse, path
 
+from library.archive import borrow_querysets, union_latest
 from library.models import Author, Genre, Book, Reservation, Borrow
+from library.paginators import EstimatedCountPaginator
+from library.services import bulk_return_borrows, bulk_extend_borrows
 
 
 class AuthorAdmin(admin.ModelAdmin):
@@ -30,8 +36,9 @@ class BorrowAdminForm(forms.ModelForm):
 
 
 class BookAdmin(admin.ModelAdmin):
-    list_display = ['title', 'author', 'genre', 'release_year', 'quantity', 'currently_borrowed_count',
-                    'active_reservations_count', 'total_borrowed_count', 'borrow_history_link']
+    list_display = ['title', 'author', 'genre', 'release_year', 'quantity', 'currently_borrowed',
+                    'active_reservations', 'total_borrowed', 'borrow_history_link']
+    list_select_related = ['author', 'genre']
     readonly_fields = ('currently_borrowed_count', 'active_reservations_count', 'total_borrowed_count')
     fieldsets = (
         (None, {
@@ -44,6 +51,31 @@ class BookAdmin(admin.ModelAdmin):
     search_fields = ['title', 'author__full_name', 'genre__name']
     list_filter = ['genre', 'author']
     ordering = ['title']
+    borrow_history_page_size = 50
+
+    def get_queryset(self, request):
+        """
+        Annotate the circulation counts, so the changelist does not count borrows and reservations per row.
+        """
+        return super().get_queryset(request).with_circulation_counts()
+
+    def currently_borrowed(self, obj):
+        return obj.currently_borrowed_count
+
+    currently_borrowed.short_description = 'Currently borrowed'
+    currently_borrowed.admin_order_field = 'num_currently_borrowed'
+
+    def active_reservations(self, obj):
+        return obj.active_reservations_count
+
+    active_reservations.short_description = 'Active reservations'
+    active_reservations.admin_order_field = 'num_active_reservations'
+
+    def total_borrowed(self, obj):
+        return obj.total_borrowed_count
+
+    total_borrowed.short_description = 'Total borrowed'
+    total_borrowed.admin_order_field = 'num_total_borrowed'
 
     def borrow_history_link(self, obj):
         """
@@ -67,14 +99,40 @@ class BookAdmin(admin.ModelAdmin):
 
     def borrow_history_view(self, request, book_id):
         """
-        Custom view to display the borrow history of a book.
+        Custom view to display the borrow history of a book, newest first, including the archived borrows with
+        ?include_archived=true.
+        Pages are addressed by a keyset cursor (borrowed_at and id of the last row shown), so deep pages cost
+        the same as the first one.
         """
-        book = Book.objects.get(pk=book_id)
-        borrows = book.borrow_history()
+        book = get_object_or_404(Book, pk=book_id)
+        archived = request.GET.get('include_archived', '').lower() in ('1', 'true', 'yes')
+        querysets = [queryset.filter(book=book).select_related('user') for queryset in borrow_querysets(archived)]
+
+        cursor = request.GET.get('after', '')
+        borrowed_at, _, borrow_id = cursor.partition('|')
+        try:
+            borrowed_at = parse_datetime(borrowed_at) if borrowed_at else None
+        except ValueError:  # Well formed but not a valid datetime, e.g. month 13
+            borrowed_at = None
+        # A malformed cursor shows the first page
+        is_first_page = not (borrowed_at and borrow_id.isdigit())
+        if not is_first_page:
+            querysets = [queryset.filter(Q(borrowed_at__lt=borrowed_at) | Q(borrowed_at=borrowed_at, id__lt=borrow_id))
+                         for queryset in querysets]
+
+        page = union_latest(querysets, 'borrowed_at', self.borrow_history_page_size + 1)
+        next_cursor = None
+        if len(page) > self.borrow_history_page_size:
+            page = page[:self.borrow_history_page_size]
+            next_cursor = f'{page[-1].borrowed_at.isoformat()}|{page[-1].pk}'
+
         context = dict(
             self.admin_site.each_context(request),
             book=book,
-            borrows=borrows,
+            borrows=page,
+            include_archived=archived,
+            is_first_page=is_first_page,
+            next_cursor=next_cursor,
         )
         return render(request, 'admin/borrow_history.html', context)
 
@@ -82,15 +140,44 @@ class BookAdmin(admin.ModelAdmin):
 class ReservationAdmin(admin.ModelAdmin):
     form = ReservationAdminForm
     list_display = ['user', 'book', 'reserved_at', 'expires_at', 'is_active']
+    list_select_related = ['user', 'book']
     search_fields = ['user__email', 'book__title']
-    list_filter = ['reserved_at', 'expires_at']
+    list_filter = ['is_active', 'reserved_at', 'expires_at']
+    date_hierarchy = 'reserved_at'
+    autocomplete_fields = ['user', 'book']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class BorrowAdmin(admin.ModelAdmin):
     form = BorrowAdminForm
     list_display = ['user', 'book', 'borrowed_at', 'due_date', 'returned_at']
+    list_select_related = ['user', 'book']
     search_fields = ['user__email', 'book__title']
     list_filter = ['borrowed_at', 'due_date', 'returned_at']
+    date_hierarchy = 'borrowed_at'
+    autocomplete_fields = ['user', 'book']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['mark_returned', 'extend_due_date']
+
+    def mark_returned(self, request, queryset):
+        """
+        Return all selected borrows in one transaction.
+        """
+        count = bulk_return_borrows(queryset.values_list('pk', flat=True))
+        self.message_user(request, f'{count} borrow(s) marked as returned.')
+
+    mark_returned.short_description = 'Mark selected borrows as returned'
+
+    def extend_due_date(self, request, queryset):
+        """
+        Extend the due date of all selected unreturned borrows.
+        """
+        count = bulk_extend_borrows(queryset.values_list('pk', flat=True))
+        self.message_user(request, f'{count} borrow(s) extended by {settings.BORROW_EXTENSION_DAYS} days.')
+
+    extend_due_date.short_description = 'Extend due date of selected borrows'
 
 
 admin.site.register(Author, AuthorAdmin)
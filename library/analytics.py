@@ -0,0 +1,160 @@
+"""
+Circulation analytics answered from the columnar snapshot of library.snapshot with vectorized NumPy and pandas
+operations, without querying the database.
+"""
+import numpy as np
+import pandas as pd
+
+DAY = np.timedelta64(1, 'D')
+
+# Upper bounds in days of the borrow duration histogram buckets
+DURATION_BUCKETS = [1, 3, 7, 14, 21, 28, 42, 60]
+
+
+def _round(value, digits=4):
+    return None if pd.isna(value) else round(float(value), digits)
+
+
+def daily_active_loans(snapshot, group, groups, start, days):
+    """
+    Return a (groups, days) array with the number of books on loan on each day from `start` on, per value
+    of `group` (one code per borrow). Each loan adds +1 on its first day and -1 after its last day to a difference
+    array, and a cumulative sum turns those into counts, so the cost is linear in borrows plus days.
+    """
+    borrows = snapshot.borrows
+    end = snapshot.created_at
+    returned_at = np.where(np.isnat(borrows['returned_at']), end, borrows['returned_at'])
+    first = np.clip((borrows['borrowed_at'] - start) // DAY, 0, days)
+    last = np.clip((returned_at - start) // DAY, 0, days)
+    counted = last > first
+    diff = np.bincount(group[counted] * (days + 1) + first[counted], minlength=groups * (days + 1))
+    diff -= np.bincount(group[counted] * (days + 1) + last[counted], minlength=groups * (days + 1))
+    return np.cumsum(diff.reshape(groups, days + 1), axis=1)[:, :days]
+
+
+def utilization_by_genre_month(snapshot, months=12):
+    """
+    Return the average share of each genre's copies that was on loan, per month of the last `months` months.
+    """
+    books = snapshot.books
+    genres = len(snapshot.genres['id'])
+    end = snapshot.created_at.astype('datetime64[D]')
+    start = (end.astype('datetime64[M]') - (months - 1)).astype('datetime64[D]')
+    days = int((end - start) // DAY) + 1
+
+    genre_of_borrow = np.asarray(books['genre'])[snapshot.borrows['book']]
+    active = daily_active_loans(snapshot, genre_of_borrow, genres, start.astype('datetime64[s]'), days)
+    copies = np.bincount(books['genre'], weights=books['quantity'], minlength=genres)
+
+    frame = pd.DataFrame(active.T, index=pd.date_range(str(start), periods=days, freq='D'))
+    monthly = frame.resample('MS').mean()
+    names = snapshot.labels['genres']
+    return [
+        {'genre': names[genre], 'month': month.strftime('%Y-%m'), 'average_loans': _round(loans),
+         'copies': int(copies[genre]), 'utilization': _round(loans / copies[genre]) if copies[genre] else None}
+        for month, row in monthly.iterrows() for genre, loans in enumerate(row)
+    ]
+
+
+def borrow_durations(snapshot):
+    """
+    Return the distribution of the loan periods of returned borrows, in days: percentiles, a histogram over
+    DURATION_BUCKETS and the median and 90th percentile per genre.
+    """
+    borrows = snapshot.borrows
+    returned = ~np.isnat(borrows['returned_at'])
+    durations = (borrows['returned_at'][returned] - borrows['borrowed_at'][returned]) / DAY
+    if not len(durations):
+        return {'count': 0, 'mean': None, 'percentiles': {}, 'histogram': [], 'by_genre': []}
+
+    percentiles = np.percentile(durations, [50, 90, 99])
+    edges = [0, *DURATION_BUCKETS, np.inf]
+    counts, _ = np.histogram(durations, bins=edges)
+    genres = pd.Series(durations).groupby(np.asarray(snapshot.books['genre'])[borrows['book'][returned]])
+    quantiles = genres.quantile([0.5, 0.9]).unstack()
+    names = snapshot.labels['genres']
+    return {
+        'count': int(len(durations)),
+        'mean': _round(durations.mean()),
+        'percentiles': {f'p{p}': _round(value) for p, value in zip([50, 90, 99], percentiles)},
+        'histogram': [{'min_days': low, 'max_days': None if np.isinf(high) else high, 'count': int(count)}
+                      for low, high, count in zip(edges, edges[1:], counts)],
+        'by_genre': [{'genre': names[genre], 'median': _round(row[0.5]), 'p90': _round(row[0.9])}
+                     for genre, row in quantiles.iterrows()],
+    }
+
+
+def late_return_rates(snapshot, limit=100, min_returns=1):
+    """
+    Return the share of returned borrows that came back after their due date, per author, highest first.
+    """
+    borrows = snapshot.borrows
+    returned = ~np.isnat(borrows['returned_at'])
+    late = returned & (borrows['returned_at'] > borrows['due_date'])
+    authors = len(snapshot.authors['id'])
+    author_of_borrow = np.asarray(snapshot.books['author'])[borrows['book']]
+    returns = np.bincount(author_of_borrow[returned], minlength=authors)
+    lates = np.bincount(author_of_borrow[late], minlength=authors)
+    rates = np.divide(lates, returns, out=np.zeros(authors), where=returns > 0)
+
+    eligible = np.flatnonzero(returns >= min_returns)
+    ranked = eligible[np.lexsort((-returns[eligible], -rates[eligible]))][:limit]
+    names = snapshot.labels['authors']
+    return [{'author': names[author], 'returns': int(returns[author]), 'late_returns': int(lates[author]),
+             'late_rate': _round(rates[author])} for author in ranked]
+
+
+def capacity_report(snapshot, days=365):
+    """
+    Return a DataFrame with one row per book sizing its quantity from the last `days` days of borrows and wishes:
+    the peak number of concurrent loans, the days all copies were on loan, the current waitlist (wishers) and the
+    wishes made, and a suggested quantity covering the peak loans plus the waitlist.
+
+    Loans are turned into +1/-1 events sorted by book and time. Every book's events sum to zero, so one cumulative
+    sum over all of them gives each book's number of loans after each event, without a loop per book.
+    """
+    books = snapshot.books
+    count = len(books['id'])
+    quantity = np.asarray(books['quantity'])
+    end = snapshot.created_at
+    start = end - np.timedelta64(days, 'D')
+
+    borrows = snapshot.borrows
+    returned_at = np.where(np.isnat(borrows['returned_at']), end, borrows['returned_at'])
+    overlaps = (returned_at > start) & (borrows['borrowed_at'] < end)
+    loan_start = np.maximum(borrows['borrowed_at'][overlaps], start).astype(np.int64)
+    loan_end = np.minimum(returned_at[overlaps], end).astype(np.int64)
+    loan_book = np.asarray(borrows['book'])[overlaps]
+
+    event_book = np.concatenate([loan_book, loan_book])
+    event_time = np.concatenate([loan_start, loan_end])
+    event_delta = np.concatenate([np.ones(len(loan_book), np.int64), -np.ones(len(loan_book), np.int64)])
+    # By book, then time, returns before loans at the same second
+    order = np.lexsort((event_delta, event_time, event_book))
+    event_book, event_time, event_delta = event_book[order], event_time[order], event_delta[order]
+    loans = np.cumsum(event_delta)
+
+    peak_loans = np.zeros(count, np.int64)
+    np.maximum.at(peak_loans, event_book, loans)
+    # Loans stay constant until the book's next event
+    same_book = np.append(event_book[1:] == event_book[:-1], False)
+    duration = np.where(same_book, np.append(event_time[1:], 0) - event_time, 0)
+    all_on_loan = loans >= quantity[event_book]
+    zero_seconds = np.bincount(event_book, weights=duration * all_on_loan, minlength=count)
+    zero_days = np.where(quantity <= 0, days, zero_seconds / 86400)
+
+    wish_events = snapshot.wish_events
+    recent = wish_events['occurred_at'] >= start
+    waitlist = np.bincount(snapshot.wishes['book'], minlength=count)
+    suggested = np.maximum(1, peak_loans + waitlist)
+    return pd.DataFrame({
+        'book': np.asarray(books['id']),
+        'quantity': quantity,
+        'peak_loans': peak_loans,
+        'zero_availability_days': np.round(zero_days, 2),
+        'zero_availability_share': np.round(zero_days / days, 4),
+        'waitlist': waitlist,
+        'wishes': np.bincount(np.asarray(wish_events['book'])[recent], minlength=count),
+        'suggested_quantity': suggested,
+        'change': suggested - quantity,
+    })
@@ -0,0 +1,116 @@
+"""
+Cold storage for closed circulation history.
+
+Returned borrows and inactive reservations older than the archive horizon are moved, chunk by chunk, into the
+ArchivedBorrow and ArchivedReservation tables, keeping the hot tables small. Every chunk is copied, counted into the
+summary rows and deleted in one transaction, so an interrupted run loses nothing and the next run carries on where it
+stopped. The summary rows keep the borrow counts of books and the late return counts of users correct without
+scanning the archive; the rows themselves can be read back together with the hot ones through union_latest().
+"""
+from collections import Counter
+from datetime import timedelta
+from heapq import merge
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from library.models import ArchivedBorrow, ArchivedReservation, BookArchiveSummary, Borrow, Reservation, \
+    UserArchiveSummary
+
+# Borrows younger than a year feed Book.borrow_count_last_year, so they must stay in the hot table
+MIN_HORIZON_DAYS = 365
+
+
+def archive_cutoff(days=None):
+    """Return the moment before which closed rows are archived, ARCHIVE_HORIZON_DAYS ago by default."""
+    days = settings.ARCHIVE_HORIZON_DAYS if days is None else days
+    if days < MIN_HORIZON_DAYS:
+        raise ValueError(f'The archive horizon must be at least {MIN_HORIZON_DAYS} days')
+    return timezone.now() - timedelta(days=days)
+
+
+def _add_to_summary(model, key, field, counts):
+    """Add `counts` (key value -> amount) to `field` of the summary rows of `model`, creating missing rows."""
+    if not counts:
+        return
+    qn = connection.ops.quote_name
+    table, key, field = qn(model._meta.db_table), qn(key), qn(field)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {table} ({key}, {field}) VALUES (%s, %s) '
+            f'ON CONFLICT ({key}) DO UPDATE SET {field} = {table}.{field} + excluded.{field}',
+            list(counts.items()),
+        )
+
+
+def archive_borrows(before, chunk_size=1000):
+    """
+    Move the borrows returned before `before` into the archive, `chunk_size` at a time in id order. Borrows with an
+    unsettled fine stay in the hot table until the fine is paid. Yields the number of borrows archived by every
+    committed chunk.
+    """
+    closed = Borrow.objects.filter(returned_at__lt=before).exclude(fine__amount__gt=F('fine__paid')).order_by('id')
+    while True:
+        with transaction.atomic():
+            rows = list(closed.values('id', 'user_id', 'book_id', 'borrowed_at', 'due_date', 'returned_at')
+                        [:chunk_size])
+            if not rows:
+                return
+            ArchivedBorrow.objects.bulk_create(ArchivedBorrow(**row) for row in rows)
+            _add_to_summary(BookArchiveSummary, 'book_id', 'borrow_count', Counter(row['book_id'] for row in rows))
+            _add_to_summary(UserArchiveSummary, 'user_id', 'late_return_count',
+                            Counter(row['user_id'] for row in rows if row['returned_at'] > row['due_date']))
+            closed.filter(id__lte=rows[-1]['id']).delete()
+        yield len(rows)
+
+
+def archive_reservations(before, chunk_size=1000):
+    """
+    Move the inactive reservations made before `before` into the archive, `chunk_size` at a time in id order.
+    Yields the number of reservations archived by every committed chunk.
+    """
+    closed = Reservation.objects.filter(is_active=False, reserved_at__lt=before).order_by('id')
+    while True:
+        with transaction.atomic():
+            rows = list(closed.values('id', 'user_id', 'book_id', 'reserved_at', 'expires_at')[:chunk_size])
+            if not rows:
+                return
+            ArchivedReservation.objects.bulk_create(ArchivedReservation(**row) for row in rows)
+            closed.filter(id__lte=rows[-1]['id']).delete()
+        yield len(rows)
+
+
+def analyze(*models):
+    """
+    Refresh the planner statistics of the tables of `models`. The admin reads its estimated row counts from them, which
+    would otherwise still count the archived rows.
+    """
+    with connection.cursor() as cursor:
+        for model in models:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+
+def borrow_querysets(include_archived=False):
+    """Return the querysets holding borrows: the hot table, plus the archive if `include_archived`."""
+    if include_archived:
+        return [Borrow.objects.all(), ArchivedBorrow.objects.all()]
+    return [Borrow.objects.all()]
+
+
+def late_borrow_querysets(include_archived=False):
+    """Return the querysets holding late returned borrows, see borrow_querysets()."""
+    return [queryset.filter(returned_at__gt=F('due_date')) for queryset in borrow_querysets(include_archived)]
+
+
+def union_latest(querysets, field, limit=None):
+    """
+    Return the `limit` rows (all by default) with the latest `field` across `querysets`, e.g. the hot and archived
+    borrows, ties broken by the latest id. Archived rows keep their original ids, so the order is total and can be
+    paged with a (field, id) keyset. Each queryset is read up to `limit` rows in that order and the results are
+    merged, so `field` must not be null.
+    """
+    rows = [list(queryset.order_by(f'-{field}', '-pk')[:limit]) for queryset in querysets]
+    return list(merge(*rows, key=attrgetter(field, 'pk'), reverse=True))[:limit]
@@ -0,0 +1,316 @@
+"""
+Benchmark helpers used by the `benchmark` management command.
+
+The endpoints suite generates synthetic datasets, runs every API endpoint and web view in-process through the Django
+test client and records latency percentiles, SQL query counts and allocated memory for each of them. The other suites
+live in one module per area and share the datasets, endpoints and percentiles defined here.
+"""
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import timedelta
+from unittest import mock
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from requests.structures import CaseInsensitiveDict
+
+from library.models import Author, Genre, Book, Reservation, Borrow
+from library.fines import accrue_fines
+from library.recommendations import rebuild_neighbours
+from monitoring.sql import QueryTimer
+
+User = get_user_model()
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+
+@dataclass
+class Dataset:
+    """Handles to the rows of a generated dataset that the endpoints are run against."""
+    size: int
+    librarian: object
+    reader: object
+    available_book: object
+    unavailable_book: object
+    search_term: str
+
+
+def generate_dataset(size, seed=0, prefix=''):
+    """
+    Fill the database with `size` books and a proportional amount of authors, genres, users, borrows and
+    reservations. Rows are inserted with bulk_create, so model validation is skipped on purpose. Use a distinct
+    `prefix` to add a second dataset to an already populated database.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    unusable_password = make_password(None)
+
+    authors = Author.objects.bulk_create(
+        [Author(full_name=f'{prefix}Author {i}') for i in range(max(size // 10, 1))])
+    genres = Genre.objects.bulk_create([Genre(name=f'{prefix}Genre {i}') for i in range(10)])
+    users = User.objects.bulk_create([
+        User(email=f'{prefix}reader{i}@example.com', first_name='Reader', last_name=str(i),
+             personal_id_number=f'{prefix}R{i:09d}', birth_date='1990-01-01', password=unusable_password)
+        for i in range(max(size // 2, 2) + 2)
+    ])
+    librarian, reader, borrowers = users[0], users[1], users[2:]
+    User.objects.filter(pk=librarian.pk).update(is_staff=True)
+    librarian.is_staff = True
+
+    books = Book.objects.bulk_create([
+        Book(title=f'{prefix}Book {i}', author=rng.choice(authors), genre=rng.choice(genres),
+             release_year=rng.randint(1850, 2024), quantity=rng.randint(2, 10))
+        for i in range(size)
+    ])
+    available_book, unavailable_book = books[0], books[-1]
+    Book.objects.filter(pk=available_book.pk).update(quantity=size + 10)
+    Book.objects.filter(pk=unavailable_book.pk).update(quantity=1)
+
+    borrows = []
+    for i in range(size * 3):
+        borrowed_at = now - timedelta(days=rng.randint(1, 720))
+        due_date = borrowed_at + timedelta(days=14)
+        returned_at = borrowed_at + timedelta(days=rng.randint(1, 28))
+        borrows.append(Borrow(user=rng.choice(borrowers), book=rng.choice(books[1:-1] or books),
+                              due_date=due_date, returned_at=returned_at))
+    borrows.append(Borrow(user=borrowers[0], book=unavailable_book, due_date=now + timedelta(days=14)))
+    borrows = Borrow.objects.bulk_create(borrows)
+    # borrowed_at is auto_now_add, so spread the history over time after the insert
+    for borrow in borrows[:-1]:
+        borrow.borrowed_at = borrow.returned_at - timedelta(days=rng.randint(1, 28))
+    Borrow.objects.bulk_update(borrows[:-1], ['borrowed_at'], batch_size=500)
+    Book.objects.refresh_popularity()  # bulk_create skips Borrow.save
+    rebuild_neighbours()
+    accrue_fines(now, lookback_days=720)
+
+    Reservation.objects.bulk_create([
+        Reservation(user=borrowers[i % len(borrowers)], book=rng.choice(books[1:-1] or books),
+                    expires_at=now + timedelta(hours=24), is_active=i % 2 == 0)
+        for i in range(size)
+    ])
+    unavailable_book.wished_by.add(*borrowers[1:size // 10 + 2])
+
+    return Dataset(size=size, librarian=librarian, reader=reader, available_book=available_book,
+                   unavailable_book=unavailable_book, search_term=available_book.title)
+
+
+@dataclass
+class Endpoint:
+    """A single endpoint to benchmark. `reset` runs (unmeasured) before every iteration."""
+    name: str
+    method: str
+    url: object
+    staff: bool = False
+    reset: object = None
+    loopback: bool = False
+    params: object = field(default=None)
+
+
+def _deactivate_reservations(dataset):
+    Reservation.objects.filter(user=dataset.reader, is_active=True).update(is_active=False)
+
+
+def _ensure_reservation(dataset):
+    _deactivate_reservations(dataset)
+    Reservation.objects.bulk_create([
+        Reservation(user=dataset.reader, book=dataset.available_book,
+                    expires_at=timezone.now() + timedelta(hours=24))
+    ])
+
+
+def _remove_wish(dataset):
+    dataset.unavailable_book.wished_by.remove(dataset.reader)
+
+
+def _add_wish(dataset):
+    dataset.unavailable_book.wished_by.add(dataset.reader)
+
+
+ENDPOINTS = [
+    Endpoint('book-list', 'get', lambda d: reverse('book-list')),
+    Endpoint('book-search', 'get', lambda d: reverse('book-list'), params=lambda d: {'search': d.search_term}),
+    Endpoint('book-ordering', 'get', lambda d: reverse('book-list'), params=lambda d: {'ordering': '-popularity'}),
+    Endpoint('book-detail', 'get', lambda d: reverse('book-detail', args=[d.available_book.pk])),
+    Endpoint('book-similar', 'get', lambda d: reverse('book-similar', args=[d.available_book.pk])),
+    Endpoint('book-borrow-history', 'get', lambda d: reverse('book-borrow-history', args=[d.unavailable_book.pk]),
+             staff=True),
+    Endpoint('book-reserve', 'post', lambda d: reverse('book-reserve', args=[d.available_book.pk]),
+             reset=_deactivate_reservations),
+    Endpoint('book-cancel-reservation', 'post',
+             lambda d: reverse('book-cancel-reservation', args=[d.available_book.pk]), reset=_ensure_reservation),
+    Endpoint('book-wish', 'post', lambda d: reverse('book-wish', args=[d.unavailable_book.pk]), reset=_remove_wish),
+    Endpoint('book-remove-wish', 'post', lambda d: reverse('book-remove-wish', args=[d.unavailable_book.pk]),
+             reset=_add_wish),
+    Endpoint('user-book-status', 'get', lambda d: reverse('user_book_status', args=[d.available_book.pk])),
+    Endpoint('author-list', 'get', lambda d: reverse('author-list')),
+    Endpoint('genre-list', 'get', lambda d: reverse('genre-list')),
+    Endpoint('fine-mine', 'get', lambda d: reverse('fine-mine')),
+    Endpoint('fine-balances', 'get', lambda d: reverse('fine-balances'), staff=True),
+    Endpoint('statistics-popular-books', 'get', lambda d: reverse('statistics-popular-books')),
+    Endpoint('statistics-late-returns', 'get', lambda d: reverse('statistics-late-returns')),
+    Endpoint('statistics-late-returning-users', 'get', lambda d: reverse('statistics-late-returning-users')),
+    Endpoint('web-home', 'get', lambda d: reverse('home'), loopback=True),
+    Endpoint('web-book-detail', 'get', lambda d: reverse('book_detail', args=[d.available_book.pk]), loopback=True),
+]
+
+
+class LoopbackAdapter(requests.adapters.BaseAdapter):
+    """
+    Requests transport adapter that dispatches the web views' API calls to the Django test client instead of the
+    network, so the web tier can be measured without a running server.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.client = Client()
+
+    def send(self, request, **kwargs):
+        extra = {f'HTTP_{key.upper().replace("-", "_")}': value for key, value in request.headers.items()
+                 if key.lower() not in ('content-type', 'content-length')}
+        response = self.client.generic(request.method, request.url, data=request.body or '',
+                                       content_type=request.headers.get('Content-Type', ''), **extra)
+        result = requests.Response()
+        result.status_code = response.status_code
+        result._content = response.content
+        result.headers = CaseInsensitiveDict(response.headers)
+        result.encoding = 'utf-8'
+        result.url = request.url
+        result.request = request
+        return result
+
+    def close(self):
+        pass
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of `values` using linear interpolation between the closest ranks."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def measure_endpoint(endpoint, dataset, iterations):
+    """Run `endpoint` `iterations` times and return its latency, query count and memory figures."""
+    client = Client()
+    client.force_login(dataset.librarian if endpoint.staff else dataset.reader)
+    url = endpoint.url(dataset)
+    params = endpoint.params(dataset) if endpoint.params else None
+    adapter = LoopbackAdapter()
+
+    def get_adapter(session, url):
+        return adapter
+
+    def call():
+        if endpoint.reset:
+            endpoint.reset(dataset)
+        with QueryTimer().installed() as queries:
+            start = time.perf_counter()
+            if endpoint.loopback:
+                with mock.patch.object(requests.Session, 'get_adapter', get_adapter):
+                    response = getattr(client, endpoint.method)(url, params)
+            else:
+                response = getattr(client, endpoint.method)(url, params)
+            elapsed = (time.perf_counter() - start) * 1000
+        return response, elapsed, queries.count
+
+    # The first call is traced for memory and kept out of the latency sample, as tracing slows it down
+    tracemalloc.start()
+    response, _, query_count = call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = [call()[1] for _ in range(iterations)]
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'queries': query_count,
+        'peak_memory_kib': round(peak / 1024, 1),
+    }
+
+
+def run_suite(sizes=DEFAULT_SIZES, iterations=20, endpoints=None, stdout=None):
+    """Generate a dataset for each size and benchmark every endpoint against it."""
+    selected = [e for e in ENDPOINTS if not endpoints or e.name in endpoints]
+    report = {
+        'generated_at': timezone.now().isoformat(),
+        'iterations': iterations,
+        'api_url': settings.API_URL,
+        'results': {},
+    }
+    for size in sizes:
+        call_command('flush', interactive=False, verbosity=0)
+        dataset = generate_dataset(size)
+        results = report['results'][str(size)] = {}
+        for endpoint in selected:
+            results[endpoint.name] = measure_endpoint(endpoint, dataset, iterations)
+            if stdout:
+                stdout.write(f'{size:>7} {endpoint.name:<34} {format_result(results[endpoint.name])}')
+    return report
+
+
+def fresh_readers(count, prefix):
+    """Insert `count` readers without borrows, reservations or a usable password."""
+    unusable_password = make_password(None)
+    return User.objects.bulk_create([
+        User(email=f'{prefix}{i}@example.com', first_name='Desk', last_name=str(i),
+             personal_id_number=f'{prefix}{i:09d}', birth_date='1990-01-01', password=unusable_password)
+        for i in range(count)
+    ])
+
+
+def format_result(result):
+    return (f"p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms  "
+            f"{result['queries']:>4} queries  {result['peak_memory_kib']:>9.1f} KiB  [{result['status']}]")
+
+
+def compare_reports(report, baseline, latency_threshold=0.25, query_threshold=0, memory_threshold=0.5,
+                    min_latency_ms=1.0):
+    """
+    Compare `report` against `baseline` and return a list of human readable regressions.
+
+    Thresholds are relative for latency (p95) and memory and absolute for query counts. Latency changes smaller than
+    `min_latency_ms` are ignored as noise.
+    """
+    regressions = []
+    for size, endpoints in report['results'].items():
+        for name, current in endpoints.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            label = f'{name} @ {size} rows'
+            if current['queries'] > previous['queries'] + query_threshold:
+                regressions.append(f"{label}: queries {previous['queries']} -> {current['queries']}")
+            limit = previous['p95_ms'] * (1 + latency_threshold)
+            if current['p95_ms'] > limit and current['p95_ms'] - previous['p95_ms'] > min_latency_ms:
+                regressions.append(f"{label}: p95 {previous['p95_ms']} ms -> {current['p95_ms']} ms")
+            limit = previous['peak_memory_kib'] * (1 + memory_threshold)
+            if current['peak_memory_kib'] > limit:
+                regressions.append(
+                    f"{label}: memory {previous['peak_memory_kib']} KiB -> {current['peak_memory_kib']} KiB")
+    return regressions
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,63 @@
+"""
+Authentication benchmark: the overhead of session cookies against bearer access tokens.
+"""
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from library.benchmarks import ENDPOINTS, generate_dataset, percentile
+from monitoring.sql import QueryTimer
+from users import tokens
+from users.serializers import LibraryTokenObtainPairSerializer
+
+
+# Read-only endpoints the auth suite calls, one of them behind IsLibrarian
+AUTH_ENDPOINTS = ('genre-list', 'book-list', 'user-book-status', 'book-borrow-history')
+
+
+def run_auth_benchmark(size=1000, iterations=200, stdout=None):
+    """
+    Compare the overhead of authenticating API requests with a session cookie, whose session and user are cached per
+    process, and with a bearer access token, whose claims are trusted and whose deny list lookup is remembered for
+    JWT_DENY_LIST_LOCAL_SECONDS. 'jwt-uncached' looks the token up in the shared deny list on every request. Queries
+    are counted on a warm request.
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    dataset = generate_dataset(size)
+    report = {'generated_at': timezone.now().isoformat(), 'size': size, 'iterations': iterations, 'results': {}}
+    for endpoint in [e for e in ENDPOINTS if e.name in AUTH_ENDPOINTS]:
+        user = dataset.librarian if endpoint.staff else dataset.reader
+        session_client = Client()
+        session_client.force_login(user)
+        access = LibraryTokenObtainPairSerializer.get_token(user).access_token
+        token_client = Client(headers={'Authorization': f'Bearer {access}'})
+        url = endpoint.url(dataset)
+
+        for mode, client, local_seconds in (('session', session_client, settings.JWT_DENY_LIST_LOCAL_SECONDS),
+                                            ('jwt', token_client, settings.JWT_DENY_LIST_LOCAL_SECONDS),
+                                            ('jwt-uncached', token_client, 0)):
+            tokens._checked.clear()
+            with override_settings(JWT_DENY_LIST_LOCAL_SECONDS=local_seconds):
+                response = client.get(url)
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{endpoint.name} failed with {response.status_code} using {mode}')
+                with QueryTimer().installed() as queries:
+                    client.get(url)
+                timings = []
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    client.get(url)
+                    timings.append((time.perf_counter() - start) * 1000)
+            result = report['results'].setdefault(endpoint.name, {})[mode] = {
+                'p50_ms': round(percentile(timings, 50), 3),
+                'p95_ms': round(percentile(timings, 95), 3),
+                'queries': queries.count,
+            }
+            if stdout:
+                stdout.write(f"{endpoint.name:<24} {mode:<12} p50 {result['p50_ms']:>8.3f} ms  "
+                             f"p95 {result['p95_ms']:>8.3f} ms  {result['queries']:>3} queries")
+    return report
@@ -0,0 +1,59 @@
+"""
+Circulation desk benchmark: checkout throughput of single validated checkouts against desk batches.
+"""
+import time
+
+from django.core.management import call_command
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from library.benchmarks import fresh_readers, generate_dataset
+from library.models import Book, Borrow
+from monitoring.sql import QueryTimer
+
+
+def run_circulation_benchmark(size=1000, operations=500, batch_size=50, stdout=None):
+    """
+    Compare checking out `operations` books one by one through the validated model path used by the admin form
+    with checking them out in batches through the circulation desk API, then check them back in through the desk.
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    dataset = generate_dataset(size)
+    Book.objects.update(quantity=operations * 2)
+    books = list(Book.objects.values_list('pk', flat=True))
+    client = Client()
+    client.force_login(dataset.librarian)
+    report = {'generated_at': timezone.now().isoformat(), 'size': size, 'operations': operations,
+              'batch_size': batch_size, 'results': {}}
+
+    def record(name, elapsed, queries):
+        report['results'][name] = {
+            'ops_per_sec': round(operations / elapsed, 1),
+            'queries_per_op': round(queries / operations, 2),
+        }
+        if stdout:
+            stdout.write(f"{name:<24} {report['results'][name]['ops_per_sec']:>10.1f} ops/s  "
+                         f"{report['results'][name]['queries_per_op']:>6.2f} queries/op")
+
+    users = fresh_readers(operations, 'single')
+    with QueryTimer().installed() as queries:
+        start = time.perf_counter()
+        for i, user in enumerate(users):
+            Borrow.objects.create(user=user, book_id=books[i % len(books)])
+        record('single-checkout', time.perf_counter() - start, queries.count)
+
+    users = fresh_readers(operations, 'desk')
+    operations_list = [{'user': user.pk, 'book': books[i % len(books)]} for i, user in enumerate(users)]
+    batches = [operations_list[start:start + batch_size] for start in range(0, operations, batch_size)]
+    for name in ('checkout', 'renew', 'checkin'):
+        with QueryTimer().installed() as queries:
+            start = time.perf_counter()
+            for batch in batches:
+                response = client.post(reverse(f'circulation-{name}'), {'operations': batch},
+                                       content_type='application/json')
+                failed = [item for item in response.json()['results'] if item['status'] != 'ok']
+                if failed:
+                    raise RuntimeError(f'{name} failed: {failed[:3]}')
+            record(f'desk-{name}', time.perf_counter() - start, queries.count)
+    return report
@@ -0,0 +1,66 @@
+"""
+Fines benchmark: nightly fine accrual over a large number of overdue borrows.
+"""
+import time
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from library import fines
+from library.benchmarks import fresh_readers, generate_dataset
+from library.models import Book, Borrow
+from monitoring.sql import QueryTimer
+
+
+def _insert_overdue_borrows(count, user_ids, book_ids, now):
+    """
+    Insert `count` borrows 3 to 92 days overdue with one INSERT ... SELECT over a recursive CTE, a tenth of them
+    returned yesterday. Ids are assumed consecutive, as bulk_create inserts them into a fresh table.
+    """
+    qn = connection.ops.quote_name
+    now = connection.ops.adapt_datetimefield_value(now)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {qn(Borrow._meta.db_table)} (user_id, book_id, borrowed_at, due_date, returned_at) '
+            f'WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n + 1 < %s) '
+            f"SELECT %s + n %% %s, %s + n %% %s, datetime(%s, '-' || (n %% 90 + 17) || ' days'), "
+            f"datetime(%s, '-' || (n %% 90 + 3) || ' days'), "
+            f"CASE WHEN n %% 10 = 0 THEN datetime(%s, '-1 days') END FROM seq",
+            [count, min(user_ids), len(user_ids), min(book_ids), len(book_ids), now, now, now],
+        )
+
+
+def run_fines_benchmark(rows=1000000, stdout=None):
+    """
+    Time the set-based fine accrual against `rows` overdue borrows: the first run inserting every fine, the next
+    day's run updating them, a rerun with nothing to change, and reading and settling balances. SQLite only.
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    generate_dataset(100)
+    now = timezone.now()
+    users = fresh_readers(max(rows // 20, 1), 'fined')
+    books = list(Book.objects.values_list('pk', flat=True))
+    start = time.perf_counter()
+    _insert_overdue_borrows(rows, [user.pk for user in users], books, now)
+    report = {'generated_at': now.isoformat(), 'rows': rows, 'setup_seconds': round(time.perf_counter() - start, 2),
+              'results': {}}
+
+    def record(name, function):
+        with QueryTimer().installed() as queries:
+            start = time.perf_counter()
+            written = function()
+            elapsed = time.perf_counter() - start
+        result = report['results'][name] = {'seconds': round(elapsed, 3), 'rows': written,
+                                            'rows_per_sec': round(written / elapsed, 1), 'queries': queries.count}
+        if stdout:
+            stdout.write(f"{name:<16} {result['seconds']:>9.3f} s  {result['rows']:>9} rows  "
+                         f"{result['rows_per_sec']:>12.1f} rows/s  {result['queries']:>3} queries")
+
+    record('accrue-insert', lambda: fines.accrue_fines(now))
+    record('accrue-update', lambda: fines.accrue_fines(now + timedelta(days=1)))
+    record('accrue-unchanged', lambda: fines.accrue_fines(now + timedelta(days=1)))
+    record('balances-top-100', lambda: len(fines.balances()[:100]))
+    record('settle', lambda: 1 if fines.settle(users[0].pk) else 0)
+    return report
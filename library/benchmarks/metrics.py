@@ -0,0 +1,68 @@
+"""
+Metrics benchmark: the request overhead of METRICS_ENABLED and the cost of a worker metrics dump.
+"""
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from library.benchmarks import ENDPOINTS, generate_dataset, measure_endpoint, percentile
+from monitoring import metrics
+from monitoring.middleware import MetricsMiddleware
+
+
+# Endpoints the metrics suite calls, from the cheapest to a heavy list
+METRICS_ENDPOINTS = ('genre-list', 'user-book-status', 'book-list', 'web-home')
+
+
+def run_metrics_benchmark(size=1000, iterations=200, stdout=None):
+    """
+    Measure the overhead of recording request metrics by running the same endpoints with METRICS_ENABLED off and on,
+    the cost of MetricsMiddleware alone around a view doing nothing, which the endpoint timings are too noisy to show,
+    and the cost of the registry dump a Celery worker writes after each task.
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    dataset = generate_dataset(size)
+    report = {'generated_at': timezone.now().isoformat(), 'size': size, 'iterations': iterations, 'results': {}}
+    for endpoint in [e for e in ENDPOINTS if e.name in METRICS_ENDPOINTS]:
+        result = report['results'][endpoint.name] = {}
+        for enabled in (False, True):
+            with override_settings(METRICS_ENABLED=enabled):
+                measured = measure_endpoint(endpoint, dataset, iterations)
+            result['on' if enabled else 'off'] = {'p50_ms': measured['p50_ms'], 'p95_ms': measured['p95_ms']}
+        result['overhead_ms'] = round(result['on']['p50_ms'] - result['off']['p50_ms'], 3)
+        if stdout:
+            stdout.write(f"{endpoint.name:<24} off p50 {result['off']['p50_ms']:>8.3f} ms  "
+                         f"on p50 {result['on']['p50_ms']:>8.3f} ms  overhead {result['overhead_ms']:>7.3f} ms")
+
+    response = HttpResponse()
+    middleware = MetricsMiddleware(lambda request: response)
+    request = RequestFactory().get('/')
+    calls = iterations * 100
+    result = report['results']['middleware'] = {}
+    for enabled in (False, True):
+        with override_settings(METRICS_ENABLED=enabled):
+            start = time.perf_counter()
+            for _ in range(calls):
+                middleware(request)
+            result['on' if enabled else 'off'] = round((time.perf_counter() - start) / calls * 1e6, 2)
+    result['overhead_us'] = round(result['on'] - result['off'], 2)
+    if stdout:
+        stdout.write(f"{'middleware':<24} off {result['off']:>8.2f} us  on {result['on']:>8.2f} us  "
+                     f"overhead {result['overhead_us']:>7.2f} us")
+
+    with tempfile.TemporaryDirectory() as directory:
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            metrics.dump(directory, 'benchmark')
+            timings.append((time.perf_counter() - start) * 1000)
+    report['results']['worker-dump'] = {'p50_ms': round(percentile(timings, 50), 3),
+                                        'p95_ms': round(percentile(timings, 95), 3)}
+    if stdout:
+        stdout.write(f"{'worker-dump':<24} p50 {report['results']['worker-dump']['p50_ms']:>8.3f} ms")
+    return report
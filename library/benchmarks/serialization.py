@@ -0,0 +1,51 @@
+"""
+Serialization benchmark: book list rows per second of the serializer and values_list() paths.
+"""
+import time
+
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from library.benchmarks import generate_dataset, percentile
+from library.models import Book
+from library.renderers import FastJSONRenderer
+from library.serializers import BookListSerializer
+from library.views import BOOK_LIST_ROWS
+
+
+SERIALIZATION_SIZES = (5, 100, 10000)
+
+
+def run_serialization_benchmark(sizes=SERIALIZATION_SIZES, iterations=5, stdout=None):
+    """
+    Compare serializing and rendering `sizes` books with BookListSerializer and JSONRenderer against the values_list()
+    rows, RowMapping and FastJSONRenderer path of the book list, in rows per second. Both must render the same bytes.
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    generate_dataset(max(sizes))
+    report = {'generated_at': timezone.now().isoformat(), 'iterations': iterations, 'results': {}}
+    books = Book.objects.select_related('author', 'genre').order_by('id')
+
+    def drf(count):
+        return JSONRenderer().render(BookListSerializer(books[:count], many=True).data)
+
+    def fast(count):
+        return FastJSONRenderer().render(BOOK_LIST_ROWS.map(books.values_list(*BOOK_LIST_ROWS.columns)[:count]))
+
+    for count in sizes:
+        if drf(count) != fast(count):
+            raise RuntimeError(f'The fast book list path renders different bytes for {count} books')
+        results = report['results'][str(count)] = {}
+        for name, path in (('serializer', drf), ('values', fast)):
+            timings = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                path(count)
+                timings.append(time.perf_counter() - start)
+            results[name] = {'rows_per_sec': round(count / percentile(timings, 50), 1),
+                             'p50_ms': round(percentile(timings, 50) * 1000, 3)}
+            if stdout:
+                stdout.write(f"{count:>7} {name:<12} {results[name]['rows_per_sec']:>12.1f} rows/s  "
+                             f"p50 {results[name]['p50_ms']:>9.3f} ms")
+    return report
@@ -0,0 +1,114 @@
+"""
+SQLite concurrency benchmark: concurrent reads and writes with and without the production SQLite profile.
+"""
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import OperationalError, connections, transaction
+from django.utils import timezone
+
+from library.models import Author, Book, Genre, Reservation
+
+User = get_user_model()
+
+
+def _concurrency_workload(alias, duration, readers, writers, book_ids, user_ids):
+    """Run reader and writer threads against `alias` for `duration` seconds and count operations and lock errors."""
+    totals = {'reads': 0, 'writes': 0, 'lock_errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def reader(seed):
+        rng = random.Random(seed)
+        done = 0
+        while time.perf_counter() < deadline:
+            books = Book.objects.using(alias).with_circulation_counts()
+            list(books.filter(pk__in=rng.sample(book_ids, 5)))
+            done += 1
+        with lock:
+            totals['reads'] += done
+        connections[alias].close()
+
+    def writer(seed):
+        rng = random.Random(seed)
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            book_id, user_id = rng.choice(book_ids), rng.choice(user_ids)
+            try:
+                # The reserve path: validate availability, then insert, in one transaction
+                with transaction.atomic(using=alias):
+                    Reservation.objects.using(alias).filter(book_id=book_id, is_active=True).count()
+                    Reservation.objects.using(alias).bulk_create([
+                        Reservation(user_id=user_id, book_id=book_id, expires_at=timezone.now(), is_active=False)
+                    ])
+                done += 1
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                errors += 1
+        with lock:
+            totals['writes'] += done
+            totals['lock_errors'] += errors
+        connections[alias].close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'reads_per_sec': round(totals['reads'] / duration, 1),
+        'writes_per_sec': round(totals['writes'] / duration, 1),
+        'lock_errors': totals['lock_errors'],
+    }
+
+
+def run_sqlite_concurrency_benchmark(size=1000, duration=5.0, readers=4, writers=4, stdout=None):
+    """
+    Run concurrent catalog reads and reservation writes against file based SQLite databases, once with Django's
+    default SQLite settings and once with the SQLITE_PRODUCTION_DATABASE profile.
+    """
+    profiles = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3'},
+        'production': dict(settings.SQLITE_PRODUCTION_DATABASE),
+    }
+    report = {'generated_at': timezone.now().isoformat(), 'size': size, 'duration': duration, 'readers': readers,
+              'writers': writers, 'results': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for profile, database in profiles.items():
+            alias = f'benchmark_{profile}'
+            database['NAME'] = str(Path(directory) / f'{profile}.sqlite3')
+            connections.settings[alias] = connections.configure_settings({'default': database})['default']
+            try:
+                call_command('migrate', database=alias, verbosity=0)
+                Author.objects.using(alias).bulk_create([Author(full_name=f'Author {i}') for i in range(10)])
+                Genre.objects.using(alias).bulk_create([Genre(name='Genre')])
+                Book.objects.using(alias).bulk_create([
+                    Book(title=f'Book {i}', author_id=i % 10 + 1, genre_id=1, release_year=2000, quantity=5)
+                    for i in range(size)
+                ])
+                User.objects.db_manager(alias).bulk_create([
+                    User(email=f'reader{i}@example.com', first_name='Reader', last_name=str(i),
+                         personal_id_number=str(i), birth_date='1990-01-01', password='!')
+                    for i in range(100)
+                ])
+                book_ids = list(Book.objects.using(alias).values_list('pk', flat=True))
+                user_ids = list(User.objects.using(alias).values_list('pk', flat=True))
+                connections[alias].close()
+
+                result = report['results'][profile] = _concurrency_workload(
+                    alias, duration, readers, writers, book_ids, user_ids)
+            finally:
+                connections[alias].close()
+                del connections.settings[alias]
+            if stdout:
+                stdout.write(f"{profile:<12} {result['reads_per_sec']:>10.1f} reads/s  "
+                             f"{result['writes_per_sec']:>10.1f} writes/s  {result['lock_errors']:>6} lock errors")
+    return report
@@ -0,0 +1,27 @@
+from django.db.models import Case, IntegerField, Value, When
+from rest_framework import filters
+
+
+class RankedSearchFilter(filters.SearchFilter):
+    """
+    Search filter ordering the matches by relevance: exact title matches first, then titles starting with the search
+    term, then other title matches and then author or genre matches. Ties are broken by popularity.
+
+    Explicit ?ordering= takes precedence, because OrderingFilter runs after this filter.
+    """
+    rank_field = 'title'
+
+    def filter_queryset(self, request, queryset, view):
+        queryset = super().filter_queryset(request, queryset, view)
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        term = ' '.join(terms)
+        rank = Case(
+            When(**{f'{self.rank_field}__iexact': term}, then=Value(3)),
+            When(**{f'{self.rank_field}__istartswith': term}, then=Value(2)),
+            When(**{f'{self.rank_field}__icontains': term}, then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        return queryset.alias(search_rank=rank).order_by('-search_rank', '-popularity', 'id')
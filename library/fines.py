@@ -0,0 +1,88 @@
+"""
+Overdue fines.
+
+A borrow returned or still out more than FINE_GRACE_DAYS after its due date is fined FINE_DAILY_RATE cents per day
+beyond the grace period, up to FINE_MAX_AMOUNT. accrue_fines() brings the Fine rows of all overdue borrows up to date
+with a single INSERT ... SELECT ... ON CONFLICT DO UPDATE, so the nightly run costs one statement however many
+borrows are overdue. Accrued amounts never shrink, e.g. when a due date is extended afterwards; settling a user's
+fines marks everything accrued so far as paid.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from library.models import Borrow, Fine
+
+# Whole days from the due date to the return, or to `now` for borrows still out, per database vendor
+OVERDUE_DAYS_SQL = {
+    # julianday() is a float, so round to whole seconds first or exact multiples of a day may come out a day short
+    'sqlite': 'CAST(ROUND((julianday(COALESCE(returned_at, %s)) - julianday(due_date)) * 86400) AS INTEGER) / 86400',
+    'postgresql': 'CAST(FLOOR(EXTRACT(EPOCH FROM COALESCE(returned_at, %s) - due_date) / 86400) AS INTEGER)',
+}
+SCALAR_FUNCTIONS = {
+    'sqlite': {'least': 'MIN', 'greatest': 'MAX'},
+    'postgresql': {'least': 'LEAST', 'greatest': 'GREATEST'},
+}
+
+ACCRUE_SQL = """
+INSERT INTO {fine} (borrow_id, user_id, overdue_days, amount, paid, updated_at)
+SELECT id, user_id, days, {least}(%s * (days - %s), %s), 0, %s
+FROM (
+    SELECT id, user_id, {overdue_days} AS days
+    FROM {borrow}
+    WHERE due_date < %s AND (returned_at IS NULL OR returned_at >= %s)
+) AS overdue
+WHERE days > %s
+ON CONFLICT (borrow_id) DO UPDATE SET
+    overdue_days = excluded.overdue_days,
+    amount = {greatest}(excluded.amount, {fine}.amount),
+    updated_at = excluded.updated_at
+WHERE excluded.overdue_days <> {fine}.overdue_days
+"""
+
+
+def accrue_fines(now=None, lookback_days=None):
+    """
+    Create or update the fines of all borrows overdue beyond the grace period at `now`: borrows still out and
+    borrows returned in the last `lookback_days` days (FINE_RETURN_LOOKBACK_DAYS by default), whose fines are
+    finalized by the first run after their return. Returns the number of fines written.
+    """
+    now = now or timezone.now()
+    lookback_days = settings.FINE_RETURN_LOOKBACK_DAYS if lookback_days is None else lookback_days
+    grace = settings.FINE_GRACE_DAYS
+    functions = SCALAR_FUNCTIONS[connection.vendor]
+    sql = ACCRUE_SQL.format(fine=connection.ops.quote_name(Fine._meta.db_table),
+                            borrow=connection.ops.quote_name(Borrow._meta.db_table),
+                            overdue_days=OVERDUE_DAYS_SQL[connection.vendor], **functions)
+    adapt = connection.ops.adapt_datetimefield_value
+    params = [settings.FINE_DAILY_RATE, grace, settings.FINE_MAX_AMOUNT, adapt(now), adapt(now),
+              adapt(now - timezone.timedelta(days=grace)), adapt(now - timezone.timedelta(days=lookback_days)), grace]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def outstanding(fines=None):
+    """Return the fines of `fines` (all by default) that are not fully paid."""
+    return (Fine.objects.all() if fines is None else fines).filter(amount__gt=F('paid'))
+
+
+def balance(user_id):
+    """Return the cents user `user_id` owes."""
+    return outstanding().filter(user_id=user_id).aggregate(balance=Sum(F('amount') - F('paid')))['balance'] or 0
+
+
+def balances():
+    """Return the users owing fines as rows of user id, email and balance, highest balance first."""
+    return outstanding().values('user').annotate(balance=Sum(F('amount') - F('paid'))) \
+        .values('user', 'user__email', 'balance').order_by('-balance', 'user')
+
+
+def settle(user_id):
+    """Mark all fines of user `user_id` as paid. Returns the cents settled."""
+    with transaction.atomic():
+        owed = outstanding().filter(user_id=user_id)
+        total = owed.aggregate(total=Sum(F('amount') - F('paid')))['total'] or 0
+        owed.update(paid=F('amount'), settled_at=timezone.now())
+    return total
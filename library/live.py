@@ -0,0 +1,231 @@
+"""
+Live availability updates, streamed to browsers with Server-Sent Events.
+
+Once a transaction recording circulation events commits, or a book is saved, the availability and wish queue of the
+books involved are read once and published. Every process serving streams keeps one AvailabilityBus, and every open
+stream is a Subscription to a set of books holding the latest unsent update per book: bursts of changes to a book
+coalesce into one message, and a slow client never holds more than one pending update per subscribed book. A waiting
+stream is a coroutine parked on an asyncio.Event, so idle clients cost no thread and no query.
+
+LIVE_UPDATES_BACKEND selects how updates reach the buses. LocalBackend delivers them inside the publishing process,
+which suits a single ASGI server process. RedisBackend publishes them on the LIVE_UPDATES_CHANNEL pub/sub channel of
+any Redis compatible server, which every serving process relays into its bus, so changes made by other processes and
+Celery tasks reach all clients.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+import redis
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from library.models import Book
+from library.signals import circulation_recorded
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds browsers wait before reconnecting a dropped stream
+RECONNECT_MS = 5000
+
+
+class BusFull(Exception):
+    pass
+
+
+class Subscription:
+    """An open stream's books and their pending updates, filled by the bus from any thread."""
+
+    def __init__(self, bus, user_id, book_ids):
+        self.bus = bus
+        self.user_id = user_id
+        self.book_ids = frozenset(book_ids)
+        self.pending = {}
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+
+    def offer(self, update):
+        """Queue `update`, replacing any pending update of the same book. Called with the bus lock held."""
+        self.pending[update['book']] = update
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:  # The stream's event loop is closed, it is about to unsubscribe
+            pass
+
+    async def updates(self, timeout):
+        """Wait up to `timeout` seconds for updates and return them, an empty list on timeout."""
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        with self.bus.lock:
+            self.ready.clear()
+            pending, self.pending = self.pending, {}
+        return [self.personalize(update) for update in pending.values()]
+
+    def personalize(self, update):
+        """Return the message of `update` for this stream's user: their wish queue position instead of the queue."""
+        waitlist = update['waitlist']
+        position = waitlist.index(self.user_id) + 1 if self.user_id in waitlist else None
+        return {'book': update['book'], 'available_copies': update['available_copies'],
+                'is_available': update['is_available'], 'queue_position': position}
+
+
+class AvailabilityBus:
+    """In-process registry of the open streams, bounded to `max_subscribers`."""
+
+    def __init__(self, max_subscribers):
+        self.max_subscribers = max_subscribers
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.by_book = defaultdict(set)
+
+    def subscribe(self, user_id, book_ids):
+        subscription = Subscription(self, user_id, book_ids)
+        with self.lock:
+            if len(self.subscriptions) >= self.max_subscribers:
+                raise BusFull(f'{self.max_subscribers} streams are open')
+            self.subscriptions.add(subscription)
+            for book_id in subscription.book_ids:
+                self.by_book[book_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            for book_id in subscription.book_ids:
+                subscribers = self.by_book.get(book_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.by_book[book_id]
+
+    def watched(self, book_ids):
+        """Return the ids of `book_ids` that an open stream subscribed to."""
+        with self.lock:
+            return {book_id for book_id in book_ids if book_id in self.by_book}
+
+    def dispatch(self, updates):
+        with self.lock:
+            for update in updates:
+                for subscription in self.by_book.get(update['book'], ()):
+                    subscription.offer(update)
+
+
+class LocalBackend:
+    """Deliver updates to the streams of the publishing process only."""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def watched(self, book_ids):
+        return self.bus.watched(book_ids)
+
+    def publish(self, updates):
+        self.bus.dispatch(updates)
+
+    async def start(self):
+        pass
+
+
+class RedisBackend:
+    """Deliver updates to the streams of every process through a Redis pub/sub channel."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.client = redis.Redis.from_url(settings.LIVE_UPDATES_REDIS_URL)
+        self.listener = None
+
+    def watched(self, book_ids):
+        return set(book_ids)  # Streams of other processes are unknown here
+
+    def publish(self, updates):
+        self.client.publish(settings.LIVE_UPDATES_CHANNEL, json.dumps(updates))
+
+    async def start(self):
+        """Start relaying the channel into the bus, once per process."""
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.get_running_loop().create_task(self.listen())
+
+    async def listen(self):
+        while True:
+            try:
+                async with redis.asyncio.Redis.from_url(settings.LIVE_UPDATES_REDIS_URL).pubsub() as pubsub:
+                    await pubsub.subscribe(settings.LIVE_UPDATES_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.bus.dispatch(json.loads(message['data']))
+            except redis.RedisError:
+                logger.exception('Live updates channel lost, reconnecting')
+                await asyncio.sleep(RECONNECT_MS / 1000)
+
+
+bus = AvailabilityBus(settings.LIVE_MAX_SUBSCRIBERS)
+
+
+@lru_cache(maxsize=None)
+def backend():
+    return import_string(settings.LIVE_UPDATES_BACKEND)(bus)
+
+
+def availability_updates(book_ids):
+    """Return the current availability and wish queue of `book_ids`, in two queries."""
+    books = Book.objects.filter(id__in=book_ids).only('id', 'quantity') \
+        .with_circulation_counts('num_currently_borrowed', 'num_active_reservations')
+    waitlists = defaultdict(list)
+    # Wishers queue in the order they made their wishes
+    for book_id, user_id in Book.wished_by.through.objects.filter(book_id__in=book_ids).order_by('id') \
+            .values_list('book_id', 'customuser_id'):
+        waitlists[book_id].append(user_id)
+    return [{'book': book.pk, 'available_copies': book.available_copies, 'is_available': book.is_available,
+             'waitlist': waitlists[book.pk]} for book in books]
+
+
+def publish_availability(book_ids):
+    """Publish the availability of the `book_ids` that are streamed somewhere."""
+    watched = backend().watched(book_ids)
+    if watched:
+        backend().publish(availability_updates(watched))
+
+
+@receiver(circulation_recorded)
+def publish_circulated_books(events, **kwargs):
+    publish_availability({event.book_id for event in events})
+
+
+@receiver(post_save, sender=Book)
+def publish_saved_book(instance, **kwargs):
+    transaction.on_commit(lambda: publish_availability({instance.pk}), robust=True)
+
+
+def format_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+async def stream(subscription):
+    """
+    Yield the Server-Sent Events of `subscription`: the current availability of its books, then every change, with
+    a comment line every LIVE_HEARTBEAT_SECONDS of silence to keep proxies from closing the connection.
+    """
+    try:
+        await backend().start()
+        yield f'retry: {RECONNECT_MS}\n\n'
+        # Subscribed before reading, so no change between the two is missed
+        for update in await sync_to_async(availability_updates)(subscription.book_ids):
+            yield format_event('availability', subscription.personalize(update))
+        while True:
+            updates = await subscription.updates(settings.LIVE_HEARTBEAT_SECONDS)
+            if not updates:
+                yield ': keep-alive\n\n'
+            for update in updates:
+                yield format_event('availability', update)
+    finally:
+        bus.unsubscribe(subscription)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from library.fines import accrue_fines
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates the fines of all overdue borrows'
+
+    def handle(self, *args, **kwargs):
+        count = accrue_fines()
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully accrued {count} fines'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library.archive import analyze, archive_borrows, archive_cutoff, archive_reservations
+from library.models import ArchivedBorrow, ArchivedReservation, Borrow, Reservation
+
+
+class Command(BaseCommand):
+    help = 'Moves returned borrows and inactive reservations older than the archive horizon into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive horizon in days, ARCHIVE_HORIZON_DAYS by default')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows moved per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            before = archive_cutoff(options['days'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        # Every chunk commits on its own, an interrupted run is simply started again
+        for name, archive in [('borrows', archive_borrows), ('reservations', archive_reservations)]:
+            total = 0
+            for count in archive(before, options['chunk_size']):
+                total += count
+                self.stdout.write(f'Archived {total} {name}')
+            self.stdout.write(self.style.SUCCESS(
+                f'Successfully archived {total} {name} closed before {before:%Y-%m-%d}'))
+        analyze(Borrow, Reservation, ArchivedBorrow, ArchivedReservation)
@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from Library_management_project.celery import app as celery_app
+from library import benchmarks
+from library.benchmarks import auth, circulation, fines, metrics, serialization, sqlite_concurrency
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks API endpoints and web views against generated datasets in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', choices=['endpoints', 'circulation', 'sqlite-concurrency', 'auth',
+                                                'serialization', 'fines', 'metrics'],
+                            default='endpoints',
+                            help='endpoints: every API endpoint and web view; '
+                                 'circulation: checkout throughput of the circulation desk; '
+                                 'auth: session against bearer token authentication overhead; '
+                                 'serialization: book list rows per second of the serializer and values() paths; '
+                                 'fines: nightly fine accrual over --rows overdue borrows; '
+                                 'metrics: request overhead of METRICS_ENABLED and the cost of a worker metrics dump; '
+                                 'sqlite-concurrency: concurrent reads and writes with and without the production '
+                                 'SQLite profile')
+        parser.add_argument('--sizes', default=','.join(map(str, benchmarks.DEFAULT_SIZES)),
+                            help='Comma separated dataset sizes (number of books)')
+        parser.add_argument('--iterations', type=int, default=20, help='Measured calls per endpoint')
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            help='Only run the given endpoint (repeatable)')
+        parser.add_argument('--operations', type=int, default=500,
+                            help='Operations per phase of the circulation suite')
+        parser.add_argument('--batch-size', type=int, default=50, help='Operations per call in the circulation suite')
+        parser.add_argument('--duration', type=float, default=5.0,
+                            help='Seconds per profile in the sqlite-concurrency suite')
+        parser.add_argument('--threads', type=int, default=4,
+                            help='Reader and writer threads each in the sqlite-concurrency suite')
+        parser.add_argument('--rows', type=int, default=1000000, help='Overdue borrows in the fines suite')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='Compare the results against this JSON report')
+        parser.add_argument('--latency-threshold', type=float, default=0.25,
+                            help='Allowed relative p95 latency increase over the baseline')
+        parser.add_argument('--query-threshold', type=int, default=0,
+                            help='Allowed absolute increase of SQL queries over the baseline')
+        parser.add_argument('--memory-threshold', type=float, default=0.5,
+                            help='Allowed relative peak memory increase over the baseline')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size]
+        baseline = benchmarks.load_report(options['baseline']) if options['baseline'] else None
+
+        setup_test_environment()
+        celery_app.conf.task_always_eager = True  # Run queued tasks inline, no broker is needed
+        # Measure the endpoints rather than the rate limits
+        rates = dict.fromkeys(settings.REST_FRAMEWORK.get('DEFAULT_THROTTLE_RATES', {}))
+        unthrottled = override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates})
+        unthrottled.enable()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            if options['suite'] == 'sqlite-concurrency':
+                report = sqlite_concurrency.run_sqlite_concurrency_benchmark(
+                    sizes[-1], options['duration'], options['threads'], options['threads'], stdout=self.stdout)
+            elif options['suite'] == 'serialization':
+                report = serialization.run_serialization_benchmark(stdout=self.stdout)
+            elif options['suite'] == 'fines':
+                report = fines.run_fines_benchmark(options['rows'], stdout=self.stdout)
+            elif options['suite'] == 'metrics':
+                report = metrics.run_metrics_benchmark(sizes[-1], options['iterations'], stdout=self.stdout)
+            elif options['suite'] == 'auth':
+                report = auth.run_auth_benchmark(sizes[-1], options['iterations'], stdout=self.stdout)
+            elif options['suite'] == 'circulation':
+                report = circulation.run_circulation_benchmark(sizes[-1], options['operations'],
+                                                               options['batch_size'], stdout=self.stdout)
+            else:
+                report = benchmarks.run_suite(sizes, options['iterations'], options['endpoints'],
+                                              stdout=self.stdout)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            unthrottled.disable()
+            teardown_test_environment()
+
+        if options['output']:
+            benchmarks.write_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+        if baseline and options['suite'] == 'endpoints':
+            regressions = benchmarks.compare_reports(
+                report, baseline,
+                latency_threshold=options['latency_threshold'],
+                query_threshold=options['query_threshold'],
+                memory_threshold=options['memory_threshold'],
+            )
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f'{len(regressions)} regression(s) against {options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from library.snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Exports books, borrows and reservations into a columnar snapshot for the analytics API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help='Snapshot directory, ANALYTICS_SNAPSHOT_DIR by default')
+        parser.add_argument('--keep', type=int, help='Snapshots kept, ANALYTICS_SNAPSHOTS_KEPT by default')
+
+    def handle(self, *args, **options):
+        path = export_snapshot(options['directory'], options['keep'])
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully exported the snapshot {path}'))
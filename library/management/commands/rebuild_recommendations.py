@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from library.recommendations import rebuild_neighbours
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the similar books of all books from the borrow history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--neighbours', type=int,
+                            help='Similar books per book, RECOMMENDATION_NEIGHBOURS by default')
+
+    def handle(self, *args, **options):
+        count = rebuild_neighbours(options['neighbours'])
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully stored {count} similar books'))
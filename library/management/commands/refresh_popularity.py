@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from library.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Recounts the popularity of all books from their borrows and archive summaries'
+
+    def handle(self, *args, **kwargs):
+        count = Book.objects.refresh_popularity()
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully refreshed the popularity of {count} books'))
@@ -0,0 +1,39 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Copies the primary SQLite database onto the read replicas in DATABASE_REPLICAS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='Keep running and sync again every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No replicas configured, set DATABASE_REPLICAS')
+        while True:
+            self.sync()
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def sync(self):
+        primary = sqlite3.connect(settings.DATABASES['default']['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                started = time.monotonic()
+                # The online backup API copies a consistent snapshot while the primary keeps taking writes, and
+                # replica readers simply wait for the copy through their busy timeout
+                replica = sqlite3.connect(settings.DATABASES[alias]['NAME'], timeout=30)
+                try:
+                    primary.backup(replica)
+                finally:
+                    replica.close()
+                self.stdout.write(self.style.SUCCESS(
+                    f'Synced {alias} in {(time.monotonic() - started) * 1000:.0f} ms'))
+        finally:
+            primary.close()
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_alter_author_options_alter_book_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='borrow',
+            index=models.Index(fields=['book', '-borrowed_at', '-id'], name='borrow_book_history_idx'),
+        ),
+    ]
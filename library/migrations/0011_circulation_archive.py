@@ -0,0 +1,68 @@
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_circulation_date_indexes'),
+        ('users', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookArchiveSummary',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive_summary', serialize=False, to='library.book', verbose_name='Book')),
+                ('borrow_count', models.PositiveIntegerField(default=0, verbose_name='Borrow Count')),
+            ],
+            options={
+                'verbose_name': 'Book Archive Summary',
+                'verbose_name_plural': 'Book Archive Summaries',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserArchiveSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive_summary', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+                ('late_return_count', models.PositiveIntegerField(default=0, verbose_name='Late Return Count')),
+            ],
+            options={
+                'verbose_name': 'User Archive Summary',
+                'verbose_name_plural': 'User Archive Summaries',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedReservation',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('reserved_at', models.DateTimeField(verbose_name='Reserved At')),
+                ('expires_at', models.DateTimeField(verbose_name='Expires At')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='library.book', verbose_name='Book')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Archived Reservation',
+                'verbose_name_plural': 'Archived Reservations',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedBorrow',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('borrowed_at', models.DateTimeField(verbose_name='Borrowed At')),
+                ('due_date', models.DateTimeField(verbose_name='Due Date')),
+                ('returned_at', models.DateTimeField(verbose_name='Returned At')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='library.book', verbose_name='Book')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Archived Borrow',
+                'verbose_name_plural': 'Archived Borrows',
+                'indexes': [models.Index(fields=['returned_at'], name='archived_borrow_returned_idx')],
+            },
+        ),
+    ]
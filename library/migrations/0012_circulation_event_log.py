@@ -0,0 +1,42 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0011_circulation_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsumerCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='Name')),
+                ('position', models.BigIntegerField(default=0, verbose_name='Position')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+            ],
+            options={
+                'verbose_name': 'Consumer Checkpoint',
+                'verbose_name_plural': 'Consumer Checkpoints',
+            },
+        ),
+        migrations.CreateModel(
+            name='CirculationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('borrowed', 'Borrowed'), ('returned', 'Returned'), ('extended', 'Extended'), ('reserved', 'Reserved'), ('cancelled', 'Cancelled'), ('expired', 'Expired'), ('wished', 'Wished'), ('unwished', 'Unwished')], max_length=10, verbose_name='Kind')),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Occurred At')),
+                ('book', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='library.book', verbose_name='Book')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Circulation Event',
+                'verbose_name_plural': 'Circulation Events',
+            },
+        ),
+    ]
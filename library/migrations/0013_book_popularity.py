@@ -0,0 +1,28 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_popularity(apps, schema_editor):
+    Book = apps.get_model('library', 'Book')
+    Borrow = apps.get_model('library', 'Borrow')
+    BookArchiveSummary = apps.get_model('library', 'BookArchiveSummary')
+    borrows = Borrow.objects.filter(book=OuterRef('pk')).order_by().values('book').annotate(count=Count('pk'))
+    archived = BookArchiveSummary.objects.filter(book=OuterRef('pk')).values('borrow_count')
+    Book.objects.update(popularity=Coalesce(Subquery(borrows.values('count')), 0) + Coalesce(Subquery(archived), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0012_circulation_event_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='popularity',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False, verbose_name='Popularity'),
+        ),
+        migrations.RunPython(backfill_popularity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0013_book_popularity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookNeighbour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='Score')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='library.book', verbose_name='Book')),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='library.book', verbose_name='Neighbour')),
+            ],
+            options={
+                'verbose_name': 'Book Neighbour',
+                'verbose_name_plural': 'Book Neighbours',
+                'indexes': [models.Index(fields=['book', '-score'], name='book_neighbour_score_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='bookneighbour',
+            constraint=models.UniqueConstraint(fields=('book', 'neighbour'), name='book_neighbour_unique'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0014_book_neighbours'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Fine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('overdue_days', models.PositiveIntegerField(default=0, verbose_name='Overdue Days')),
+                ('amount', models.PositiveIntegerField(default=0, verbose_name='Amount (cents)')),
+                ('paid', models.PositiveIntegerField(default=0, verbose_name='Paid (cents)')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Updated At')),
+                ('settled_at', models.DateTimeField(blank=True, null=True, verbose_name='Settled At')),
+                ('borrow', models.OneToOneField(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='fine', to='library.borrow', verbose_name='Borrow')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fines', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Fine',
+                'verbose_name_plural': 'Fines',
+                'indexes': [models.Index(fields=['user', 'paid', 'amount'], name='fine_user_balance_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0015_fines'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedborrow',
+            index=models.Index(fields=['book', '-borrowed_at', '-id'], name='archived_borrow_history_idx'),
+        ),
+    ]
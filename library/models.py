@@ -1,11 +1,14 @@
-from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from library.validators import validate_no_active_borrowing, validate_no_active_reservation, validate_book_availability
+from library.signals import circulation_recorded
+from library.validators import validate_no_active_borrowing, validate_no_active_reservation, \
+    validate_book_availability, validate_no_reservation_for_other_book
 
 
 class Author(models.Model):
@@ -36,6 +39,66 @@ class Genre(models.Model):
         return self.name
 
 
+def count_per_book(queryset):
+    """Return a subquery expression counting the rows of `queryset` that belong to the outer book."""
+    counts = queryset.filter(book=OuterRef('pk')).order_by().values('book').annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(counts), 0)
+
+
+class BookQuerySet(models.QuerySet):
+    # Annotations read by Book's count properties, by property
+    COUNT_ANNOTATIONS = {
+        'currently_borrowed_count': ['num_currently_borrowed'],
+        'active_reservations_count': ['num_active_reservations'],
+        'total_borrowed_count': ['num_total_borrowed'],
+        'borrow_count_last_year': ['num_borrowed_last_year'],
+        'available_copies': ['num_currently_borrowed', 'num_active_reservations'],
+        'is_available': ['num_currently_borrowed', 'num_active_reservations'],
+    }
+
+    def with_circulation_counts(self, *names):
+        """
+        Annotate the borrow and reservation counts behind Book's count properties, so that listing many books does
+        not run a COUNT query per book and property. `names` limits the annotations; by default all are added except
+        num_borrowed_last_year.
+        """
+        one_year_ago = timezone.now() - timezone.timedelta(days=365)
+        counts = {
+            'num_currently_borrowed': lambda: count_per_book(Borrow.objects.filter(returned_at__isnull=True)),
+            'num_active_reservations': lambda: count_per_book(Reservation.objects.filter(is_active=True)),
+            'num_total_borrowed': lambda: count_per_book(Borrow.objects.all()) + archived_borrow_count(),
+            'num_borrowed_last_year': lambda: count_per_book(Borrow.objects.filter(borrowed_at__gte=one_year_ago)),
+        }
+        names = names or ['num_currently_borrowed', 'num_active_reservations', 'num_total_borrowed']
+        return self.annotate(**{name: counts[name]() for name in names})
+
+    def with_counts_for(self, fields):
+        """
+        Annotate only the counts read by the properties among `fields`, e.g. the fields a serializer renders.
+        Counts that are already annotated are kept.
+        """
+        names = {name for field in fields for name in self.COUNT_ANNOTATIONS.get(field, [])}
+        names.difference_update(self.query.annotations)
+        return self.with_circulation_counts(*sorted(names)) if names else self
+
+    def with_borrow_count(self, name='borrow_count'):
+        """Annotate the number of borrows of each book, archived ones included, as `name`."""
+        return self.annotate(**{name: count_per_book(Borrow.objects.all()) + archived_borrow_count()})
+
+    def refresh_popularity(self):
+        """
+        Recount the popularity of the books from their borrows and archive summaries in one UPDATE.
+        Returns the number of books updated.
+        """
+        return self.update(popularity=count_per_book(Borrow.objects.all()) + archived_borrow_count())
+
+
+def archived_borrow_count():
+    """Return a subquery expression with the number of archived borrows of the outer book."""
+    counts = BookArchiveSummary.objects.filter(book=OuterRef('pk')).values('borrow_count')
+    return Coalesce(Subquery(counts), 0)
+
+
 class Book(models.Model):
     """
     Model representing a book.
@@ -46,18 +109,29 @@ class Book(models.Model):
     title = models.CharField(max_length=100, verbose_name=_('Title'))
     release_year = models.IntegerField(verbose_name=_('Release Year'))
     quantity = models.IntegerField(verbose_name=_('Quantity'))
+    # Number of borrows, archived ones included. Incremented by Borrow.save and recounted nightly.
+    popularity = models.PositiveIntegerField(default=0, editable=False, db_index=True, verbose_name=_('Popularity'))
+
+    objects = BookQuerySet.as_manager()
 
+    # The count properties use the annotations of BookQuerySet.with_circulation_counts() when they are present
     @property
     def currently_borrowed_count(self):
+        if hasattr(self, 'num_currently_borrowed'):
+            return self.num_currently_borrowed
         return Borrow.objects.filter(book=self, returned_at__isnull=True).count()
 
     @property
     def active_reservations_count(self):
+        if hasattr(self, 'num_active_reservations'):
+            return self.num_active_reservations
         return Reservation.objects.filter(book=self, is_active=True).count()
 
     @property
     def total_borrowed_count(self):
-        return Borrow.objects.filter(book=self).count()
+        if hasattr(self, 'num_total_borrowed'):
+            return self.num_total_borrowed
+        return Book.objects.filter(pk=self.pk).with_borrow_count().values_list('borrow_count', flat=True).get()
 
     @property
     def available_copies(self):
@@ -72,16 +146,19 @@ class Book(models.Model):
         """
         Calculate the borrow count for the book in the past year.
         """
+        if hasattr(self, 'num_borrowed_last_year'):
+            return self.num_borrowed_last_year
         one_year_ago = timezone.now() - timezone.timedelta(days=365)
         return Borrow.objects.filter(book=self, borrowed_at__gte=one_year_ago).count()
 
     def borrow_history(self):
-        return Borrow.objects.filter(book=self).select_related('user').order_by('-borrowed_at')
+        return Borrow.objects.filter(book=self).select_related('user').order_by('-borrowed_at', '-id')
 
     def notify_wishers(self):
-        """Send a notification to all wishers of the book when it becomes available."""
+        """Send a notification to all wishers of the book when it becomes available and clear their wishes."""
         if self.is_available:
-            for user in self.wished_by.all():
+            wishers = list(self.wished_by.all())
+            for user in wishers:
                 send_mail(
                     'Book Available Notification',
                     f'Dear {user.email}, \n\n'
@@ -91,7 +168,9 @@ class Book(models.Model):
                     [user.email],
                     fail_silently=False,
                 )
-            self.wished_by.clear()
+            with transaction.atomic():
+                self.wished_by.remove(*wishers)
+                CirculationEvent.record_many(CirculationEvent.UNWISHED, [(user.pk, self.pk) for user in wishers])
 
     class Meta:
         verbose_name = _('Book')
@@ -118,20 +197,34 @@ class Reservation(models.Model):
         Plus, validate that only one active reservation per user is allowed.
         """
         validate_book_availability(self.book)
-        validate_no_active_borrowing(self.user, ignore_instance=self)
-        validate_no_active_reservation(self.user, ignore_instance=self)
+        validate_no_active_borrowing(self.user_id, ignore_instance=self)
+        validate_no_active_reservation(self.user_id, ignore_instance=self)
 
     def save(self, *args, **kwargs):
         is_new = self.pk is None
-        self.clean()
-        super().save(*args, **kwargs)
+        # Validate and write in one transaction, so concurrent reservations cannot both pass validation
+        with transaction.atomic():
+            self.clean()
+            # Only the save that deactivates the reservation cancels it, re-saving an inactive one records nothing.
+            # The filtered UPDATE locks the row, so of two concurrent cancellations only one matches
+            cancelled = not is_new and not self.is_active and bool(
+                Reservation.objects.filter(pk=self.pk, is_active=True).update(is_active=False))
+            super().save(*args, **kwargs)
+            if is_new:
+                CirculationEvent.record(CirculationEvent.RESERVED, self.user_id, self.book_id)
+            elif cancelled:
+                CirculationEvent.record(CirculationEvent.CANCELLED, self.user_id, self.book_id)
         # Notify the book's wishers (if they exist) when reservation is canceled or expired
-        if not self.is_active and not is_new:
+        if cancelled:
             self.book.notify_wishers()
 
     class Meta:
         verbose_name = _('Reservation')
         verbose_name_plural = _('Reservations')
+        indexes = [
+            models.Index(fields=['reserved_at'], name='reservation_reserved_at_idx'),
+            models.Index(fields=['expires_at'], name='reservation_expires_at_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.email} reserved {self.book.title}'
@@ -153,26 +246,251 @@ class Borrow(models.Model):
         """
         if self.returned_at is None:
             validate_book_availability(self.book)
-            validate_no_active_borrowing(self.user, ignore_instance=self)
-
-            # Check if the user has an active reservation for a different book
-            active_reservations = Reservation.objects.filter(user=self.user, is_active=True)
-            if active_reservations.exists() and not active_reservations.filter(book=self.book).exists():
-                raise ValidationError("This user has an active reservation for a different book.")
+            validate_no_active_borrowing(self.user_id, ignore_instance=self)
+            validate_no_reservation_for_other_book(self.user_id, self.book)
 
-    def save(self, *args, **kwargs):
-        """Cancel the reservation if the user borrows the reserved book."""
+    def save(self, *args, validate=True, **kwargs):
+        """
+        Cancel the reservation if the user borrows the reserved book.
+        Callers that already validated the borrow against prefetched state can pass validate=False.
+        """
         is_new = self.pk is None
-        self.clean()
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            if validate:
+                self.clean()
+            # Only the save that sets returned_at returns the borrow, re-saving a returned one records nothing
+            returned = not is_new and self.returned_at is not None and bool(
+                Borrow.objects.filter(pk=self.pk, returned_at__isnull=True).update(returned_at=self.returned_at))
+            super().save(*args, **kwargs)
+            Reservation.objects.filter(user_id=self.user_id, book_id=self.book_id, is_active=True) \
+                .update(is_active=False)
+            if is_new:
+                Book.objects.filter(pk=self.book_id).update(popularity=F('popularity') + 1)
+                CirculationEvent.record(CirculationEvent.BORROWED, self.user_id, self.book_id)
+            elif returned:
+                CirculationEvent.record(CirculationEvent.RETURNED, self.user_id, self.book_id)
         # Notify the book's wishers (if they exist) when borrowed book is returned
-        if self.returned_at and not is_new:
+        if returned:
             self.book.notify_wishers()
-        Reservation.objects.filter(user=self.user, book=self.book, is_active=True).update(is_active=False)
 
     class Meta:
         verbose_name = _('Borrow')
         verbose_name_plural = _('Borrows')
+        indexes = [
+            # Serves a book's borrow history, newest first, including its keyset pagination
+            models.Index(fields=['book', '-borrowed_at', '-id'], name='borrow_book_history_idx'),
+            models.Index(fields=['borrowed_at'], name='borrow_borrowed_at_idx'),
+            models.Index(fields=['due_date'], name='borrow_due_date_idx'),
+            models.Index(fields=['returned_at'], name='borrow_returned_at_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.email} borrowed {self.book.title}'
+
+
+class CirculationEvent(models.Model):
+    """
+    Model representing an entry of the append-only circulation event log.
+    Events are written in the transaction of the change they describe, so the log never misses or invents a change,
+    and are read in id order by the consumers in library.events. Borrowing a book also closes the borrower's
+    reservation of it, without a separate cancelled event.
+    """
+    BORROWED = 'borrowed'
+    RETURNED = 'returned'
+    EXTENDED = 'extended'
+    RESERVED = 'reserved'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+    WISHED = 'wished'
+    UNWISHED = 'unwished'
+    KIND_CHOICES = [
+        (BORROWED, _('Borrowed')),
+        (RETURNED, _('Returned')),
+        (EXTENDED, _('Extended')),
+        (RESERVED, _('Reserved')),
+        (CANCELLED, _('Cancelled')),
+        (EXPIRED, _('Expired')),
+        (WISHED, _('Wished')),
+        (UNWISHED, _('Unwished')),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name=_('Kind'))
+    # No database constraints: the log outlives deleted users and books
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False,
+                             related_name='+', verbose_name=_('User'))
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+                             verbose_name=_('Book'))
+    occurred_at = models.DateTimeField(default=timezone.now, verbose_name=_('Occurred At'))
+
+    @classmethod
+    def record(cls, kind, user_id, book_id):
+        """Append one event, in the caller's transaction."""
+        event = cls.objects.create(kind=kind, user_id=user_id, book_id=book_id)
+        cls._announce([event])
+        return event
+
+    @classmethod
+    def record_many(cls, kind, user_book_ids):
+        """Append one event per (user id, book id) pair with a single INSERT, in the caller's transaction."""
+        now = timezone.now()
+        events = cls.objects.bulk_create(
+            cls(kind=kind, user_id=user_id, book_id=book_id, occurred_at=now) for user_id, book_id in user_book_ids
+        )
+        cls._announce(events)
+        return events
+
+    @classmethod
+    def _announce(cls, events):
+        """Send circulation_recorded for `events` after the caller's transaction commits."""
+        if events:
+            # Robust, so a failing receiver cannot fail the caller after its changes are committed
+            transaction.on_commit(lambda: circulation_recorded.send(sender=cls, events=events), robust=True)
+
+    class Meta:
+        verbose_name = _('Circulation Event')
+        verbose_name_plural = _('Circulation Events')
+
+    def __str__(self):
+        return f'{self.kind} user {self.user_id} book {self.book_id}'
+
+
+class ConsumerCheckpoint(models.Model):
+    """
+    Model holding the id of the last circulation event processed by a consumer.
+    """
+    name = models.CharField(max_length=100, unique=True, verbose_name=_('Name'))
+    position = models.BigIntegerField(default=0, verbose_name=_('Position'))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_('Updated At'))
+
+    class Meta:
+        verbose_name = _('Consumer Checkpoint')
+        verbose_name_plural = _('Consumer Checkpoints')
+
+    def __str__(self):
+        return f'{self.name} at {self.position}'
+
+
+class ArchivedBorrow(models.Model):
+    """
+    Model representing a returned borrowing moved out of the Borrow table by the archive_circulation command.
+    It keeps the id of the original borrowing.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('User'))
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name=_('Book'))
+    borrowed_at = models.DateTimeField(verbose_name=_('Borrowed At'))
+    due_date = models.DateTimeField(verbose_name=_('Due Date'))
+    returned_at = models.DateTimeField(verbose_name=_('Returned At'))
+
+    class Meta:
+        verbose_name = _('Archived Borrow')
+        verbose_name_plural = _('Archived Borrows')
+        indexes = [
+            models.Index(fields=['returned_at'], name='archived_borrow_returned_idx'),
+            # Serves a book's borrow history including the archive, see Borrow
+            models.Index(fields=['book', '-borrowed_at', '-id'], name='archived_borrow_history_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.email} borrowed {self.book.title}'
+
+
+class ArchivedReservation(models.Model):
+    """
+    Model representing an inactive reservation moved out of the Reservation table by the archive_circulation command.
+    It keeps the id of the original reservation.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('User'))
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name=_('Book'))
+    reserved_at = models.DateTimeField(verbose_name=_('Reserved At'))
+    expires_at = models.DateTimeField(verbose_name=_('Expires At'))
+
+    class Meta:
+        verbose_name = _('Archived Reservation')
+        verbose_name_plural = _('Archived Reservations')
+
+    def __str__(self):
+        return f'{self.user.email} reserved {self.book.title}'
+
+
+class BookArchiveSummary(models.Model):
+    """
+    Model holding the number of archived borrows of a book, so its borrow counts stay correct after archiving.
+    """
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='archive_summary',
+                                verbose_name=_('Book'))
+    borrow_count = models.PositiveIntegerField(default=0, verbose_name=_('Borrow Count'))
+
+    class Meta:
+        verbose_name = _('Book Archive Summary')
+        verbose_name_plural = _('Book Archive Summaries')
+
+
+class UserArchiveSummary(models.Model):
+    """
+    Model holding the number of archived late returns of a user, so the late returning users stay correct after
+    archiving.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name='archive_summary', verbose_name=_('User'))
+    late_return_count = models.PositiveIntegerField(default=0, verbose_name=_('Late Return Count'))
+
+    class Meta:
+        verbose_name = _('User Archive Summary')
+        verbose_name_plural = _('User Archive Summaries')
+
+
+class BookNeighbour(models.Model):
+    """
+    Model holding one of the most similar books of a book, by the cosine similarity of their readers, see
+    library.recommendations.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='neighbours', verbose_name=_('Book'))
+    neighbour = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+', verbose_name=_('Neighbour'))
+    score = models.FloatField(verbose_name=_('Score'))
+
+    class Meta:
+        verbose_name = _('Book Neighbour')
+        verbose_name_plural = _('Book Neighbours')
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'neighbour'], name='book_neighbour_unique'),
+        ]
+        indexes = [
+            # Serves a book's neighbours, most similar first
+            models.Index(fields=['book', '-score'], name='book_neighbour_score_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.book_id} -> {self.neighbour_id} ({self.score:.3f})'
+
+
+class Fine(models.Model):
+    """
+    Model holding the overdue fine of a borrow, in cents. `amount` is the total accrued so far and `paid` the part
+    settled, so the outstanding balance is amount - paid. Fines are accrued nightly by library.fines.accrue_fines.
+    """
+    # Settled fines outlive their borrow when it is archived; unsettled ones keep it from being archived
+    borrow = models.OneToOneField(Borrow, on_delete=models.SET_NULL, null=True, related_name='fine',
+                                  verbose_name=_('Borrow'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='fines',
+                             verbose_name=_('User'))
+    overdue_days = models.PositiveIntegerField(default=0, verbose_name=_('Overdue Days'))
+    amount = models.PositiveIntegerField(default=0, verbose_name=_('Amount (cents)'))
+    paid = models.PositiveIntegerField(default=0, verbose_name=_('Paid (cents)'))
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name=_('Updated At'))
+    settled_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Settled At'))
+
+    class Meta:
+        verbose_name = _('Fine')
+        verbose_name_plural = _('Fines')
+        indexes = [
+            models.Index(fields=['user', 'paid', 'amount'], name='fine_user_balance_idx'),
+        ]
+
+    @property
+    def balance(self):
+        return self.amount - self.paid
+
+    def __str__(self):
+        return f'{self.user_id} owes {self.balance} for borrow {self.borrow_id}'
@@ -0,0 +1,62 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils.functional import cached_property
+
+
+def estimate_table_rows(model, using='default', exact_below=None):
+    """
+    Return a cheap estimate of the number of rows in `model`'s table, or None if no estimate is available.
+
+    PostgreSQL keeps the estimate in its catalog. SQLite only has one after ANALYZE, which archive_circulation and the
+    nightly refresh_table_statistics task run; an estimate bigger than the primary key range predates a deletion and
+    is ignored. Without it a table holding fewer than `exact_below` rows is counted exactly, reading at most that many
+    rows, and a bigger one is estimated by its primary key range, which overestimates after deletions.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    analyzed = None
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            if 'sqlite_stat1' in connection.introspection.table_names(cursor):
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+                row = cursor.fetchone()
+                if row:
+                    analyzed = int(row[0].split()[0])
+    queryset = model._default_manager.using(using).order_by()
+    bounds = None
+    if analyzed is not None:
+        bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['high'] is None:
+            return 0
+        if analyzed <= bounds['high'] - bounds['low'] + 1:
+            return analyzed
+    counted = queryset[:exact_below].count() if exact_below else 0
+    if exact_below and counted < exact_below:
+        return counted
+    bounds = bounds or queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['high'] is None:
+        return 0
+    return max(bounds['high'] - bounds['low'] + 1, counted)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for very large tables. An unfiltered listing gets an estimated total instead of a COUNT(*) over the
+    whole table once the table is bigger than `exact_count_limit`; filtered listings are still counted exactly.
+    """
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not getattr(queryset, 'query', None) or queryset.query.where:
+            return super().count
+        estimate = estimate_table_rows(queryset.model, queryset.db, exact_below=self.exact_count_limit + 1)
+        if estimate is None or estimate <= self.exact_count_limit:
+            return super().count
+        return estimate
@@ -0,0 +1,146 @@
+"""
+"Readers also borrowed" recommendations.
+
+Borrow history is read once as the distinct (user, book) pairs, i.e. a sparse user x book matrix X, and the
+co-occurrence X^T X is computed with NumPy for batches of books at a time: each batch's readers are expanded to all
+books they read and the resulting (book, other book) pairs are counted, so only non-zero entries are ever held. The
+cosine similarity of two books is their number of common readers divided by the geometric mean of their reader counts.
+The RECOMMENDATION_NEIGHBOURS most similar books of every book are stored in BookNeighbour, so serving recommendations
+is a single indexed lookup.
+The table is rebuilt nightly by the rebuild_book_neighbours task. In between, the apply_events consumer of the
+circulation event log recomputes the neighbours of newly borrowed books and inserts them into their neighbours' lists.
+Archived borrows are not used: recommendations follow the last ARCHIVE_HORIZON_DAYS of reading.
+"""
+import itertools
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from library.models import Borrow, BookNeighbour, CirculationEvent
+
+# (book, other book) pairs expanded in memory per batch of books
+MAX_BATCH_PAIRS = 1 << 22
+
+
+def load_pairs(borrows):
+    """Return the distinct (user id, book id) pairs of the `borrows` queryset as an (n, 2) int64 array."""
+    rows = borrows.order_by().values_list('user_id', 'book_id').distinct()
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, 2)
+
+
+def top_neighbours(pairs, book_ids=None, degrees=None, k=None):
+    """
+    Yield (book id, neighbour ids, scores) for each of `book_ids` (all books by default) found in `pairs`, with up to
+    `k` neighbours of a positive cosine similarity, most similar first.
+
+    `pairs` must hold every reader of `book_ids` with all books those readers borrowed. `degrees` maps book ids to
+    their number of readers and defaults to the counts in `pairs`, which are only complete if `pairs` is.
+    """
+    k = k or settings.RECOMMENDATION_NEIGHBOURS
+    if not len(pairs):
+        return
+    users, user_index = np.unique(pairs[:, 0], return_inverse=True)
+    books, book_index = np.unique(pairs[:, 1], return_inverse=True)
+    if degrees is None:
+        readers = np.bincount(book_index, minlength=len(books)).astype(np.float64)
+    else:
+        readers = np.array([degrees.get(book_id, 0) for book_id in books.tolist()], dtype=np.float64)
+
+    # CSR layout of X: the books of user u are user_books[indptr[u]:indptr[u + 1]]
+    order = np.argsort(user_index, kind='stable')
+    user_books = book_index[order]
+    user_lengths = np.bincount(user_index, minlength=len(users))
+    indptr = np.concatenate(([0], np.cumsum(user_lengths)))
+
+    if book_ids is None:
+        targets = np.arange(len(books))
+    else:
+        targets = np.flatnonzero(np.isin(books, np.fromiter(book_ids, dtype=np.int64)))
+    # Split the targets into batches of about MAX_BATCH_PAIRS expanded pairs
+    cost = np.cumsum(np.bincount(book_index, weights=user_lengths[user_index], minlength=len(books))[targets])
+    local = np.full(len(books), -1, dtype=np.int64)
+    start = 0
+    while start < len(targets):
+        done = cost[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(cost, done + MAX_BATCH_PAIRS, side='right')))
+        batch = targets[start:end]
+        start = end
+        local[batch] = np.arange(len(batch))
+        # Readers of the batch's books, expanded to every book they read, counted per (book, other book)
+        mask = local[book_index] >= 0
+        pair_users, pair_books = user_index[mask], local[book_index[mask]]
+        local[batch] = -1
+        lengths = user_lengths[pair_users]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        cols = user_books[np.repeat(indptr[pair_users], lengths) + offsets]
+        keys, counts = np.unique(np.repeat(pair_books, lengths) * len(books) + cols, return_counts=True)
+        rows, cols = np.divmod(keys, len(books))
+        other = cols != batch[rows]
+        rows, cols, counts = rows[other], cols[other], counts[other]
+
+        scores = counts / np.sqrt(np.maximum(readers[batch[rows]] * readers[cols], 1))
+        order = np.lexsort((cols, -scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        best = rank < k
+        rows, cols, scores = rows[best], cols[best], scores[best]
+        splits = np.searchsorted(rows, np.arange(1, len(batch)))
+        for target, neighbours, neighbour_scores in zip(batch.tolist(), np.split(cols, splits),
+                                                        np.split(scores, splits)):
+            yield int(books[target]), books[neighbours].tolist(), neighbour_scores.tolist()
+
+
+def rebuild_neighbours(k=None):
+    """Recompute the neighbours of all books from the whole borrow history. Returns the number of rows stored."""
+    pairs = load_pairs(Borrow.objects.all())
+    rows = [BookNeighbour(book_id=book_id, neighbour_id=neighbour_id, score=score)
+            for book_id, neighbour_ids, scores in top_neighbours(pairs, k=k)
+            for neighbour_id, score in zip(neighbour_ids, scores)]
+    with transaction.atomic():
+        BookNeighbour.objects.all().delete()
+        BookNeighbour.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def patch_neighbours(book_ids, k=None):
+    """
+    Recompute the neighbours of `book_ids` from the histories of their readers only, and insert the books into
+    their neighbours' lists, which keep their `k` best entries. Other scores are refreshed by the next rebuild.
+    """
+    k = k or settings.RECOMMENDATION_NEIGHBOURS
+    readers = Borrow.objects.filter(book_id__in=book_ids).values('user_id')
+    pairs = load_pairs(Borrow.objects.filter(user_id__in=readers))
+    co_read = Borrow.objects.filter(user_id__in=readers).values('book_id')
+    degrees = dict(Borrow.objects.filter(book_id__in=co_read).order_by().values('book_id')
+                   .annotate(readers=Count('user_id', distinct=True)).values_list('book_id', 'readers'))
+    rows = []
+    reverse_rows = []
+    for book_id, neighbour_ids, scores in top_neighbours(pairs, book_ids, degrees, k):
+        for neighbour_id, score in zip(neighbour_ids, scores):
+            rows.append(BookNeighbour(book_id=book_id, neighbour_id=neighbour_id, score=score))
+            reverse_rows.append(BookNeighbour(book_id=neighbour_id, neighbour_id=book_id, score=score))
+    with transaction.atomic():
+        BookNeighbour.objects.filter(book_id__in=book_ids).delete()
+        BookNeighbour.objects.bulk_create(rows, batch_size=1000)
+        BookNeighbour.objects.bulk_create(reverse_rows, batch_size=1000, update_conflicts=True,
+                                          unique_fields=['book', 'neighbour'], update_fields=['score'])
+        _trim({row.book_id for row in reverse_rows}, k)
+    return len(rows)
+
+
+def _trim(book_ids, k):
+    """Delete all but the `k` best neighbours of `book_ids`."""
+    neighbours = BookNeighbour.objects.filter(book_id__in=book_ids).order_by('book_id', '-score', 'id') \
+        .values_list('id', 'book_id')
+    surplus = [row_id for _, group in itertools.groupby(neighbours, key=lambda row: row[1])
+               for row_id, _ in itertools.islice(group, k, None)]
+    BookNeighbour.objects.filter(id__in=surplus).delete()
+
+
+def apply_events(events):
+    """Circulation event consumer patching the neighbours of newly borrowed books."""
+    book_ids = sorted({event.book_id for event in events if event.kind == CirculationEvent.BORROWED})
+    if book_ids:
+        patch_neighbours(book_ids)
@@ -0,0 +1,45 @@
+import math
+
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is used without it
+    orjson = None
+
+
+def _has_non_finite_float(data):
+    if isinstance(data, float):
+        return not math.isfinite(data)
+    if isinstance(data, dict):
+        data = data.values()
+    elif not isinstance(data, (list, tuple)):
+        return False
+    return any(_has_non_finite_float(item) for item in data)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer encoding with orjson when it is installed, falling back to JSONRenderer otherwise.
+
+    The output is byte for byte that of JSONRenderer with the default compact, unicode and strict settings, as long as
+    the data holds no floats in exponent notation, which orjson writes differently (1e16 instead of 1e+16). Types
+    orjson does not know, and datetimes, go through the DRF encoder as before. Indented output (e.g. for the browsable
+    API) and data orjson rejects are rendered by JSONRenderer. orjson writes NaN and infinities as null where the strict
+    JSONRenderer raises ValueError, so output holding a null is checked for them and handed to JSONRenderer to raise.
+    """
+    options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+               if orjson else 0)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or not self.compact or self.ensure_ascii or not self.strict
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except (orjson.JSONEncodeError, TypeError):
+            return super().render(data, accepted_media_type, renderer_context)
+        if b'null' in ret and _has_non_finite_float(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escape the line separators like JSONRenderer does, to keep the output a strict JavaScript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
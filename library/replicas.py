@@ -0,0 +1,106 @@
+"""
+Routing of read-only API traffic to SQLite read replicas.
+
+Reads go to the primary database unless a view opts in: viewsets using ReplicaReadsMixin send the actions listed in
+`replica_actions` to a random replica from DATABASE_REPLICAS. PrimaryPinMiddleware pins a user who has just written
+something, through any view, to the primary for REPLICA_STICKY_SECONDS, so they read their own writes while the
+replicas catch up. Pins are kept in the REPLICA_PIN_CACHE cache, which must be shared by all processes. Writes always
+go to the primary. Replicas are refreshed from the primary with the sync_replicas command.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_use_replica = ContextVar('use_replica', default=False)
+
+
+@contextmanager
+def replica_reads():
+    """Send the reads made inside the block to a replica, if any is configured."""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def _pin_key(user_id):
+    return f'replicas:primary-pin:{user_id}'
+
+
+def pin_to_primary(user):
+    """Keep `user`'s reads on the primary for REPLICA_STICKY_SECONDS after a write."""
+    if user.is_authenticated and settings.DATABASE_REPLICAS:
+        caches[settings.REPLICA_PIN_CACHE].set(_pin_key(user.pk), True, settings.REPLICA_STICKY_SECONDS)
+
+
+def is_pinned_to_primary(user):
+    return bool(settings.DATABASE_REPLICAS and user.is_authenticated
+                and caches[settings.REPLICA_PIN_CACHE].get(_pin_key(user.pk), False))
+
+
+class ReplicaRouter:
+    """
+    Database router sending reads to a replica inside replica_reads() blocks and everything else to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        # Entries of a database cache, e.g. the pins, change on every request and would be stale on a replica
+        if _use_replica.get() and settings.DATABASE_REPLICAS and model._meta.app_label != 'django_cache':
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas are copies of the primary, so rows from any of them may be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive the schema together with the data from sync_replicas
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaReadsMixin:
+    """
+    ViewSet mixin serving the safe requests of the actions in `replica_actions` from a read replica, unless the user
+    is pinned to the primary after a recent write.
+    """
+    replica_actions = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if (self.action in self.replica_actions and request.method in SAFE_METHODS
+                and not is_pinned_to_primary(request.user)):
+            self._replica_token = _use_replica.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _use_replica.reset(token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class PrimaryPinMiddleware:
+    """
+    Pin the user of every successful unsafe request to the primary, whichever view served it: the API, the admin or
+    the web views. Must come after AuthenticationMiddleware; users authenticated by DRF, e.g. with a bearer token, are
+    seen too, as DRF sets them on the request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and user is not None:
+            pin_to_primary(user)
+        return response
@@ -0,0 +1,50 @@
+"""
+Serialization of values_list() rows without model instances or serializer fields.
+
+RowMapping compiles the read-only fields of a serializer into the list of columns to select and nested closures over
+operator.itemgetter building the serializer's output dict from a row, so listing many rows costs one dict per (nested)
+object instead of a model instance and a to_representation() call per field.
+"""
+from operator import itemgetter
+
+from rest_framework import serializers
+
+# Fields whose representation of a database value is the value itself
+PLAIN_FIELDS = (serializers.IntegerField, serializers.CharField, serializers.BooleanField)
+
+
+class RowMapping:
+    """
+    Mapping from the values_list(*mapping.columns) rows of a queryset to the output of `serializer_class`.
+    Supports plain fields and nested single serializers of relations that are never null; any other field raises
+    TypeError. `kwargs` are passed to the serializer, e.g. the fields of a SparseFieldsMixin serializer.
+    """
+
+    def __init__(self, serializer_class, **kwargs):
+        self.columns = []
+        self.to_representation = self._compile(serializer_class(**kwargs), '')
+
+    def _compile(self, serializer, prefix):
+        """Return a function building the output of `serializer` from a row, adding the columns it reads."""
+        getters = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            path = prefix + '__'.join(field.source_attrs)
+            if isinstance(field, serializers.Serializer):
+                getters.append((name, self._compile(field, path + '__')))
+            elif isinstance(field, PLAIN_FIELDS):
+                self.columns.append(path)
+                getters.append((name, itemgetter(len(self.columns) - 1)))
+            else:
+                raise TypeError(f'{type(field).__name__} {name} cannot be read from a row')
+
+        def to_representation(row):
+            return {name: getter(row) for name, getter in getters}
+
+        return to_representation
+
+    def map(self, rows):
+        """Return the representations of `rows`, values_list() rows of self.columns."""
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
@@ -1,49 +1,60 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
-from library.models import Author, Genre, Book, Reservation, Borrow
+from library.models import Author, Genre, Book, Reservation, Borrow, Fine
+from library.sparse import SparseFieldsMixin
 
 User = get_user_model()
 
 
-class CustomUserSerializer(serializers.ModelSerializer):
+class CustomUserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'email']
 
 
-class AuthorSerializer(serializers.ModelSerializer):
+class AuthorSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
-    Serializer for Author model.
+    Serializer for Author model. The book count is only rendered on request and must be annotated.
     """
+    book_count = serializers.IntegerField(read_only=True)
+
     class Meta:
         model = Author
-        fields = ['id', 'full_name']
+        fields = ['id', 'full_name', 'book_count']
+        expandable_fields = ['book_count']
 
 
-class GenreSerializer(serializers.ModelSerializer):
+class GenreSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
-    Serializer for Genre model.
+    Serializer for Genre model. The book count is only rendered on request and must be annotated.
     """
+    book_count = serializers.IntegerField(read_only=True)
+
     class Meta:
         model = Genre
-        fields = ['id', 'name']
+        fields = ['id', 'name', 'book_count']
+        expandable_fields = ['book_count']
 
 
-class BookListSerializer(serializers.ModelSerializer):
+class BookListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
-    Serializer for Book model.
+    Serializer for Book model. The quantity and the counts are only rendered on request.
     """
     author = AuthorSerializer()
     genre = GenreSerializer()
 
     class Meta:
         model = Book
-        fields = ['id', 'title', 'author', 'genre', 'release_year']
+        fields = ['id', 'title', 'author', 'genre', 'release_year', 'quantity', 'currently_borrowed_count',
+                  'active_reservations_count', 'total_borrowed_count', 'borrow_count_last_year', 'available_copies',
+                  'is_available']
+        expandable_fields = ['quantity', 'currently_borrowed_count', 'active_reservations_count',
+                             'total_borrowed_count', 'borrow_count_last_year', 'available_copies', 'is_available']
 
 
-class BookSerializer(serializers.ModelSerializer):
+class BookSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
-    Serializer for Book model.
+    Serializer for Book model. The availability is only rendered on request.
     """
     author = AuthorSerializer()
     genre = GenreSerializer()
@@ -51,7 +62,9 @@ class BookSerializer(serializers.ModelSerializer):
     class Meta:
         model = Book
         fields = ['id', 'title', 'author', 'genre', 'release_year', 'quantity', 'currently_borrowed_count',
-                  'active_reservations_count', 'total_borrowed_count', 'borrow_count_last_year']
+                  'active_reservations_count', 'total_borrowed_count', 'borrow_count_last_year', 'available_copies',
+                  'is_available']
+        expandable_fields = ['available_copies', 'is_available']
 
 
 class ReservationSerializer(serializers.ModelSerializer):
@@ -63,7 +76,7 @@ class ReservationSerializer(serializers.ModelSerializer):
         fields = ['id']
 
 
-class BorrowSerializer(serializers.ModelSerializer):
+class BorrowSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for Borrow model
     """
@@ -74,6 +87,22 @@ class BorrowSerializer(serializers.ModelSerializer):
         fields = ['user', 'borrowed_at', 'returned_at']
 
 
+class FineSerializer(serializers.ModelSerializer):
+    """
+    Serializer for Fine model
+    """
+    balance = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Fine
+        fields = ['id', 'borrow', 'overdue_days', 'amount', 'paid', 'balance', 'updated_at', 'settled_at']
+
+
+class SettleFinesSerializer(serializers.Serializer):
+    """Serializer for the settle fines endpoint"""
+    user = serializers.IntegerField()
+
+
 class EmptySerializer(serializers.Serializer):
     """Empty serializer to be used for wish endpoints"""
     pass
@@ -86,3 +115,20 @@ class UserBookStatusSerializer(serializers.Serializer):
     has_wish = serializers.BooleanField()
     is_available = serializers.BooleanField()
     has_any_active_reservation = serializers.BooleanField()
+
+
+class BulkBorrowSerializer(serializers.Serializer):
+    """Serializer for the bulk borrow endpoints"""
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
+    days = serializers.IntegerField(required=False, min_value=1, max_value=365)
+
+
+class CirculationOperationSerializer(serializers.Serializer):
+    """A single (user, book) operation of the circulation desk"""
+    user = serializers.IntegerField()
+    book = serializers.IntegerField()
+
+
+class CirculationBatchSerializer(serializers.Serializer):
+    """Serializer for the circulation desk endpoints"""
+    operations = CirculationOperationSerializer(many=True, allow_empty=False, max_length=500)
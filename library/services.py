@@ -0,0 +1,244 @@
+"""
+Set-based circulation operations that act on many rows at once, for librarians processing batches.
+"""
+import logging
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.mail import send_mass_mail
+from django.db import DatabaseError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from library.models import Book, Borrow, CirculationEvent, Reservation
+from library.validators import validate_book_availability, validate_no_active_borrowing, \
+    validate_no_reservation_for_other_book
+from monitoring import metrics
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+
+def bulk_return_borrows(borrow_ids, returned_at=None):
+    """
+    Mark the unreturned borrows among `borrow_ids` as returned with a single UPDATE and queue one wisher
+    notification job for all affected books once the transaction commits. Returns the number of returned borrows.
+    """
+    from library.tasks import notify_wishers_of_books
+
+    returned_at = returned_at or timezone.now()
+    with transaction.atomic():
+        borrows = Borrow.objects.filter(pk__in=borrow_ids, returned_at__isnull=True)
+        user_book_ids = list(borrows.values_list('user_id', 'book_id'))
+        book_ids = sorted({book_id for _, book_id in user_book_ids})
+        count = borrows.update(returned_at=returned_at)
+        CirculationEvent.record_many(CirculationEvent.RETURNED, user_book_ids)
+        if book_ids:
+            transaction.on_commit(lambda: notify_wishers_of_books.delay(book_ids))
+    return count
+
+
+def bulk_extend_borrows(borrow_ids, days=None):
+    """
+    Push the due date of the unreturned borrows among `borrow_ids` back by `days` (BORROW_EXTENSION_DAYS by default)
+    with a single UPDATE. Returns the number of extended borrows.
+    """
+    days = days or settings.BORROW_EXTENSION_DAYS
+    with transaction.atomic():
+        borrows = Borrow.objects.filter(pk__in=borrow_ids, returned_at__isnull=True)
+        user_book_ids = list(borrows.values_list('user_id', 'book_id'))
+        count = borrows.update(due_date=F('due_date') + timedelta(days=days))
+        CirculationEvent.record_many(CirculationEvent.EXTENDED, user_book_ids)
+    metrics.CIRCULATION_EVENTS.inc(count, event='extended')
+    return count
+
+
+def notify_wishers(book_ids):
+    """
+    Email the wishers of every available book among `book_ids` and clear their wishes, recording them as unwished.
+    Availability of all books is computed in one query and all emails go out over a single connection.
+    """
+    books = Book.objects.filter(pk__in=book_ids, wished_by__isnull=False).distinct() \
+        .with_circulation_counts().prefetch_related('wished_by')
+    available = [book for book in books if book.is_available]
+    messages = [
+        ('Book Available Notification',
+         f'Dear {user.email}, \n\n'
+         f'The book "{book.title}" is now available. You can reserve or borrow it.\n\n'
+         'Thank you.',
+         settings.DEFAULT_FROM_EMAIL,
+         [user.email])
+        for book in available for user in book.wished_by.all()
+    ]
+    if messages:
+        send_mass_mail(messages, fail_silently=False)
+        # Clear only the wishes that were notified, wishes made meanwhile stay for the next return
+        wishers = {book.pk: [user.pk for user in book.wished_by.all()] for book in available}
+        with transaction.atomic():
+            Book.wished_by.through.objects.filter(reduce(or_, (
+                Q(book_id=book_id, customuser_id__in=user_ids) for book_id, user_ids in wishers.items()))).delete()
+            CirculationEvent.record_many(CirculationEvent.UNWISHED, [
+                (user_id, book_id) for book_id, user_ids in wishers.items() for user_id in user_ids])
+    return len(messages)
+
+
+class CirculationDesk:
+    """
+    Batch checkout, checkin and renewal of (user, book) pairs for the librarian circulation desk.
+
+    All state the business rules need is prefetched for the whole batch with a fixed number of queries and kept up
+    to date in memory while the items are validated, so validation costs no queries per item and an invalid item is
+    reported without affecting the others. The valid items are then written together with set-based statements.
+    Prefetching, validation and writing happen in one transaction that locks the batch's users and books (the
+    production SQLite profile takes the write lock when it begins), so a concurrent batch or borrow cannot invalidate
+    the prefetched state. If it fails with a database error, nothing is applied and every valid item reports it.
+    """
+
+    def __init__(self, operations):
+        self.operations = [(int(operation['user']), int(operation['book'])) for operation in operations]
+
+    def _load(self):
+        """Prefetch and lock the users and books of the batch, with their active borrows and reservations."""
+        user_ids = {user_id for user_id, _ in self.operations}
+        book_ids = {book_id for _, book_id in self.operations}
+        self.users = User.objects.select_for_update().in_bulk(user_ids)
+        self.books = Book.objects.with_circulation_counts().select_for_update().in_bulk(book_ids)
+        self.active_borrows = {
+            borrow.user_id: borrow
+            for borrow in Borrow.objects.filter(user_id__in=user_ids, returned_at__isnull=True)
+        }
+        self.reserved_book_ids = {}
+        for user_id, book_id in Reservation.objects.filter(user_id__in=user_ids, is_active=True) \
+                .values_list('user_id', 'book_id'):
+            self.reserved_book_ids.setdefault(user_id, set()).add(book_id)
+
+    def _run(self, plan, write, *fields):
+        """
+        Validate every operation with `plan`, which returns the borrow it affects, then pass the borrows of the valid
+        operations to `write`, which returns the (result, borrow) pairs it could not apply with an error message.
+        The results of applied operations report the borrow and its `fields`.
+        """
+        results = [{'user': user_id, 'book': book_id} for user_id, book_id in self.operations]
+        planned = []
+        try:
+            with transaction.atomic():
+                self._load()
+                for result in results:
+                    try:
+                        user, book = self.users.get(result['user']), self.books.get(result['book'])
+                        if user is None or book is None:
+                            raise ValidationError('Unknown user or book.')
+                        planned.append((result, plan(user, book)))
+                    except ValidationError as e:
+                        result.update(status='error', detail=e.messages)
+                skipped = write(planned) if planned else []
+        except DatabaseError:
+            logger.exception('Circulation desk batch of %d operations failed', len(self.operations))
+            for result in results:
+                if 'status' not in result:
+                    result.update(status='error', detail=['The batch could not be saved, nothing was applied.'])
+            return results
+        for result, message in skipped:
+            result.update(status='error', detail=[message])
+        for result, borrow in planned:
+            if 'status' not in result:
+                result.update(borrow=borrow.pk, **{field: getattr(borrow, field) for field in fields}, status='ok')
+        return results
+
+    @staticmethod
+    def _not_updated(planned, updated, changed, message):
+        """
+        Return the (result, message) pairs of the `planned` borrows a bulk update left alone, when it `updated` fewer
+        rows than planned; `changed` filters the borrows it did change.
+        """
+        if updated == len(planned):
+            return []
+        ids = [borrow.pk for _, borrow in planned]
+        applied = set(Borrow.objects.filter(changed, pk__in=ids).values_list('pk', flat=True))
+        return [(result, message) for result, borrow in planned if borrow.pk not in applied]
+
+    def _active_borrow(self, user, book):
+        borrow = self.active_borrows.get(user.pk)
+        if borrow is None or borrow.book_id != book.pk:
+            raise ValidationError('This user has no active borrowing of this book.')
+        return borrow
+
+    def checkout(self):
+        """Lend each book to its user, applying the same rules as Borrow.clean()."""
+        due_date = timezone.now() + timedelta(days=settings.BORROW_PERIOD_DAYS)
+        reserved = []
+
+        def plan(user, book):
+            reserved_book_ids = self.reserved_book_ids.get(user.pk, set())
+            validate_book_availability(book)
+            validate_no_active_borrowing(user, has_active_borrowing=user.pk in self.active_borrows)
+            validate_no_reservation_for_other_book(user, book, reserved_book_ids=reserved_book_ids)
+
+            borrow = self.active_borrows[user.pk] = Borrow(user=user, book=book, due_date=due_date)
+            book.num_currently_borrowed += 1
+            if book.pk in reserved_book_ids:
+                reserved_book_ids.discard(book.pk)
+                book.num_active_reservations -= 1
+                reserved.append(borrow)
+            return borrow
+
+        def write(planned):
+            # The statements Borrow.save() runs per borrow, once for the whole batch
+            borrows = [borrow for _, borrow in planned]
+            Borrow.objects.bulk_create(borrows)
+            if reserved:
+                Reservation.objects.filter(reduce(or_, (Q(user_id=borrow.user_id, book_id=borrow.book_id)
+                                                        for borrow in reserved)), is_active=True) \
+                    .update(is_active=False)
+            borrowed = Counter(borrow.book_id for borrow in borrows)
+            Book.objects.filter(pk__in=borrowed).update(popularity=F('popularity') + Case(
+                *[When(pk=book_id, then=Value(count)) for book_id, count in borrowed.items()]))
+            CirculationEvent.record_many(CirculationEvent.BORROWED,
+                                         [(borrow.user_id, borrow.book_id) for borrow in borrows])
+            return []
+
+        results = self._run(plan, write, 'due_date')
+        metrics.CIRCULATION_EVENTS.inc(sum(result['status'] == 'ok' for result in results), event='borrowed')
+        return results
+
+    def checkin(self):
+        """Return each user's borrowing of the given book and notify the wishers of all returned books at once."""
+        now = timezone.now()
+
+        def plan(user, book):
+            borrow = self._active_borrow(user, book)
+            borrow.returned_at = now
+            del self.active_borrows[user.pk]
+            book.num_currently_borrowed -= 1
+            return borrow
+
+        def write(planned):
+            count = bulk_return_borrows([borrow.pk for _, borrow in planned], now)
+            return self._not_updated(planned, count, Q(returned_at=now), 'This borrowing was already returned.')
+
+        return self._run(plan, write, 'returned_at')
+
+    def renew(self):
+        """Extend each user's borrowing of the given book by BORROW_EXTENSION_DAYS."""
+        renewed = set()
+
+        def plan(user, book):
+            borrow = self._active_borrow(user, book)
+            if borrow.pk in renewed:
+                raise ValidationError('This borrowing is already renewed in this batch.')
+            renewed.add(borrow.pk)
+            borrow.due_date += timedelta(days=settings.BORROW_EXTENSION_DAYS)
+            return borrow
+
+        def write(planned):
+            count = bulk_extend_borrows([borrow.pk for _, borrow in planned])
+            return self._not_updated(planned, count, Q(returned_at__isnull=True),
+                                     'This borrowing was returned before it could be renewed.')
+
+        return self._run(plan, write, 'due_date')
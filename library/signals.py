@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent once the transaction that recorded circulation events commits, with `events`, the CirculationEvent instances.
+# Receivers run in the committing process only, so state shared between processes must be updated through a
+# shared store, e.g. the cache.
+circulation_recorded = Signal()
@@ -0,0 +1,177 @@
+"""
+Columnar snapshots of the circulation data for analytics.
+
+A snapshot is a directory under ANALYTICS_SNAPSHOT_DIR with one .npy file per column of the Book, Borrow and Reservation
+tables, the current wishes and the wish events, e.g. `borrows.returned_at.npy`. Keys are integer-encoded: `borrows.book`
+is the row of the book in the `books.*` arrays and `books.author` / `books.genre` the row in `authors.id` / `genres.id`,
+whose names are in labels.json. Timestamps are datetime64[s] in UTC with NaT for missing values. Files are loaded
+memory-mapped, so analytics read them without copying or touching the database.
+Snapshots are written to a temporary directory and renamed into place, and the CURRENT file names the latest one,
+so readers never see a partial snapshot.
+"""
+import itertools
+import json
+import os
+import shutil
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.utils import timezone
+
+from library.models import Author, Genre, Book, Borrow, Reservation, CirculationEvent
+
+CHUNK_SIZE = 10000
+
+# Table name -> (queryset, column -> (field, dtype)). Ids of books, authors and genres are replaced by int32 row
+# numbers in their arrays after reading.
+TABLES = {
+    'books': (Book.objects.all(), {
+        'id': ('id', np.int64),
+        'author': ('author_id', np.int64),
+        'genre': ('genre_id', np.int64),
+        'release_year': ('release_year', np.int32),
+        'quantity': ('quantity', np.int32),
+    }),
+    'borrows': (Borrow.objects.all(), {
+        'user_id': ('user_id', np.int64),
+        'book': ('book_id', np.int64),
+        'borrowed_at': ('borrowed_at', 'datetime64[s]'),
+        'due_date': ('due_date', 'datetime64[s]'),
+        'returned_at': ('returned_at', 'datetime64[s]'),
+    }),
+    'reservations': (Reservation.objects.all(), {
+        'user_id': ('user_id', np.int64),
+        'book': ('book_id', np.int64),
+        'reserved_at': ('reserved_at', 'datetime64[s]'),
+        'expires_at': ('expires_at', 'datetime64[s]'),
+        'is_active': ('is_active', np.bool_),
+    }),
+    'wishes': (Book.wished_by.through.objects.all(), {
+        'user_id': ('customuser_id', np.int64),
+        'book': ('book_id', np.int64),
+    }),
+    'wish_events': (CirculationEvent.objects.filter(kind=CirculationEvent.WISHED), {
+        'user_id': ('user_id', np.int64),
+        'book': ('book_id', np.int64),
+        'occurred_at': ('occurred_at', 'datetime64[s]'),
+    }),
+}
+
+
+class SnapshotNotFound(Exception):
+    pass
+
+
+class Snapshot:
+    """A snapshot's columns, loaded memory-mapped on first access as snapshot.borrows['returned_at']."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.meta = json.loads((self.path / 'meta.json').read_text())
+        self.labels = json.loads((self.path / 'labels.json').read_text())
+        self._tables = {}
+
+    def __getattr__(self, table):
+        if table not in TABLES and table not in ('authors', 'genres'):
+            raise AttributeError(table)
+        if table not in self._tables:
+            self._tables[table] = {
+                file.name.split('.')[1]: np.load(file, mmap_mode='r')
+                for file in self.path.glob(f'{table}.*.npy')
+            }
+        return self._tables[table]
+
+    @property
+    def created_at(self):
+        return np.datetime64(self.meta['created_at'], 's')
+
+
+def _column_arrays(queryset, columns):
+    """Read `columns` (name -> (field, dtype)) of `queryset` in chunks into one array per column."""
+    names = list(columns)
+    rows = queryset.order_by('pk').values_list(*[field for field, _ in columns.values()]).iterator(CHUNK_SIZE)
+    chunks = {name: [] for name in names}
+    while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+        for name, values in zip(names, zip(*chunk)):
+            dtype = columns[name][1]
+            if dtype == 'datetime64[s]':
+                chunks[name].append(pd.to_datetime(list(values), utc=True).tz_localize(None).to_numpy(dtype))
+            else:
+                chunks[name].append(np.asarray(values, dtype=dtype))
+    return {name: np.concatenate(parts) if parts else np.empty(0, dtype=columns[name][1])
+            for name, parts in chunks.items()}
+
+
+def export_snapshot(directory=None, keep=None):
+    """
+    Write a snapshot of the circulation data to `directory` (ANALYTICS_SNAPSHOT_DIR by default), make it the current
+    one and delete all but the `keep` newest snapshots. Returns the snapshot's path.
+    """
+    directory = Path(directory or settings.ANALYTICS_SNAPSHOT_DIR)
+    keep = keep or settings.ANALYTICS_SNAPSHOTS_KEPT
+    name = timezone.now().strftime('%Y%m%dT%H%M%S%f')
+    path = directory / name
+    partial = directory / f'.{name}.partial'
+    partial.mkdir(parents=True)
+
+    try:
+        tables = {table: _column_arrays(queryset, columns) for table, (queryset, columns) in TABLES.items()}
+        # Read after the books, so every book's author and genre is known
+        labels = {
+            'authors': dict(Author.objects.order_by('pk').values_list('pk', 'full_name')),
+            'genres': dict(Genre.objects.order_by('pk').values_list('pk', 'name')),
+        }
+        author_ids = np.fromiter(labels['authors'], dtype=np.int64, count=len(labels['authors']))
+        genre_ids = np.fromiter(labels['genres'], dtype=np.int64, count=len(labels['genres']))
+        books = tables['books']
+        # Replace ids by row numbers, the keys the analytics index arrays with
+        books['author'] = np.searchsorted(author_ids, books['author']).astype(np.int32)
+        books['genre'] = np.searchsorted(genre_ids, books['genre']).astype(np.int32)
+        for table in ('borrows', 'reservations', 'wishes', 'wish_events'):
+            # Tables are read one after another, so skip rows of books added since the books were read
+            rows = np.minimum(np.searchsorted(books['id'], tables[table]['book']), max(len(books['id']) - 1, 0))
+            known = books['id'][rows] == tables[table]['book'] if len(books['id']) else rows < 0
+            tables[table] = {column: values[known] for column, values in tables[table].items()}
+            tables[table]['book'] = rows[known].astype(np.int32)
+        tables['authors'] = {'id': author_ids}
+        tables['genres'] = {'id': genre_ids}
+
+        for table, columns in tables.items():
+            for column, values in columns.items():
+                np.save(partial / f'{table}.{column}.npy', values)
+        (partial / 'labels.json').write_text(json.dumps({key: list(value.values()) for key, value in labels.items()}))
+        (partial / 'meta.json').write_text(json.dumps({
+            # The next full second after reading, so every exported timestamp lies before it
+            'created_at': (timezone.now() + timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S'),
+            'rows': {table: len(next(iter(columns.values()))) for table, columns in tables.items()},
+        }))
+        os.replace(partial, path)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    current = directory / '.CURRENT.partial'
+    current.write_text(name)
+    os.replace(current, directory / 'CURRENT')
+    for old in sorted(p for p in directory.iterdir() if p.is_dir() and not p.name.startswith('.'))[:-keep]:
+        shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+_loaded = {}
+
+
+def load_snapshot(directory=None):
+    """Return the current snapshot in `directory` (ANALYTICS_SNAPSHOT_DIR by default), loaded once per process."""
+    directory = Path(directory or settings.ANALYTICS_SNAPSHOT_DIR)
+    try:
+        name = (directory / 'CURRENT').read_text().strip()
+    except FileNotFoundError:
+        raise SnapshotNotFound(f'No snapshot in {directory}, run `python manage.py export_snapshot`')
+    path = directory / name
+    if _loaded.get('path') != path:
+        _loaded.update(path=path, snapshot=Snapshot(path))
+    return _loaded['snapshot']
@@ -0,0 +1,92 @@
+"""
+Sparse fieldsets and on-demand expansion for read endpoints.
+
+`?fields=id,title` renders only the listed fields and `?expand=available_copies` adds the optional fields a serializer
+leaves out by default (its Meta.expandable_fields). Views select only the columns and compute only the aggregates
+behind the fields they render, so narrow clients do not pay for fields they never read.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def query_list(request, name):
+    """Return the values of the comma separated query parameter `name`, e.g. ['id', 'title'] for ?fields=id,title."""
+    return [value.strip() for value in request.query_params.get(name, '').split(',') if value.strip()]
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin rendering only the fields listed in `fields` and the expandable fields listed in `expand`.
+    Without `fields` all fields of Meta.fields are rendered except the Meta.expandable_fields not listed in `expand`.
+    """
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selected_fields = self.select_fields(fields, expand)
+
+    @classmethod
+    def select_fields(cls, fields=None, expand=None):
+        """Return the names of the fields rendered for `fields` and `expand`, in Meta.fields order."""
+        declared = list(cls.Meta.fields)
+        expandable = getattr(cls.Meta, 'expandable_fields', [])
+        errors = {}
+        for param, names in (('fields', fields), ('expand', expand)):
+            unknown = [name for name in names or [] if name not in declared]
+            if unknown:
+                errors[param] = [f'Unknown field: {name}' for name in unknown]
+        if errors:
+            raise serializers.ValidationError(errors)
+        requested = set(fields or []) | set(expand or [])
+        if fields:
+            return [name for name in declared if name in requested]
+        return [name for name in declared if name not in expandable or name in requested]
+
+    def get_fields(self):
+        fields = super().get_fields()
+        return {name: field for name, field in fields.items() if name in self.selected_fields}
+
+
+class SparseFieldsViewMixin:
+    """
+    View mixin passing the ?fields= and ?expand= query parameters of safe requests to SparseFieldsMixin serializers.
+    """
+
+    def sparse_kwargs(self):
+        """Return the fields and expand arguments of the request's serializers."""
+        if self.request.method not in SAFE_METHODS:
+            return {}
+        return {'fields': query_list(self.request, 'fields'), 'expand': query_list(self.request, 'expand')}
+
+    def sparse_field_names(self, serializer_class=None):
+        """Return the names of the fields `serializer_class` (the view's serializer by default) renders."""
+        serializer_class = serializer_class or self.get_serializer_class()
+        return serializer_class.select_fields(**self.sparse_kwargs())
+
+    def get_serializer(self, *args, **kwargs):
+        if issubclass(self.get_serializer_class(), SparseFieldsMixin):
+            kwargs = {**self.sparse_kwargs(), **kwargs}
+        return super().get_serializer(*args, **kwargs)
+
+
+def only_fields(queryset, names, *required):
+    """
+    Restrict `queryset` to the columns of the model fields among `names` and the `required` columns, joining the
+    relations among them. Names that are not concrete model fields, e.g. properties, are skipped.
+    """
+    opts = queryset.model._meta
+    columns = list(required)
+    relations = []
+    for name in names:
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if not field.concrete or field.many_to_many:
+            continue
+        columns.append(name)
+        if field.is_relation:
+            relations.append(name)
+    if relations:
+        queryset = queryset.select_related(*relations)
+    return queryset.only(*columns) if columns else queryset.only(opts.pk.name)
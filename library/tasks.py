@@ -1,16 +1,30 @@
 from celery import shared_task
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
+from django.db import transaction
 
-from library.models import Reservation, Borrow
+from library.archive import analyze
+from library.events import consume, registered_consumers
+from library.fines import accrue_fines
+from library.recommendations import rebuild_neighbours
+from library.snapshot import export_snapshot
+from library.models import Reservation, Borrow, Book, CirculationEvent, ArchivedBorrow, ArchivedReservation
+from library.services import notify_wishers
 from django.utils import timezone
+from monitoring import metrics
 
 
 @shared_task
 def cancel_expired_reservations():
     now = timezone.now()
-    expired_reservations = Reservation.objects.filter(expires_at__lte=now, is_active=True)
-    count = expired_reservations.update(is_active=False)
+    with transaction.atomic():
+        expired = list(Reservation.objects.filter(expires_at__lte=now, is_active=True)
+                       .values_list('id', 'user_id', 'book_id'))
+        count = Reservation.objects.filter(id__in=[reservation_id for reservation_id, _, _ in expired]) \
+            .update(is_active=False)
+        CirculationEvent.record_many(CirculationEvent.EXPIRED, [(user_id, book_id) for _, user_id, book_id in expired])
+    metrics.CIRCULATION_EVENTS.inc(count, event='reservation_expired')
     return count
 
 
@@ -26,3 +40,44 @@ def send_overdue_notifications():
             settings.DEFAULT_FROM_EMAIL,
             [borrow.user.email],
         )
+
+
+@shared_task
+def notify_wishers_of_books(book_ids):
+    return notify_wishers(book_ids)
+
+
+@shared_task
+def relay_circulation_events(batch_size=500):
+    """Drain the circulation event log into every consumer in CIRCULATION_EVENT_CONSUMERS, in order."""
+    return {name: consume(name, handler, batch_size) for name, handler in registered_consumers().items()}
+
+
+@shared_task
+def refresh_book_popularity():
+    """Recount the popularity of all books, correcting drift from deleted borrows."""
+    return Book.objects.refresh_popularity()
+
+
+@shared_task
+def rebuild_book_neighbours():
+    """Recompute the similar books of all books from the borrow history."""
+    return rebuild_neighbours()
+
+
+@shared_task
+def export_analytics_snapshot():
+    """Write a columnar snapshot of the circulation data for the analytics API."""
+    return str(export_snapshot())
+
+
+@shared_task
+def accrue_overdue_fines():
+    """Bring the fines of all overdue borrows up to date."""
+    return accrue_fines()
+
+
+@shared_task
+def refresh_table_statistics():
+    """Refresh the planner statistics the estimated row counts of the admin lists are read from."""
+    analyze(Borrow, Reservation, ArchivedBorrow, ArchivedReservation, get_user_model())
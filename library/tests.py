@@ -1,3 +1,1281 @@
-from django.test import TestCase
+import asyncio
+import difflib
+import json
+import os
+import tempfile
+import threading
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Count, F
+from django.conf import settings
+from django.core import mail
+from django.core.cache import caches
+from django.contrib.auth import get_user_model
+from django.db.utils import ConnectionHandler
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from django.utils import timezone
+
+from library import live
+from library.admin import BookAdmin
+from library.archive import analyze, archive_borrows, archive_cutoff, archive_reservations
+from library.benchmarks import ENDPOINTS, Endpoint, generate_dataset
+from library.models import ArchivedBorrow, ArchivedReservation, Author, Book, BookArchiveSummary, BookNeighbour, \
+    Borrow, CirculationEvent, Fine, Genre, Reservation, UserArchiveSummary
+from library import analytics, fines, snapshot, tasks
+from library.paginators import EstimatedCountPaginator, estimate_table_rows
+from library.recommendations import patch_neighbours, rebuild_neighbours, top_neighbours
+from library.renderers import FastJSONRenderer
+from library.rows import RowMapping
+from library.serializers import AuthorSerializer, BookListSerializer
+from library.replicas import PrimaryPinMiddleware, ReplicaRouter, is_pinned_to_primary, replica_reads
+from library.events import consume, lag
+from library.services import CirculationDesk, bulk_extend_borrows, bulk_return_borrows, notify_wishers
+from library.throttling import LocalBucketStore, take_token
+from monitoring.sql import query_shape
+
+User = get_user_model()
+
+ADMIN_ENDPOINTS = [
+    Endpoint('admin-book-changelist', 'get', lambda d: reverse('admin:library_book_changelist'), staff=True),
+    Endpoint('admin-borrow-changelist', 'get', lambda d: reverse('admin:library_borrow_changelist'), staff=True),
+    Endpoint('admin-reservation-changelist', 'get', lambda d: reverse('admin:library_reservation_changelist'),
+             staff=True),
+]
+
+
+@override_settings(DATABASE_REPLICAS=[])  # Count every query on the one test connection
+class QueryBudgetTests(TestCase):
+    """
+    Pin the maximum number of SQL queries of every endpoint, independent of the amount of data. Each endpoint is called
+    against a small dataset, the dataset is grown a hundredfold and the endpoint is called again: a different query
+    count means per-row queries crept in.
+    """
+    small_size = 10
+    large_size = 1000
+    endpoints = {endpoint.name: endpoint for endpoint in ENDPOINTS + ADMIN_ENDPOINTS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(cls.small_size)
+        cls.dataset.librarian.is_superuser = True
+        cls.dataset.librarian.save(update_fields=['is_superuser'])
+
+    def capture(self, endpoint):
+        self.client.force_login(self.dataset.librarian if endpoint.staff else self.dataset.reader)
+        if endpoint.reset:
+            endpoint.reset(self.dataset)
+        params = endpoint.params(self.dataset) if endpoint.params else None
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, endpoint.method)(endpoint.url(self.dataset), params)
+        self.assertLess(response.status_code, 400, f'{endpoint.name} failed with {response.status_code}')
+        return [query_shape(query['sql']) for query in queries]
+
+    def assertQueryBudget(self, name, budget):
+        endpoint = self.endpoints[name]
+        small = self.capture(endpoint)
+        generate_dataset(self.large_size - self.small_size, seed=1, prefix='grown-')
+        large = self.capture(endpoint)
+
+        diff = '\n'.join(difflib.unified_diff(small, large, f'{self.small_size} rows', f'{self.large_size} rows',
+                                              lineterm=''))
+        self.assertEqual(len(small), len(large),
+                         f'{name} runs {len(small)} queries at {self.small_size} rows but {len(large)} at '
+                         f'{self.large_size} rows:\n{diff}')
+        self.assertLessEqual(len(large), budget,
+                             f'{name} runs {len(large)} queries, budget is {budget}:\n' + '\n'.join(large))
+
+    def test_book_list(self):
+        self.assertQueryBudget('book-list', 4)
+
+    def test_book_search(self):
+        self.assertQueryBudget('book-search', 4)
+
+    def test_book_ordering(self):
+        self.assertQueryBudget('book-ordering', 4)
+
+    def test_book_detail(self):
+        self.assertQueryBudget('book-detail', 3)
+
+    def test_book_similar(self):
+        self.assertQueryBudget('book-similar', 3)
+
+    def test_book_borrow_history(self):
+        self.assertQueryBudget('book-borrow-history', 4)
+
+    def test_book_reserve(self):
+        self.assertQueryBudget('book-reserve', 11)
+
+    def test_book_cancel_reservation(self):
+        self.assertQueryBudget('book-cancel-reservation', 17)
+
+    def test_book_wish(self):
+        self.assertQueryBudget('book-wish', 9)
+
+    def test_book_remove_wish(self):
+        self.assertQueryBudget('book-remove-wish', 8)
+
+    def test_user_book_status(self):
+        self.assertQueryBudget('user-book-status', 9)
+
+    def test_author_list(self):
+        self.assertQueryBudget('author-list', 4)
+
+    def test_genre_list(self):
+        self.assertQueryBudget('genre-list', 4)
+
+    def test_fine_mine(self):
+        self.assertQueryBudget('fine-mine', 3)
+
+    def test_fine_balances(self):
+        self.assertQueryBudget('fine-balances', 3)
+
+    def test_statistics_popular_books(self):
+        self.assertQueryBudget('statistics-popular-books', 3)
+
+    def test_statistics_late_returns(self):
+        self.assertQueryBudget('statistics-late-returns', 3)
+
+    def test_statistics_late_returning_users(self):
+        self.assertQueryBudget('statistics-late-returning-users', 3)
+
+    def test_admin_book_changelist(self):
+        self.assertQueryBudget('admin-book-changelist', 7)
+
+    def test_admin_borrow_changelist(self):
+        self.assertQueryBudget('admin-borrow-changelist', 8)
+
+    def test_admin_reservation_changelist(self):
+        self.assertQueryBudget('admin-reservation-changelist', 8)
+
+
+class AvailabilityStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(10)
+
+    async def next_event(self, chunks):
+        chunk = await asyncio.wait_for(anext(chunks), 5)
+        return json.loads(chunk.decode().split('data: ')[1])
+
+    def borrow(self, *users):
+        with self.captureOnCommitCallbacks(execute=True):
+            for user in users:
+                Borrow.objects.create(user=user, book=self.dataset.available_book)
+
+    async def test_stream_sends_current_and_coalesced_availability(self):
+        await self.async_client.aforce_login(self.dataset.reader)
+        book = self.dataset.available_book
+        response = await self.async_client.get(reverse('availability_stream'), {'books': book.pk})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        await anext(chunks)  # Reconnection delay
+        initial = await self.next_event(chunks)
+        self.assertEqual(initial['book'], book.pk)
+
+        await sync_to_async(self.borrow)(self.dataset.reader, self.dataset.librarian)
+        changed = await self.next_event(chunks)
+        self.assertEqual(changed['available_copies'], initial['available_copies'] - 2)
+        self.assertEqual(len(live.bus.subscriptions), 1)
+
+    async def test_stream_requires_authentication_and_books(self):
+        response = await self.async_client.get(reverse('availability_stream'), {'books': '1'})
+        self.assertEqual(response.status_code, 401)
+        await self.async_client.aforce_login(self.dataset.reader)
+        response = await self.async_client.get(reverse('availability_stream'), {'books': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def tearDown(self):
+        for subscription in list(live.bus.subscriptions):
+            live.bus.unsubscribe(subscription)
+
+
+class BorrowHistoryAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(10)
+        cls.book = Borrow.objects.values('book').annotate(borrows=Count('id')).order_by('-borrows')[0]['book']
+
+    def get(self, **params):
+        self.client.force_login(self.dataset.librarian)
+        response = self.client.get(reverse('admin:borrow_history', args=[self.book]), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_invalid_cursors_show_the_first_page(self):
+        first = self.get()
+        for cursor in ('2024-13-45T00:00:00|5', 'garbage', '2024-01-01T00:00:00+00:00|x'):
+            with self.subTest(cursor=cursor):
+                response = self.get(after=cursor)
+                self.assertEqual(list(response.context['borrows']), list(first.context['borrows']))
+                self.assertTrue(response.context['is_first_page'])
+
+    def test_cursor_continues_after_the_last_row_shown(self):
+        borrows = list(Borrow.objects.filter(book=self.book).order_by('-borrowed_at', '-id'))
+        cursor = f'{borrows[0].borrowed_at.isoformat()}|{borrows[0].pk}'
+        response = self.get(after=cursor)
+        self.assertGreater(len(borrows), 1)
+        self.assertEqual(list(response.context['borrows']), borrows[1:])
+        self.assertFalse(response.context['is_first_page'])
+
+
+class EstimatedCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(100)
+        # Leave a few rows spread over the whole primary key range, as archiving does
+        ids = list(Borrow.objects.order_by('id').values_list('id', flat=True))
+        Borrow.objects.exclude(id__in=ids[::10] + ids[-1:]).delete()
+        cls.count = Borrow.objects.count()
+
+    def paginator(self, limit):
+        paginator = EstimatedCountPaginator(Borrow.objects.order_by('id'), 10)
+        paginator.exact_count_limit = limit
+        return paginator
+
+    def test_small_tables_are_counted_despite_gaps_in_the_primary_key(self):
+        self.assertEqual(self.paginator(self.count).count, self.count)
+
+    def test_big_tables_fall_back_to_the_primary_key_range(self):
+        self.assertGreater(self.paginator(self.count - 1).count, self.count)
+
+    def test_analyze_refreshes_the_estimate(self):
+        analyze(Borrow)
+        self.assertEqual(estimate_table_rows(Borrow), self.count)
+
+    def test_estimates_from_before_a_deletion_are_ignored(self):
+        analyze(Borrow)
+        kept = list(Borrow.objects.order_by('id').values_list('id', flat=True)[:2])
+        Borrow.objects.exclude(id__in=kept).delete()
+
+        self.assertEqual(estimate_table_rows(Borrow, exact_below=self.count), 2)
+
+    def test_statistics_are_refreshed_nightly(self):
+        Borrow.objects.filter(id__in=list(Borrow.objects.values_list('id', flat=True)[:3])).delete()
+
+        tasks.refresh_table_statistics()
+
+        self.assertEqual(estimate_table_rows(Borrow), self.count - 3)
+
+
+class BulkCirculationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(10)
+        reopened = Borrow.objects.filter(returned_at__isnull=False).order_by('id').values_list('id', flat=True)[:2]
+        Borrow.objects.filter(id__in=list(reopened)).update(returned_at=None)
+        cls.out = list(Borrow.objects.filter(returned_at__isnull=True).order_by('id'))
+        cls.returned = Borrow.objects.filter(returned_at__isnull=False).first()
+
+    def events(self, kind):
+        return set(CirculationEvent.objects.filter(kind=kind).values_list('user_id', 'book_id'))
+
+    def test_return_closes_only_unreturned_borrows_and_notifies_wishers_once(self):
+        returned_at = self.returned.returned_at
+        with mock.patch('library.tasks.notify_wishers_of_books.delay') as notify, \
+                self.captureOnCommitCallbacks(execute=True):
+            count = bulk_return_borrows([borrow.pk for borrow in self.out] + [self.returned.pk])
+        self.assertEqual(count, 3)
+        self.assertFalse(Borrow.objects.filter(pk__in=[borrow.pk for borrow in self.out], returned_at__isnull=True)
+                         .exists())
+        self.returned.refresh_from_db()
+        self.assertEqual(self.returned.returned_at, returned_at)
+        self.assertEqual(self.events(CirculationEvent.RETURNED), {(b.user_id, b.book_id) for b in self.out})
+        notify.assert_called_once_with(sorted({borrow.book_id for borrow in self.out}))
+
+    def test_extend_pushes_back_the_due_date_of_unreturned_borrows(self):
+        due_date = self.returned.due_date
+        self.assertEqual(bulk_extend_borrows([borrow.pk for borrow in self.out] + [self.returned.pk], days=7), 3)
+        for borrow in self.out:
+            self.assertEqual(Borrow.objects.get(pk=borrow.pk).due_date, borrow.due_date + timedelta(days=7))
+        self.returned.refresh_from_db()
+        self.assertEqual(self.returned.due_date, due_date)
+        self.assertEqual(self.events(CirculationEvent.EXTENDED), {(b.user_id, b.book_id) for b in self.out})
+
+    def test_nothing_to_return_queues_no_notification(self):
+        with mock.patch('library.tasks.notify_wishers_of_books.delay') as notify, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(bulk_return_borrows([self.returned.pk]), 0)
+        notify.assert_not_called()
+
+
+class CirculationDeskTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(10)
+        cls.book = cls.dataset.available_book
+        cls.readers = [User.objects.create_user(email=f'desk{i}@example.com', personal_id_number=f'D{i}',
+                                                birth_date='1990-01-01') for i in range(3)]
+        Reservation.objects.create(user=cls.readers[0], book=cls.book, expires_at=timezone.now() + timedelta(days=1))
+
+    def post(self, operation, pairs, user=None):
+        self.client.force_login(user or self.dataset.librarian)
+        with mock.patch('library.tasks.notify_wishers_of_books.delay'), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse(f'circulation-{operation}'),
+                                        {'operations': [{'user': u.pk, 'book': b.pk} for u, b in pairs]},
+                                        content_type='application/json')
+        return response
+
+    def statuses(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [result['status'] for result in response.json()['results']]
+
+    def test_checkout_applies_valid_items_and_reports_invalid_ones(self):
+        popularity = Book.objects.get(pk=self.book.pk).popularity
+        response = self.post('checkout', [(self.readers[0], self.book), (self.readers[1], self.book),
+                                          (self.readers[1], self.book),
+                                          (self.readers[2], self.dataset.unavailable_book)])
+        self.assertEqual(self.statuses(response), ['ok', 'ok', 'error', 'error'])
+        borrows = Borrow.objects.filter(user__in=self.readers, returned_at__isnull=True)
+        self.assertEqual({borrow.pk for borrow in borrows}, {result.get('borrow') for result in
+                                                             response.json()['results'][:2]})
+        self.assertFalse(Reservation.objects.filter(user=self.readers[0], is_active=True).exists())
+        self.assertEqual(Book.objects.get(pk=self.book.pk).popularity, popularity + 2)
+        self.assertEqual(CirculationEvent.objects.filter(kind=CirculationEvent.BORROWED).count(), 2)
+
+    def test_renew_and_checkin_act_on_active_borrows(self):
+        self.post('checkout', [(self.readers[0], self.book)])
+        borrow = Borrow.objects.get(user=self.readers[0], returned_at__isnull=True)
+
+        response = self.post('renew', [(self.readers[0], self.book), (self.readers[0], self.book),
+                                       (self.readers[1], self.book)])
+        self.assertEqual(self.statuses(response), ['ok', 'error', 'error'])
+        self.assertEqual(Borrow.objects.get(pk=borrow.pk).due_date,
+                         borrow.due_date + timedelta(days=settings.BORROW_EXTENSION_DAYS))
+
+        response = self.post('checkin', [(self.readers[0], self.book), (self.readers[0], self.book)])
+        self.assertEqual(self.statuses(response), ['ok', 'error'])
+        self.assertIsNotNone(Borrow.objects.get(pk=borrow.pk).returned_at)
+        self.assertEqual(CirculationEvent.objects.filter(kind=CirculationEvent.RETURNED).count(), 1)
+
+    def test_database_errors_fail_the_whole_batch(self):
+        with mock.patch.object(Borrow.objects, 'bulk_create', side_effect=DatabaseError('disk full')), \
+                self.assertLogs('library.services', 'ERROR'):
+            response = self.post('checkout', [(self.readers[1], self.book), (self.readers[2], self.book)])
+        self.assertEqual(self.statuses(response), ['error', 'error'])
+        self.assertFalse(Borrow.objects.filter(user__in=self.readers).exists())
+
+    def test_only_librarians_use_the_desk(self):
+        response = self.post('checkout', [(self.readers[1], self.book)], user=self.dataset.reader)
+        self.assertEqual(response.status_code, 403)
+
+    def test_batch_state_is_read_in_the_writing_transaction(self):
+        depths = []
+        load = CirculationDesk._load
+
+        def recording_load(desk):
+            depths.append(len(connection.savepoint_ids))
+            return load(desk)
+
+        with mock.patch.object(CirculationDesk, '_load', recording_load):
+            self.post('checkout', [(self.readers[1], self.book)])
+        outside = len(connection.savepoint_ids)
+
+        # One level deeper than the test: the prefetch runs in the transaction that writes the batch
+        self.assertEqual(depths, [outside + 1])
+
+    def test_checkin_reports_borrows_returned_concurrently(self):
+        self.post('checkout', [(self.readers[1], self.book), (self.readers[2], self.book)])
+        raced = Borrow.objects.get(user=self.readers[1], returned_at__isnull=True)
+
+        def racing_return(borrow_ids, returned_at=None):
+            # Another request returns the first borrow after the desk read it as active
+            Borrow.objects.filter(pk=raced.pk).update(returned_at=timezone.now() - timedelta(minutes=1))
+            return bulk_return_borrows(borrow_ids, returned_at)
+
+        with mock.patch('library.services.bulk_return_borrows', racing_return):
+            response = self.post('checkin', [(self.readers[1], self.book), (self.readers[2], self.book)])
+
+        self.assertEqual(self.statuses(response), ['error', 'ok'])
+        self.assertEqual(response.json()['results'][0]['detail'], ['This borrowing was already returned.'])
+
+    def test_renew_reports_borrows_returned_concurrently(self):
+        self.post('checkout', [(self.readers[1], self.book), (self.readers[2], self.book)])
+        raced = Borrow.objects.get(user=self.readers[2], returned_at__isnull=True)
+
+        def racing_extend(borrow_ids, days=None):
+            Borrow.objects.filter(pk=raced.pk).update(returned_at=timezone.now())
+            return bulk_extend_borrows(borrow_ids, days)
+
+        with mock.patch('library.services.bulk_extend_borrows', racing_extend):
+            response = self.post('renew', [(self.readers[1], self.book), (self.readers[2], self.book)])
+
+        self.assertEqual(self.statuses(response), ['ok', 'error'])
+
+
+class SQLiteProductionProfileTests(SimpleTestCase):
+    alias = 'sqlite-production'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = {**settings.SQLITE_PRODUCTION_DATABASE, 'NAME': os.path.join(directory.name, 'db.sqlite3'),
+                    'CONN_MAX_AGE': 0}
+        self.handler = ConnectionHandler({'default': database, self.alias: database})
+        self.execute('CREATE TABLE counter (value INTEGER)', 'INSERT INTO counter VALUES (0)')
+
+    def execute(self, *statements):
+        connection = self.handler.create_connection(self.alias)
+        try:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+                return cursor.fetchone()
+        finally:
+            connection.close()
+
+    def test_pragmas_are_applied_to_every_connection(self):
+        self.assertEqual(self.execute('PRAGMA journal_mode'), ('wal',))
+        self.assertEqual(self.execute('PRAGMA busy_timeout'), (5000,))
+
+    def test_concurrent_read_then_write_transactions_serialize(self):
+        errors = []
+
+        def increment():
+            # transaction.atomic() looks the alias up in this thread's connections
+            connections[self.alias] = connection = self.handler.create_connection(self.alias)
+            try:
+                for _ in range(20):
+                    # Deferred transactions reading first fail with "database is locked" when another one writes
+                    with transaction.atomic(using=self.alias), connection.cursor() as cursor:
+                        cursor.execute('SELECT value FROM counter')
+                        value = cursor.fetchone()[0]
+                        cursor.execute('UPDATE counter SET value = %s', [value + 1])
+            except DatabaseError as error:
+                errors.append(error)
+            finally:
+                connection.close()
+                del connections[self.alias]
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.execute('SELECT value FROM counter'), (80,))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(10)
+
+    def test_only_reads_inside_replica_reads_go_to_a_replica(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Book), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Book), 'replica')
+            self.assertEqual(router.db_for_write(Book), 'default')
+            self.assertEqual(router.db_for_read(caches['shared'].cache_model_class), 'default')
+
+    def test_successful_unsafe_requests_pin_the_user(self):
+        def request(method, status):
+            request = getattr(RequestFactory(), method)('/')
+            request.user = self.dataset.reader
+            PrimaryPinMiddleware(lambda request: HttpResponse(status=status))(request)
+            return is_pinned_to_primary(self.dataset.reader)
+
+        self.assertFalse(request('get', 200))
+        self.assertFalse(request('post', 400))
+        self.assertTrue(request('post', 201))
+
+    def test_writes_through_the_admin_pin_the_user(self):
+        User.objects.filter(pk=self.dataset.librarian.pk).update(is_superuser=True)
+        self.client.force_login(self.dataset.librarian)
+        response = self.client.post(reverse('admin:library_genre_add'), {'name': 'Poetry'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(is_pinned_to_primary(self.dataset.librarian))
+
+    def test_pinned_users_read_from_the_primary(self):
+        self.client.force_login(self.dataset.reader)
+        with mock.patch('library.replicas.random.choice', return_value='default') as choice:
+            self.client.get(reverse('book-list'))
+            replica_reads_made = choice.call_count
+            self.assertGreater(replica_reads_made, 0)
+            self.assertEqual(self.client.post(reverse('book-wish', args=[self.dataset.unavailable_book.pk]))
+                             .status_code, 200)
+            self.client.get(reverse('book-list'))
+            self.assertEqual(choice.call_count, replica_reads_made)
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(20)
+        Reservation.objects.filter(id__in=Reservation.objects.filter(is_active=False).values('id')[:5]) \
+            .update(reserved_at=timezone.now() - timedelta(days=400))
+        cls.before = archive_cutoff(365)
+
+    def closed_borrows(self):
+        closed = Borrow.objects.filter(returned_at__lt=self.before).exclude(fine__amount__gt=F('fine__paid'))
+        return {borrow['id']: borrow for borrow in closed.values()}
+
+    def late_counts(self):
+        return Counter(Borrow.objects.filter(returned_at__gt=F('due_date')).values_list('user', flat=True)) \
+            + Counter(dict(UserArchiveSummary.objects.values_list('user', 'late_return_count')))
+
+    def borrow_counts(self):
+        return Counter(Borrow.objects.values_list('book', flat=True)) \
+            + Counter(dict(BookArchiveSummary.objects.values_list('book', 'borrow_count')))
+
+    def test_closed_borrows_move_to_the_archive_with_their_counts(self):
+        closed, late_counts, borrow_counts = self.closed_borrows(), self.late_counts(), self.borrow_counts()
+        self.assertGreater(len(closed), 10)
+        self.assertEqual(sum(archive_borrows(self.before, chunk_size=10)), len(closed))
+        self.assertFalse(Borrow.objects.filter(id__in=closed).exists())
+        self.assertEqual({borrow['id']: borrow for borrow in ArchivedBorrow.objects.values()}, closed)
+        self.assertEqual(self.late_counts(), late_counts)
+        self.assertEqual(self.borrow_counts(), borrow_counts)
+        # Borrows with unpaid fines stay
+        self.assertTrue(Borrow.objects.filter(returned_at__lt=self.before, fine__amount__gt=F('fine__paid')).exists())
+
+    def test_an_interrupted_run_resumes_without_counting_twice(self):
+        closed, late_counts = self.closed_borrows(), self.late_counts()
+        bulk_create = ArchivedBorrow.objects.bulk_create
+        calls = []
+
+        def crash_on_second_chunk(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise DatabaseError('disk full')
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(ArchivedBorrow.objects, 'bulk_create', crash_on_second_chunk), \
+                self.assertRaises(DatabaseError):
+            for _ in archive_borrows(self.before, chunk_size=10):
+                pass
+        self.assertEqual(ArchivedBorrow.objects.count(), 10)
+
+        self.assertEqual(sum(archive_borrows(self.before, chunk_size=10)), len(closed) - 10)
+        self.assertEqual(ArchivedBorrow.objects.count(), len(closed))
+        self.assertEqual(self.late_counts(), late_counts)
+
+    def test_summaries_accumulate_across_runs(self):
+        borrow_counts = self.borrow_counts()
+        list(archive_borrows(self.before - timedelta(days=200)))
+        list(archive_borrows(self.before))
+        self.assertEqual(self.borrow_counts(), borrow_counts)
+
+    def test_inactive_reservations_move_to_the_archive(self):
+        old = set(Reservation.objects.filter(is_active=False, reserved_at__lt=self.before).values_list('id', flat=True))
+        self.assertEqual(len(old), 5)
+        self.assertEqual(sum(archive_reservations(self.before, chunk_size=2)), 5)
+        self.assertEqual(set(ArchivedReservation.objects.values_list('id', flat=True)), old)
+        self.assertFalse(Reservation.objects.filter(id__in=old).exists())
+
+    def test_statistics_and_history_include_the_archive(self):
+        late_counts = self.late_counts()
+        list(archive_borrows(self.before))
+        self.client.force_login(self.dataset.librarian)
+
+        users = self.client.get(reverse('statistics-late-returning-users')).json()
+        self.assertEqual([user['id'] for user in users],
+                         [user_id for user_id, _ in sorted(late_counts.items(), key=lambda item: (-item[1], item[0]))])
+
+        book = ArchivedBorrow.objects.values_list('book', flat=True).first()
+        url = reverse('book-borrow-history', args=[book])
+        hot = self.client.get(url).json()
+        both = self.client.get(url, {'include_archived': 'true'}).json()
+        self.assertEqual(len(both), len(hot) + ArchivedBorrow.objects.filter(book=book).count())
+        self.assertEqual([borrow['borrowed_at'] for borrow in both],
+                         sorted((borrow['borrowed_at'] for borrow in both), reverse=True))
+
+    def test_admin_history_pages_through_hot_and_archived_borrows(self):
+        list(archive_borrows(self.before))
+        book = ArchivedBorrow.objects.values('book').annotate(borrows=Count('id')).order_by('-borrows')[0]['book']
+        expected = sorted([(borrow.borrowed_at, borrow.pk) for model in (Borrow, ArchivedBorrow)
+                           for borrow in model.objects.filter(book=book)], reverse=True)
+        self.client.force_login(self.dataset.librarian)
+        seen, params = [], {'include_archived': 'true'}
+        with mock.patch.object(BookAdmin, 'borrow_history_page_size', 2):
+            while True:
+                response = self.client.get(reverse('admin:borrow_history', args=[book]), params)
+                seen.extend((borrow.borrowed_at, borrow.pk) for borrow in response.context['borrows'])
+                if not response.context['next_cursor']:
+                    break
+                params['after'] = response.context['next_cursor']
+        self.assertEqual(seen, expected)
+
+
+class CirculationEventTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(10)
+
+    def kinds(self, **filters):
+        return list(CirculationEvent.objects.filter(**filters).order_by('id').values_list('kind', flat=True))
+
+    def test_only_the_save_returning_a_borrow_records_it(self):
+        book = self.dataset.unavailable_book
+        wishers = set(book.wished_by.values_list('id', flat=True))
+        borrow = Borrow.objects.get(book=book, returned_at__isnull=True)
+        borrow.returned_at = timezone.now()
+        borrow.save()
+        borrow.save()
+        self.assertEqual(self.kinds(user=borrow.user_id), [CirculationEvent.RETURNED])
+        # The wishers were notified once and their wishes recorded as withdrawn
+        self.assertEqual(len(mail.outbox), len(wishers))
+        self.assertEqual(set(CirculationEvent.objects.filter(kind=CirculationEvent.UNWISHED, book=book)
+                             .values_list('user_id', flat=True)), wishers)
+        self.assertFalse(book.wished_by.exists())
+
+    def test_only_the_save_deactivating_a_reservation_cancels_it(self):
+        reservation = Reservation.objects.create(user=self.dataset.reader, book=self.dataset.available_book,
+                                                 expires_at=timezone.now() + timedelta(days=1))
+        reservation.save()
+        reservation.is_active = False
+        reservation.save()
+        reservation.save()
+        self.assertEqual(self.kinds(user=self.dataset.reader),
+                         [CirculationEvent.RESERVED, CirculationEvent.CANCELLED])
+
+    def test_notifying_wishers_records_the_cleared_wishes(self):
+        book = self.dataset.available_book
+        book.wished_by.add(self.dataset.reader, self.dataset.librarian)
+        self.assertEqual(notify_wishers([book.pk]), 2)
+        self.assertFalse(book.wished_by.exists())
+        self.assertEqual(set(CirculationEvent.objects.filter(kind=CirculationEvent.UNWISHED)
+                             .values_list('user_id', 'book_id')),
+                         {(self.dataset.reader.pk, book.pk), (self.dataset.librarian.pk, book.pk)})
+
+
+class EventConsumerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        dataset = generate_dataset(10)
+        book_ids = Book.objects.values_list('id', flat=True)
+        CirculationEvent.record_many(CirculationEvent.WISHED, [(dataset.reader.pk, book_id) for book_id in book_ids])
+        cls.ids = list(CirculationEvent.objects.order_by('id').values_list('id', flat=True))
+
+    def test_events_are_consumed_in_order_and_in_batches(self):
+        batches = []
+        self.assertEqual(consume('test', lambda events: batches.append([event.id for event in events]),
+                                 batch_size=4), len(self.ids))
+        self.assertEqual([event_id for batch in batches for event_id in batch], self.ids)
+        self.assertEqual({len(batch) for batch in batches[:-1]}, {4})
+        self.assertEqual(lag('test'), 0)
+
+    def test_checkpoint_resumes_after_the_last_batch(self):
+        consume('test', lambda events: None, batch_size=3, max_batches=2)
+        self.assertEqual(lag('test'), len(self.ids) - 6)
+        seen = []
+        consume('test', lambda events: seen.extend(event.id for event in events))
+        self.assertEqual(seen, self.ids[6:])
+
+    def test_a_failing_batch_is_delivered_again(self):
+        def fail(events):
+            Genre.objects.create(name='Written by the failed batch')
+            raise RuntimeError('handler crashed')
+
+        with self.assertRaises(RuntimeError):
+            consume('test', fail, batch_size=3)
+        self.assertEqual(lag('test'), len(self.ids))
+        self.assertFalse(Genre.objects.filter(name='Written by the failed batch').exists())
+        seen = []
+        consume('test', lambda events: seen.extend(event.id for event in events))
+        self.assertEqual(seen, self.ids)
+
+    def test_consumers_have_independent_checkpoints(self):
+        consume('first', lambda events: None)
+        self.assertEqual(lag('first'), 0)
+        self.assertEqual(lag('second'), len(self.ids))
+
+
+class TokenBucketTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('library.throttling._local_store', LocalBucketStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_up_to_capacity(self):
+        results = [take_token('bucket', capacity=3, rate=1.0) for _ in range(4)]
+
+        self.assertEqual([allowed for allowed, wait in results], [True, True, True, False])
+        self.assertAlmostEqual(results[-1][1], 1.0, places=2)
+
+    def test_bucket_refills_at_the_rate(self):
+        with mock.patch('library.throttling.time.monotonic', return_value=100.0):
+            for _ in range(2):
+                take_token('bucket', capacity=2, rate=0.5)
+            self.assertEqual(take_token('bucket', capacity=2, rate=0.5), (False, 2.0))
+
+        with mock.patch('library.throttling.time.monotonic', return_value=102.0):  # One token back
+            self.assertEqual(take_token('bucket', capacity=2, rate=0.5), (True, 0.0))
+            self.assertEqual(take_token('bucket', capacity=2, rate=0.5), (False, 2.0))
+
+        with mock.patch('library.throttling.time.monotonic', return_value=1000.0):  # Never above capacity
+            results = [take_token('bucket', capacity=2, rate=0.5)[0] for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+
+    def test_buckets_are_independent(self):
+        take_token('first', capacity=1, rate=1.0)
+
+        self.assertFalse(take_token('first', capacity=1, rate=1.0)[0])
+        self.assertTrue(take_token('second', capacity=1, rate=1.0)[0])
+
+    @override_settings(THROTTLE_CACHE='throttle', CACHES={**settings.CACHES, 'throttle': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:1/0',  # Nothing listens there
+    }})
+    def test_unreachable_redis_falls_back_to_local_buckets(self):
+        with mock.patch('library.throttling._redis_stores', {}):
+            results = [take_token('bucket', capacity=2, rate=1.0)[0] for _ in range(3)]
+
+        self.assertEqual(results, [True, True, False])
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {
+        **settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], 'search': '2/min'}})
+    def test_empty_bucket_is_rejected_with_retry_after(self):
+        self.client.force_login(User.objects.create_user(email='searcher@example.com', personal_id_number='S1',
+                                                         birth_date='1990-01-01'))
+        url = reverse('book-list')
+        statuses = [self.client.get(url, {'search': 'tolkien'}).status_code for _ in range(2)]
+        response = self.client.get(url, {'search': 'tolkien'})
+
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(self.client.get(url).status_code, 200)  # Listing without a search is not throttled
+
+
+class BookListRowsTests(TestCase):
+    """The values_list() rows path of the book list must render exactly the bytes of the serializer path."""
+
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(20)
+        book = Book.objects.first()
+        book.title = 'Łódź \u2028 "quoted" \\ 東京'
+        book.save()
+        cls.books = Book.objects.select_related('author', 'genre').order_by('id')
+
+    def assert_renders_like_serializer(self, **kwargs):
+        rows = RowMapping(BookListSerializer, **kwargs)
+        fast = FastJSONRenderer().render(rows.map(self.books.values_list(*rows.columns)))
+        drf = JSONRenderer().render(BookListSerializer(self.books, many=True, **kwargs).data)
+        self.assertEqual(fast, drf)
+
+    def test_default_fields(self):
+        self.assert_renders_like_serializer(fields=BookListSerializer.select_fields())
+
+    def test_sparse_fields(self):
+        self.assert_renders_like_serializer(fields=['title', 'genre'])
+        self.assert_renders_like_serializer(fields=['quantity', 'author', 'id'])
+
+    def test_non_finite_floats_are_rejected_like_json_renderer(self):
+        for value in (float('nan'), float('inf'), float('-inf')):
+            data = [{'id': 1, 'score': None, 'ratio': [0.5, value]}]
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    JSONRenderer().render(data)
+                with self.assertRaises(ValueError):
+                    FastJSONRenderer().render(data)
+        data = [{'id': 1, 'score': None, 'ratio': 0.5}]
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_fields_needing_instances_are_refused(self):
+        with self.assertRaises(TypeError):
+            RowMapping(BookListSerializer, fields=['id', 'available_copies'])
+
+    def test_list_endpoint_matches_serializer_path(self):
+        self.client.force_login(User.objects.create_user(email='lister@example.com', personal_id_number='L1',
+                                                         birth_date='1990-01-01'))
+        url = reverse('book-list')
+        for params in ({}, {'fields': 'id,title,author'}, {'ordering': 'id', 'page': 2}, {'search': 'a'}):
+            with self.subTest(**params):
+                response = self.client.get(url, {**params, 'format': 'json'})
+                self.assertEqual(response.status_code, 200)
+                fast = response.content
+                # Without a row mapping and orjson the view serializes instances and renders with JSONRenderer
+                with mock.patch('library.views.book_list_rows', return_value=None), \
+                        mock.patch('library.renderers.orjson', None):
+                    drf = self.client.get(url, {**params, 'format': 'json'}).content
+                self.assertEqual(fast, drf)
+
+
+class SparseFieldsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(5)
+        cls.librarian = User.objects.create_user(email='sparse@example.com', personal_id_number='SP1',
+                                                 birth_date='1990-01-01', is_staff=True)
+
+    def setUp(self):
+        self.client.force_login(self.librarian)
+
+    def test_select_fields(self):
+        self.assertEqual(AuthorSerializer.select_fields(), ['id', 'full_name'])
+        self.assertEqual(AuthorSerializer.select_fields(expand=['book_count']), ['id', 'full_name', 'book_count'])
+        # Listed fields are rendered in Meta.fields order, expandable ones included
+        self.assertEqual(AuthorSerializer.select_fields(fields=['book_count', 'id']), ['id', 'book_count'])
+
+    def test_unknown_fields_are_rejected(self):
+        with self.assertRaises(ValidationError) as raised:
+            AuthorSerializer.select_fields(fields=['id', 'name'], expand=['books', 'book_count'])
+
+        self.assertEqual(raised.exception.detail, {'fields': ['Unknown field: name'],
+                                                   'expand': ['Unknown field: books']})
+
+    def test_list_renders_only_the_requested_fields(self):
+        response = self.client.get(reverse('book-list'), {'fields': 'title,id'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({tuple(book) for book in response.json()['results']}, {('id', 'title')})
+
+    def test_expand_adds_optional_fields(self):
+        books = self.client.get(reverse('book-list')).json()['results']
+        expanded = self.client.get(reverse('book-list'), {'expand': 'available_copies'}).json()['results']
+
+        self.assertNotIn('available_copies', books[0])
+        self.assertEqual(list(expanded[0]), list(books[0]) + ['available_copies'])
+        authors = self.client.get(reverse('author-list'), {'expand': 'book_count'}).json()['results']
+        self.assertTrue(all(isinstance(author['book_count'], int) for author in authors))
+
+    def test_unknown_fields_are_a_bad_request(self):
+        book_url = reverse('book-detail', args=[Book.objects.first().pk])
+        for url, param in ((reverse('book-list'), 'fields'), (book_url, 'expand'), (reverse('author-list'), 'expand'),
+                           (reverse('statistics-popular-books'), 'fields')):
+            with self.subTest(url=url, param=param):
+                response = self.client.get(url, {param: 'id,summary'})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {param: ['Unknown field: summary']})
+
+    def test_writes_ignore_the_parameters(self):
+        response = self.client.post(reverse('author-list') + '?fields=nope', {'full_name': 'New Author'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(set(response.json()), {'id', 'full_name'})
+
+
+class PopularityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(full_name='Ursula Dune')
+        genre = Genre.objects.create(name='Fantasy')
+        titles = ['Dune', 'Dune Messiah', 'Children of Dune', 'Earthsea', 'The Left Hand of Darkness']
+        cls.books = {title: Book.objects.create(title=title, author=author, genre=genre, release_year=1970,
+                                                quantity=10)
+                     for title in titles}
+        cls.readers = [User.objects.create_user(email=f'fan{i}@example.com', personal_id_number=f'F{i}',
+                                                birth_date='1990-01-01') for i in range(6)]
+        now = timezone.now()
+        borrows = {'Dune': 1, 'Dune Messiah': 3, 'Children of Dune': 3, 'Earthsea': 5, 'The Left Hand of Darkness': 0}
+        Borrow.objects.bulk_create(Borrow(user=cls.readers[i], book=cls.books[title], returned_at=now)
+                                   for title, count in borrows.items() for i in range(count))
+        BookArchiveSummary.objects.create(book=cls.books['The Left Hand of Darkness'], borrow_count=4)
+        Book.objects.refresh_popularity()
+
+    def setUp(self):
+        self.client.force_login(self.readers[0])
+
+    def titles(self, response):
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [book['title'] for book in (data['results'] if isinstance(data, dict) else data)]
+
+    def test_refresh_counts_borrows_and_archived_borrows(self):
+        popularity = dict(Book.objects.values_list('title', 'popularity'))
+
+        self.assertEqual(popularity, {'Dune': 1, 'Dune Messiah': 3, 'Children of Dune': 3, 'Earthsea': 5,
+                                      'The Left Hand of Darkness': 4})
+
+    def test_borrowing_increments_popularity(self):
+        Borrow.objects.create(user=self.readers[5], book=self.books['Dune'])
+
+        self.assertEqual(Book.objects.get(pk=self.books['Dune'].pk).popularity, 2)
+
+    def test_ordering_by_popularity(self):
+        response = self.client.get(reverse('book-list'), {'ordering': '-popularity,id', 'fields': 'title'})
+
+        self.assertEqual(self.titles(response)[:4], ['Earthsea', 'The Left Hand of Darkness', 'Dune Messiah',
+                                                     'Children of Dune'])
+
+    def test_popular_books(self):
+        response = self.client.get(reverse('statistics-popular-books'), {'fields': 'title'})
+
+        # Ties keep the id order
+        self.assertEqual(self.titles(response), ['Earthsea', 'The Left Hand of Darkness', 'Dune Messiah',
+                                                 'Children of Dune', 'Dune'])
+
+    def test_search_ranks_by_relevance_then_popularity(self):
+        response = self.client.get(reverse('book-list'), {'search': 'dune', 'fields': 'title'})
+
+        # The exact title first, then titles starting with the term, then other title matches, by popularity, and
+        # the author matches last, by popularity
+        self.assertEqual(self.titles(response)[:3], ['Dune', 'Dune Messiah', 'Children of Dune'])
+        self.assertEqual(self.titles(response)[3:5], ['Earthsea', 'The Left Hand of Darkness'])
+
+
+def cosine_neighbours(pairs, k):
+    """Brute force reference of top_neighbours: {book id: [(neighbour id, score)]}, most similar first."""
+    readers = {}
+    for user_id, book_id in pairs:
+        readers.setdefault(book_id, set()).add(user_id)
+    result = {}
+    for book_id, book_readers in readers.items():
+        scores = [(other_id, len(book_readers & other_readers) / (len(book_readers) * len(other_readers)) ** 0.5)
+                  for other_id, other_readers in readers.items()
+                  if other_id != book_id and book_readers & other_readers]
+        result[book_id] = sorted(scores, key=lambda item: (-item[1], item[0]))[:k]
+    return result
+
+
+class RecommendationTests(TestCase):
+    # (user, book) pairs: books 1 and 2 share two readers, 3 is read with 2 once, 4 has a lone reader
+    PAIRS = [(1, 1), (1, 2), (2, 1), (2, 2), (2, 3), (3, 3), (3, 5), (4, 4), (5, 5), (5, 1)]
+
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(full_name='Author')
+        genre = Genre.objects.create(name='Genre')
+        cls.books = {i: Book.objects.create(title=f'Book {i}', author=author, genre=genre, release_year=2000,
+                                            quantity=5) for i in range(1, 7)}
+        cls.readers = {i: User.objects.create_user(email=f'neighbour{i}@example.com', personal_id_number=f'N{i}',
+                                                   birth_date='1990-01-01') for i in range(1, 7)}
+
+    def setUp(self):
+        self.client.force_login(self.readers[1])
+
+    def borrow(self, pairs):
+        Borrow.objects.bulk_create(Borrow(user=self.readers[user], book=self.books[book], returned_at=timezone.now())
+                                   for user, book in pairs)
+
+    def stored(self):
+        result = {}
+        for book_id, neighbour_id, score in BookNeighbour.objects.order_by('book_id', '-score', 'neighbour_id') \
+                .values_list('book_id', 'neighbour_id', 'score'):
+            result.setdefault(book_id, []).append((neighbour_id, score))
+        return result
+
+    def assert_neighbours_equal(self, actual, expected):
+        self.assertEqual(actual.keys(), expected.keys())
+        for book_id, neighbours in expected.items():
+            self.assertEqual([n for n, _ in actual[book_id]], [n for n, _ in neighbours], book_id)
+            for (_, score), (_, expected_score) in zip(actual[book_id], neighbours):
+                self.assertAlmostEqual(score, expected_score)
+
+    def test_top_neighbours_matches_cosine_similarity(self):
+        pairs = np.array(self.PAIRS, dtype=np.int64)
+        for k in (1, 2, 10):
+            with self.subTest(k=k):
+                actual = {book_id: list(zip(ids, scores)) for book_id, ids, scores in top_neighbours(pairs, k=k)}
+                expected = cosine_neighbours(self.PAIRS, k)
+                self.assert_neighbours_equal({b: n for b, n in actual.items() if n},
+                                             {b: n for b, n in expected.items() if n})
+
+    def test_top_neighbours_in_small_batches(self):
+        pairs = np.array(self.PAIRS, dtype=np.int64)
+        with mock.patch('library.recommendations.MAX_BATCH_PAIRS', 1):
+            batched = list(top_neighbours(pairs, k=3))
+
+        self.assertEqual(batched, list(top_neighbours(pairs, k=3)))
+
+    def test_top_neighbours_of_some_books(self):
+        pairs = np.array(self.PAIRS, dtype=np.int64)
+
+        self.assertEqual([book_id for book_id, _, _ in top_neighbours(pairs, book_ids=[3, 1], k=3)], [1, 3])
+        self.assertEqual(list(top_neighbours(np.empty((0, 2), dtype=np.int64))), [])
+
+    def test_rebuild_stores_the_neighbours(self):
+        self.borrow(self.PAIRS)
+        pk = {i: book.pk for i, book in self.books.items()}
+
+        rebuild_neighbours(k=2)
+
+        expected = {pk[book]: [(pk[other], score) for other, score in neighbours]
+                    for book, neighbours in cosine_neighbours(self.PAIRS, 2).items() if neighbours}
+        self.assert_neighbours_equal(self.stored(), expected)
+
+    def test_patch_matches_a_rebuild(self):
+        self.borrow(self.PAIRS)
+        rebuild_neighbours(k=2)
+        # A new reader connects books 4 and 6 to book 1
+        self.borrow([(6, 4), (6, 6), (6, 1)])
+
+        patch_neighbours([self.books[4].pk, self.books[6].pk], k=2)
+        patched = self.stored()
+        rebuild_neighbours(k=2)
+        rebuilt = self.stored()
+
+        for book in (4, 6):
+            self.assertEqual(patched[self.books[book].pk], rebuilt[self.books[book].pk])
+        # The patched books were inserted into the lists of their neighbours, which keep at most k entries
+        self.assertIn(self.books[4].pk, [n for n, _ in patched[self.books[6].pk]])
+        self.assertTrue(all(len(neighbours) <= 2 for neighbours in patched.values()))
+
+    def test_similar_lists_the_neighbours(self):
+        self.borrow(self.PAIRS)
+        rebuild_neighbours()
+
+        response = self.client.get(reverse('book-similar', args=[self.books[1].pk]), {'fields': 'id'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([book['id'] for book in response.json()],
+                         [neighbour for neighbour, _ in self.stored()[self.books[1].pk]])
+
+    def test_similar_of_unknown_books(self):
+        self.assertEqual(self.client.get(reverse('book-similar', args=[self.books[6].pk])).json(), [])
+        self.assertEqual(self.client.get(reverse('book-similar', args=[999999])).status_code, 404)
+        self.assertEqual(self.client.get('/api/library/books/abc/similar/').status_code, 404)
+
+
+class SnapshotAnalyticsTests(TestCase):
+    """
+    Book A (two copies, author 1) has an on-time loan of 2 days, a late one of 8 days, an open loan and a wisher.
+    Book B (one copy, author 2) has an on-time loan of 4 days and book C (three copies) was never borrowed.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        authors = [Author.objects.create(full_name=f'Author {i}') for i in (1, 2)]
+        genres = [Genre.objects.create(name=f'Genre {i}') for i in (1, 2)]
+        cls.books = {name: Book.objects.create(title=f'Book {name}', author=author, genre=genre, release_year=2000,
+                                               quantity=quantity)
+                     for name, author, genre, quantity in (('A', authors[0], genres[0], 2),
+                                                           ('B', authors[1], genres[1], 1),
+                                                           ('C', authors[1], genres[0], 3))}
+        readers = [User.objects.create_user(email=f'analyst{i}@example.com', personal_id_number=f'AN{i}',
+                                             birth_date='1990-01-01') for i in range(4)]
+        cls.librarian = User.objects.create_user(email='librarian@example.com', personal_id_number='AN9',
+                                                 birth_date='1990-01-01', is_staff=True)
+        now = timezone.now().replace(microsecond=0)
+        day = timedelta(days=1)
+        # (reader, book, borrowed days ago, due after days, returned after days)
+        for reader, book, ago, due, returned in ((0, 'A', 10, 5, 2), (1, 'A', 9, 5, 8), (2, 'B', 20, 14, 4),
+                                                 (3, 'A', 3, 14, None)):
+            borrow = Borrow.objects.bulk_create([Borrow(user=readers[reader], book=cls.books[book])])[0]
+            borrowed_at = now - ago * day
+            Borrow.objects.filter(pk=borrow.pk).update(
+                borrowed_at=borrowed_at, due_date=borrowed_at + due * day,
+                returned_at=borrowed_at + returned * day if returned is not None else None)
+        cls.books['A'].wished_by.add(readers[2])
+        CirculationEvent.record(CirculationEvent.WISHED, readers[2].pk, cls.books['A'].pk)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(ANALYTICS_SNAPSHOT_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        snapshot._loaded.clear()
+        self.addCleanup(snapshot._loaded.clear)
+
+    def export(self):
+        snapshot.export_snapshot()
+        return snapshot.load_snapshot()
+
+    def test_export_and_load(self):
+        loaded = self.export()
+
+        self.assertEqual(loaded.meta['rows'], {'books': 3, 'borrows': 4, 'reservations': 0, 'wishes': 1,
+                                               'wish_events': 1, 'authors': 2, 'genres': 2})
+        self.assertEqual(loaded.books['id'].tolist(), [book.pk for book in self.books.values()])
+        self.assertEqual(loaded.books['author'].tolist(), [0, 1, 1])
+        self.assertEqual(loaded.labels, {'authors': ['Author 1', 'Author 2'], 'genres': ['Genre 1', 'Genre 2']})
+        # Keys are rows of the books arrays
+        self.assertEqual(loaded.borrows['book'].tolist(), [0, 0, 1, 0])
+        self.assertEqual(loaded.wishes['book'].tolist(), [0])
+        self.assertEqual(np.isnat(loaded.borrows['returned_at']).tolist(), [False, False, False, True])
+        self.assertIsInstance(loaded.borrows['borrowed_at'], np.memmap)
+        self.assertTrue((loaded.borrows['borrowed_at'] < loaded.created_at).all())
+
+    def test_only_the_newest_snapshots_are_kept(self):
+        paths = [snapshot.export_snapshot(keep=2) for _ in range(3)]
+
+        kept = sorted(entry.name for entry in os.scandir(self.directory) if entry.is_dir())
+        self.assertEqual(kept, [path.name for path in paths[1:]])
+        with open(os.path.join(self.directory, 'CURRENT')) as current:
+            self.assertEqual(current.read(), paths[-1].name)
+        self.assertEqual(snapshot.load_snapshot().path, paths[-1])
+
+    def test_a_failed_export_leaves_the_current_snapshot(self):
+        first = self.export()
+
+        with mock.patch('library.snapshot.np.save', side_effect=OSError('disk full')), self.assertRaises(OSError):
+            snapshot.export_snapshot()
+
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(['CURRENT', first.path.name]))
+        self.assertIs(snapshot.load_snapshot(), first)
+
+    def test_missing_snapshot(self):
+        with self.assertRaises(snapshot.SnapshotNotFound):
+            snapshot.load_snapshot()
+        self.client.force_login(self.librarian)
+        self.assertEqual(self.client.get(reverse('analytics-list')).status_code, 404)
+
+    def test_borrow_durations(self):
+        result = analytics.borrow_durations(self.export())
+
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['mean'], 4.6667)
+        self.assertEqual(result['percentiles']['p50'], 4.0)
+        self.assertEqual({(bucket['min_days'], bucket['count']) for bucket in result['histogram'] if bucket['count']},
+                         {(1, 1), (3, 1), (7, 1)})
+        self.assertEqual(result['by_genre'], [{'genre': 'Genre 1', 'median': 5.0, 'p90': 7.4},
+                                              {'genre': 'Genre 2', 'median': 4.0, 'p90': 4.0}])
+
+    def test_late_return_rates(self):
+        result = analytics.late_return_rates(self.export())
+
+        self.assertEqual(result, [{'author': 'Author 1', 'returns': 2, 'late_returns': 1, 'late_rate': 0.5},
+                                  {'author': 'Author 2', 'returns': 1, 'late_returns': 0, 'late_rate': 0.0}])
+        self.assertEqual(analytics.late_return_rates(snapshot.load_snapshot(), min_returns=2)[0]['author'],
+                         'Author 1')
+
+    def test_daily_active_loans(self):
+        loaded = self.export()
+        start = loaded.created_at - np.timedelta64(11, 'D')
+        books = np.asarray(loaded.borrows['book'])
+
+        active = analytics.daily_active_loans(loaded, books, 3, start, 11)
+
+        # Day 0 begins just under 11 days before the export: book A is lent from then on, twice while the first two
+        # loans overlap and while the late loan overlaps the open one
+        self.assertEqual(active[0].tolist(), [1, 2, 1, 1, 1, 1, 1, 2, 2, 1, 1])
+        self.assertEqual(active[2].tolist(), [0] * 11)
+
+    def test_capacity_report(self):
+        report = analytics.capacity_report(self.export(), days=30).set_index('book')
+        a, b, c = (self.books[name].pk for name in 'ABC')
+
+        self.assertEqual(report.loc[[a, b, c], 'peak_loans'].tolist(), [2, 1, 0])
+        self.assertEqual(report.loc[[a, b, c], 'waitlist'].tolist(), [1, 0, 0])
+        self.assertEqual(report.loc[[a, b, c], 'wishes'].tolist(), [1, 0, 0])
+        self.assertEqual(report.loc[[a, b, c], 'suggested_quantity'].tolist(), [3, 1, 1])
+        self.assertEqual(report.loc[[a, b, c], 'change'].tolist(), [1, 0, -2])
+        # A had both copies out for a day when the late loan began and for the two days the loans overlap
+        self.assertAlmostEqual(report.loc[a, 'zero_availability_days'], 3, places=2)
+        self.assertAlmostEqual(report.loc[b, 'zero_availability_days'], 4, places=2)
+
+    def test_endpoints(self):
+        self.export()
+        self.client.force_login(self.librarian)
+
+        for name in ('analytics-list', 'analytics-utilization', 'analytics-durations', 'analytics-late-return-rates',
+                     'analytics-capacity', 'analytics-capacity-csv'):
+            with self.subTest(name):
+                self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+        capacity = self.client.get(reverse('analytics-capacity'), {'limit': 1}).json()
+        self.assertEqual([(row['title'], row['change']) for row in capacity], [('Book A', 1)])
+
+    def test_capacity_skips_books_deleted_since_the_snapshot(self):
+        self.export()
+        self.books['A'].delete()
+        self.client.force_login(self.librarian)
+
+        capacity = self.client.get(reverse('analytics-capacity'), {'limit': 1})
+        csv = self.client.get(reverse('analytics-capacity-csv'))
+
+        self.assertEqual(capacity.status_code, 200)
+        self.assertEqual([row['title'] for row in capacity.json()], ['Book B'])
+        self.assertEqual([line.split(',')[1] for line in csv.content.decode().splitlines()],
+                         ['title', 'Book B', 'Book C'])
+
+
+@override_settings(FINE_DAILY_RATE=25, FINE_MAX_AMOUNT=2000, FINE_GRACE_DAYS=2, FINE_RETURN_LOOKBACK_DAYS=2)
+class FineTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(full_name='Author')
+        genre = Genre.objects.create(name='Genre')
+        book = Book.objects.create(title='Book', author=author, genre=genre, release_year=2000, quantity=10)
+        cls.reader, cls.other = [User.objects.create_user(email=f'fined{i}@example.com', personal_id_number=f'FN{i}',
+                                                          birth_date='1990-01-01') for i in range(2)]
+        cls.librarian = User.objects.create_user(email='cashier@example.com', personal_id_number='FN9',
+                                                 birth_date='1990-01-01', is_staff=True)
+        cls.now = timezone.now().replace(microsecond=0)
+        day = timedelta(days=1)
+        cls.borrows = dict(zip(
+            ['within_grace', 'one_day_late', 'long_overdue', 'returned_late', 'returned_long_ago', 'on_time'],
+            Borrow.objects.bulk_create([
+                Borrow(user=cls.reader, book=book, due_date=cls.now - 2 * day),
+                Borrow(user=cls.reader, book=book, due_date=cls.now - 3 * day),
+                Borrow(user=cls.other, book=book, due_date=cls.now - 100 * day),
+                Borrow(user=cls.reader, book=book, due_date=cls.now - 11 * day, returned_at=cls.now - day),
+                Borrow(user=cls.reader, book=book, due_date=cls.now - 15 * day, returned_at=cls.now - 5 * day),
+                Borrow(user=cls.other, book=book, due_date=cls.now - day, returned_at=cls.now - 3 * day),
+            ])))
+
+    def amounts(self):
+        names = {borrow.pk: name for name, borrow in self.borrows.items()}
+        return {names[borrow_id]: amount for borrow_id, amount in Fine.objects.values_list('borrow_id', 'amount')}
+
+    def test_accrual(self):
+        self.assertEqual(fines.accrue_fines(self.now), 3)
+
+        # The grace days are not fined, the rest is fined per day up to the cap; returns are finalized only within
+        # the lookback
+        self.assertEqual(self.amounts(), {'one_day_late': 25, 'long_overdue': 2000, 'returned_late': 200})
+        self.assertEqual(Fine.objects.get(borrow=self.borrows['returned_late']).overdue_days, 10)
+
+    def test_lookback(self):
+        fines.accrue_fines(self.now, lookback_days=7)
+
+        self.assertEqual(self.amounts()['returned_long_ago'], 200)
+
+    def test_accrual_updates_only_changed_fines(self):
+        fines.accrue_fines(self.now)
+
+        self.assertEqual(fines.accrue_fines(self.now), 0)
+        # A day later the borrow within the grace period is fined, the borrows still out grow (the capped one only in
+        # overdue days) and the returned one is final
+        self.assertEqual(fines.accrue_fines(self.now + timedelta(days=1)), 3)
+        self.assertEqual(self.amounts(), {'within_grace': 25, 'one_day_late': 50, 'long_overdue': 2000,
+                                          'returned_late': 200})
+        self.assertEqual(Fine.objects.get(borrow=self.borrows['long_overdue']).overdue_days, 101)
+
+    def test_amounts_never_shrink(self):
+        fines.accrue_fines(self.now)
+        Borrow.objects.filter(pk=self.borrows['one_day_late'].pk).update(due_date=self.now - timedelta(days=1))
+
+        fines.accrue_fines(self.now + timedelta(days=2))
+
+        self.assertEqual(self.amounts()['one_day_late'], 25)
+
+    def test_settle(self):
+        fines.accrue_fines(self.now)
+        self.assertEqual(fines.balance(self.reader.pk), 225)
+
+        self.assertEqual(fines.settle(self.reader.pk), 225)
+
+        self.assertEqual(fines.balance(self.reader.pk), 0)
+        self.assertEqual(fines.settle(self.reader.pk), 0)
+        # Fines accrued after settling are owed again, only the new part: a day more of the late borrow and the first
+        # fined day of the one that was within the grace period
+        fines.accrue_fines(self.now + timedelta(days=1))
+        self.assertEqual(fines.balance(self.reader.pk), 50)
+        self.assertEqual(list(fines.balances()), [
+            {'user': self.other.pk, 'user__email': self.other.email, 'balance': 2000},
+            {'user': self.reader.pk, 'user__email': self.reader.email, 'balance': 50},
+        ])
+
+    def test_endpoints(self):
+        fines.accrue_fines(self.now)
+        self.client.force_login(self.reader)
+        mine = self.client.get(reverse('fine-mine')).json()
+        self.assertEqual(mine['balance'], 225)
+        self.assertEqual(len(mine['fines']), 2)
+        self.assertEqual(self.client.post(reverse('fine-settle'), {'user': self.reader.pk}).status_code, 403)
+
+        self.client.force_login(self.librarian)
+        response = self.client.post(reverse('fine-settle'), {'user': self.reader.pk})
+
+        self.assertEqual(response.json(), {'settled': 225})
+        balances = self.client.get(reverse('fine-balances')).json()['results']
+        self.assertEqual(balances, [{'user': self.other.pk, 'email': self.other.email, 'balance': 2000}])
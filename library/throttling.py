@@ -0,0 +1,156 @@
+"""
+Token bucket rate limiting for the write and search hot spots of the API.
+
+Each user (or client address for anonymous requests) gets one bucket per throttle scope. A bucket holds up to N
+tokens for a rate of "N/period" in REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] and refills continuously at N per period,
+so short bursts pass while the sustained rate is capped. Every request takes a token; a request finding the bucket
+empty is rejected with 429 and a Retry-After header telling when the next token arrives.
+
+Buckets live in the THROTTLE_CACHE cache. On redis they are updated atomically by a Lua script, so all processes
+share them; with any other cache, or while redis is unreachable, each process keeps its own buckets in memory.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from redis.exceptions import RedisError
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+from monitoring import metrics
+
+# KEYS[1]: bucket key. ARGV: capacity, refill rate in tokens per second, expiry in seconds.
+# Returns whether the token was taken and the seconds until the next token as a string (Lua floats are truncated).
+TAKE_TOKEN_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+return {allowed, tostring(wait)}
+"""
+
+
+class LocalBucketStore:
+    """In-process buckets, shared by the threads of one process."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token from bucket `key`. Returns whether it was taken and the seconds until the next token."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, ts = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens, wait = tokens - 1, 0.0
+            else:
+                wait = (1 - tokens) / rate
+            if len(self.buckets) >= self.max_entries:
+                self.buckets.pop(next(iter(self.buckets)))  # Evict the least recently used bucket
+            self.buckets[key] = (tokens, now)
+        return allowed, wait
+
+
+class RedisBucketStore:
+    """Buckets in redis, updated atomically by TAKE_TOKEN_SCRIPT."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.scripts = {}
+
+    def take(self, key, capacity, rate):
+        key = self.cache.make_key(key)
+        # Django's redis cache has no public access to its client; the key picks the server like cache.set() does
+        client = self.cache._cache.get_client(key, write=True)
+        script = self.scripts.get(id(client))
+        if script is None:
+            script = self.scripts[id(client)] = client.register_script(TAKE_TOKEN_SCRIPT)
+        allowed, wait = script(keys=[key], args=[capacity, rate, int(capacity / rate) + 1])
+        return bool(allowed), float(wait)
+
+
+_local_store = LocalBucketStore()
+_redis_stores = {}
+
+
+def take_token(key, capacity, rate):
+    """Take a token from the bucket `key` in THROTTLE_CACHE, falling back to the in-process buckets."""
+    cache = caches[settings.THROTTLE_CACHE]
+    if isinstance(cache, RedisCache):
+        store = _redis_stores.get(settings.THROTTLE_CACHE)
+        if store is None:
+            store = _redis_stores[settings.THROTTLE_CACHE] = RedisBucketStore(cache)
+        try:
+            return store.take(key, capacity, rate)
+        except RedisError:
+            pass
+    return _local_store.take(key, capacity, rate)
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """
+    Throttle giving every user a token bucket per `scope`, sized and refilled by the scope's rate in
+    DEFAULT_THROTTLE_RATES. A rate of None disables the throttle.
+    """
+    cache_format = 'throttle:%(scope)s:%(ident)s'
+
+    @property
+    def THROTTLE_RATES(self):
+        # Looked up per request rather than at import, so the rates follow settings overrides
+        return api_settings.DEFAULT_THROTTLE_RATES
+
+    def get_cache_key(self, request, view):
+        ident = request.user.pk if request.user and request.user.is_authenticated else self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        allowed, self.retry_after = take_token(self.get_cache_key(request, view), self.num_requests,
+                                               self.num_requests / self.duration)
+        if not allowed:
+            metrics.THROTTLED_REQUESTS.inc(scope=self.scope)
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class CirculationWriteThrottle(TokenBucketThrottle):
+    """Throttle for reservations and wishes, which all write to the database."""
+    scope = 'circulation_write'
+
+
+class SearchThrottle(TokenBucketThrottle):
+    """Throttle for book searches; listing without a search term is not throttled."""
+    scope = 'search'
+
+    def allow_request(self, request, view):
+        if not request.query_params.get('search'):
+            return True
+        return super().allow_request(request, view)
+
+
+class BookStatusThrottle(TokenBucketThrottle):
+    """Throttle for the per-user book status polled by the book page."""
+    scope = 'book_status'
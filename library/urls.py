@@ -1,15 +1,21 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
-from library.views import AuthorViewSet, GenreViewSet, BookViewSet, StatisticsViewSet, user_book_status
+from library.views import AuthorViewSet, GenreViewSet, BookViewSet, BorrowViewSet, CirculationViewSet, \
+    StatisticsViewSet, AnalyticsViewSet, FineViewSet, user_book_status, availability_stream
 
 router = DefaultRouter()
 router.register(r'authors', AuthorViewSet, basename='author')
 router.register(r'genres', GenreViewSet, basename='genre')
 router.register(r'books', BookViewSet, basename='book')
+router.register(r'borrows', BorrowViewSet, basename='borrow')
+router.register(r'circulation', CirculationViewSet, basename='circulation')
+router.register(r'fines', FineViewSet, basename='fine')
 router.register(r'statistics', StatisticsViewSet, basename='statistics')
+router.register(r'analytics', AnalyticsViewSet, basename='analytics')
 
 urlpatterns = router.urls
 
 urlpatterns += [
     path('user_book_status/<int:pk>/', user_book_status, name='user_book_status'),
+    path('live/availability/', availability_stream, name='availability_stream'),
 ]
@@ -14,18 +14,39 @@ def validate_no_active_reservation(user, book=None, ignore_instance=None):
         raise ValidationError("This user already has an active reservation.")
 
 
-def validate_no_active_borrowing(user, ignore_instance=None):
-    """Validates that the user does not have an unreturned borrowing."""
+def validate_no_active_borrowing(user, ignore_instance=None, has_active_borrowing=None):
+    """
+    Validates that the user does not have an unreturned borrowing.
+    Pass has_active_borrowing when it is already known to skip the query.
+    """
     from library.models import Borrow
 
-    active_borrowings = Borrow.objects.filter(user=user, returned_at__isnull=True)
-    if ignore_instance:
-        active_borrowings = active_borrowings.exclude(pk=ignore_instance.pk)
-    if active_borrowings.exists():
+    if has_active_borrowing is None:
+        active_borrowings = Borrow.objects.filter(user=user, returned_at__isnull=True)
+        if ignore_instance:
+            active_borrowings = active_borrowings.exclude(pk=ignore_instance.pk)
+        has_active_borrowing = active_borrowings.exists()
+    if has_active_borrowing:
         raise ValidationError("This user already has an active borrowing.")
 
 
+def validate_no_reservation_for_other_book(user, book, reserved_book_ids=None):
+    """
+    Validates that the user has no active reservation for a book other than the one being borrowed.
+    Pass reserved_book_ids (ids of the user's actively reserved books) when they are already known to skip the query.
+    """
+    from library.models import Reservation
+
+    if reserved_book_ids is None:
+        reserved_book_ids = set(Reservation.objects.filter(user=user, is_active=True).values_list('book_id', flat=True))
+    if reserved_book_ids and book.pk not in reserved_book_ids:
+        raise ValidationError("This user has an active reservation for a different book.")
+
+
 def validate_book_availability(book):
-    """Validates that the book is available for borrowing or reservation"""
+    """
+    Validates that the book is available for borrowing or reservation.
+    Books annotated with BookQuerySet.with_circulation_counts() are checked without a query.
+    """
     if not book.is_available:
         raise ValidationError("This book is currently unavailable.")
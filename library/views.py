@@ -1,31 +1,94 @@
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.exceptions import ValidationError as DjangoValidationError
-from django.db.models import Count, F
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 
 from rest_framework import viewsets, status, permissions, filters
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, throttle_classes
+from rest_framework.exceptions import AuthenticationFailed, NotFound, ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 
+from library import analytics, fines, live
+from library.archive import borrow_querysets, late_borrow_querysets, union_latest
+from library.filters import RankedSearchFilter
 from library.permissions import IsLibrarian
-from library.models import Author, Genre, Book, Reservation, Borrow
+from library.renderers import FastJSONRenderer
+from library.replicas import ReplicaReadsMixin
+from library.rows import RowMapping
+from library.sparse import SparseFieldsViewMixin, only_fields
+from library.throttling import BookStatusThrottle, CirculationWriteThrottle, SearchThrottle
+from library.models import Author, Genre, Book, Reservation, Borrow, CirculationEvent, BookNeighbour
 from library.serializers import AuthorSerializer, GenreSerializer, BookSerializer, ReservationSerializer, \
-    BookListSerializer, EmptySerializer, BorrowSerializer, CustomUserSerializer, UserBookStatusSerializer
+    BookListSerializer, EmptySerializer, BorrowSerializer, CustomUserSerializer, UserBookStatusSerializer, \
+    BulkBorrowSerializer, CirculationBatchSerializer, FineSerializer, SettleFinesSerializer
+from library.services import bulk_return_borrows, bulk_extend_borrows, CirculationDesk
+from library.snapshot import SnapshotNotFound, load_snapshot
+from users.authentication import RevocableJWTAuthentication
 from users.models import CustomUser
 
 
+@lru_cache(maxsize=128)
+def book_list_rows(fields):
+    """
+    Return the RowMapping of BookListSerializer limited to `fields` (a tuple of names), or None when a field, e.g.
+    a count property, needs a model instance.
+    """
+    try:
+        return RowMapping(BookListSerializer, fields=list(fields))
+    except TypeError:
+        return None
+
+
+BOOK_LIST_ROWS = book_list_rows(tuple(BookListSerializer.select_fields()))
+
+
+def sparse_books(queryset, fields):
+    """Restrict a book queryset to the columns and counts read by the serializer fields `fields`."""
+    required = ['quantity'] if {'available_copies', 'is_available'} & set(fields) else []
+    return only_fields(queryset, fields, *required).with_counts_for(fields)
+
+
+def positive_int(request, name, default, maximum):
+    """Return the positive integer query parameter `name`, `default` when it is missing, at most `maximum`."""
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError({name: 'A positive integer is required.'})
+    if not 1 <= value <= maximum:
+        raise ValidationError({name: f'Must be between 1 and {maximum}.'})
+    return value
+
+
+def include_archived(request):
+    """Return whether the request asks for archived circulation history with ?include_archived=true."""
+    return request.query_params.get('include_archived', '').lower() in ('1', 'true', 'yes')
+
+
 @api_view(['GET'])
+@throttle_classes([BookStatusThrottle])
 def user_book_status(request, pk):
     """
     View to get the user's status for a specific book.
     """
-    user = request.user
+    user_id = request.user.pk  # Token users are not model instances, so filter by id
     book = Book.objects.get(pk=pk)
 
-    has_active_reservation = Reservation.objects.filter(user=user, book=book, is_active=True).exists()
-    has_active_borrowing = Borrow.objects.filter(user=user, book=book, returned_at__isnull=True).exists()
-    has_wish = book.wished_by.filter(pk=user.pk).exists()
+    has_active_reservation = Reservation.objects.filter(user_id=user_id, book=book, is_active=True).exists()
+    has_active_borrowing = Borrow.objects.filter(user_id=user_id, book=book, returned_at__isnull=True).exists()
+    has_wish = book.wished_by.filter(pk=user_id).exists()
     is_available = book.is_available
-    has_any_active_reservation = Reservation.objects.filter(user=user, is_active=True).exists()
+    has_any_active_reservation = Reservation.objects.filter(user_id=user_id, is_active=True).exists()
 
     data = {
         'has_active_reservation': has_active_reservation,
@@ -39,13 +102,67 @@ def user_book_status(request, pk):
     return Response(serializer.data)
 
 
-class AuthorViewSet(viewsets.ModelViewSet):
+async def stream_user(request):
+    """Return the user of a session or bearer token request, None for anonymous requests and invalid tokens."""
+    user = await request.auser()
+    if user.is_authenticated:
+        return user
+    try:
+        authenticated = await sync_to_async(RevocableJWTAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    return authenticated[0] if authenticated else None
+
+
+async def availability_stream(request):
+    """
+    View streaming Server-Sent Events with the availability of the books in ?books=1,2,3 and the user's position in
+    their wish queues, first for all of them and then for every change. Needs an ASGI server.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"detail": "Live updates require an ASGI server."}, status=status.HTTP_501_NOT_IMPLEMENTED)
+    user = await stream_user(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."},
+                            status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        book_ids = {int(book_id) for book_id in request.GET.get('books', '').split(',') if book_id}
+    except ValueError:
+        book_ids = set()
+    if not 1 <= len(book_ids) <= settings.LIVE_MAX_BOOKS:
+        return JsonResponse({"books": f"Between 1 and {settings.LIVE_MAX_BOOKS} comma separated ids are required."},
+                            status=status.HTTP_400_BAD_REQUEST)
+    try:
+        subscription = live.bus.subscribe(user.pk, book_ids)
+    except live.BusFull:
+        response = JsonResponse({"detail": "Too many open streams, retry later."},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = str(live.RECONNECT_MS // 1000)
+        return response
+    response = StreamingHttpResponse(live.stream(subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+
+class AuthorViewSet(SparseFieldsViewMixin, ReplicaReadsMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing authors.
     """
+    replica_actions = ['list', 'retrieve']
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
 
+    def get_queryset(self):
+        """
+        Select only the requested columns and count the books of each author only when ?expand=book_count asks.
+        """
+        fields = self.sparse_field_names()
+        queryset = only_fields(super().get_queryset(), fields)
+        if 'book_count' in fields:
+            queryset = queryset.annotate(book_count=Count('book'))
+        return queryset
+
     def get_permissions(self):
         """
         Assign permissions based on action.
@@ -58,13 +175,24 @@ class AuthorViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class GenreViewSet(viewsets.ModelViewSet):
+class GenreViewSet(SparseFieldsViewMixin, ReplicaReadsMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing genres.
     """
+    replica_actions = ['list', 'retrieve']
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
 
+    def get_queryset(self):
+        """
+        Select only the requested columns and count the books of each genre only when ?expand=book_count asks.
+        """
+        fields = self.sparse_field_names()
+        queryset = only_fields(super().get_queryset(), fields)
+        if 'book_count' in fields:
+            queryset = queryset.annotate(book_count=Count('book'))
+        return queryset
+
     def get_permissions(self):
         """
         Assign permissions based on action.
@@ -77,15 +205,18 @@ class GenreViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class BookViewSet(viewsets.ModelViewSet):
+class BookViewSet(SparseFieldsViewMixin, ReplicaReadsMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing books, reservations and wishes for unavailable books.
     """
+    replica_actions = ['list', 'retrieve', 'borrow_history', 'similar']
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
     queryset = Book.objects.all()
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, RankedSearchFilter, filters.OrderingFilter]
     filterset_fields = ['author', 'genre']
     search_fields = ['title', 'author__full_name', 'genre__name']
     ordering_fields = ['id', 'popularity']
+    lookup_value_regex = r'\d+'  # Other keys are not found rather than failing the integer lookups of the actions
 
     def get_permissions(self):
         """
@@ -97,19 +228,44 @@ class BookViewSet(viewsets.ModelViewSet):
             permission_classes = [permissions.IsAuthenticated]
         return [permission() for permission in permission_classes]
 
+    def get_throttles(self):
+        """
+        Rate limit the reservation and wish actions, which write, and searches, which join authors and genres.
+        """
+        if self.action in ['reserve', 'cancel_reservation', 'wish', 'remove_wish']:
+            return [CirculationWriteThrottle()]
+        elif self.action == 'list':
+            return [SearchThrottle()]
+        return super().get_throttles()
+
     def get_queryset(self):
         """
-        Customize the queryset to include popularity annotation.
+        Select only the columns and counts of the fields listed and retrieved books render.
         """
         queryset = super().get_queryset()
-        queryset = queryset.annotate(popularity=Count('borrow'))
-        return queryset
+        if self.action in ['list', 'retrieve']:
+            return sparse_books(queryset, self.sparse_field_names())
+        return queryset.select_related('author', 'genre')
+
+    def list(self, request, *args, **kwargs):
+        """
+        List books from values_list() rows mapped straight to the BookListSerializer output, without building model
+        instances and serializer fields for every row. Expanded counts need instances and use the serializer.
+        """
+        rows = book_list_rows(tuple(self.sparse_field_names()))
+        if rows is None:
+            return super().list(request, *args, **kwargs)
+        values = self.filter_queryset(self.get_queryset()).values_list(*rows.columns)
+        page = self.paginate_queryset(values)
+        if page is not None:
+            return self.get_paginated_response(rows.map(page))
+        return Response(rows.map(values))
 
     def get_serializer_class(self):
         """
         Return the appropriate serializer class based on the action.
         """
-        if self.action == 'list':
+        if self.action in ['list', 'similar']:
             return BookListSerializer
         elif self.action in ['reserve', 'cancel_reservation']:
             return ReservationSerializer
@@ -120,13 +276,29 @@ class BookViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'], permission_classes=[IsLibrarian])
     def borrow_history(self, request, pk=None):
         """
-        Custom action to retrieve the borrow history of a book.
+        Custom action to retrieve the borrow history of a book, newest first.
+        Archived borrows are included with ?include_archived=true.
         """
         book = self.get_object()
-        borrows = Borrow.objects.filter(book=book).select_related('user').order_by('-borrowed_at')
+        borrows = union_latest([queryset.filter(book=book).select_related('user')
+                                for queryset in borrow_querysets(include_archived(request))], 'borrowed_at')
         serializer = BorrowSerializer(borrows, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """
+        Custom action to list the books most borrowed by the readers of this book, most similar first.
+        Reads the precomputed neighbours of library.recommendations, never the borrow history.
+        """
+        neighbour_ids = list(BookNeighbour.objects.filter(book_id=pk).order_by('-score')
+                             .values_list('neighbour_id', flat=True))
+        if not neighbour_ids and not Book.objects.filter(pk=pk).exists():
+            raise NotFound()
+        books = sparse_books(Book.objects.all(), self.sparse_field_names()).in_bulk(neighbour_ids)
+        serializer = self.get_serializer([books[book_id] for book_id in neighbour_ids if book_id in books], many=True)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def reserve(self, request, pk=None):
         """
@@ -136,7 +308,7 @@ class BookViewSet(viewsets.ModelViewSet):
         user = request.user
 
         try:
-            reservation = Reservation.objects.create(user=user, book=book)
+            reservation = Reservation.objects.create(user_id=user.pk, book=book)
             serializer = ReservationSerializer(reservation)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         except DjangoValidationError as e:
@@ -152,7 +324,7 @@ class BookViewSet(viewsets.ModelViewSet):
         Custom action to cancel a reservation for a book.
         """
         try:
-            reservation = Reservation.objects.get(book_id=pk, user=request.user, is_active=True)
+            reservation = Reservation.objects.get(book_id=pk, user_id=request.user.pk, is_active=True)
             reservation.is_active = False
             reservation.save()
             return Response({"detail": "Reservation canceled successfully."}, status=status.HTTP_200_OK)
@@ -171,7 +343,9 @@ class BookViewSet(viewsets.ModelViewSet):
             return Response({"detail": "This book is currently available and cannot make a wish for it."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        book.wished_by.add(user)
+        with transaction.atomic():
+            book.wished_by.add(user.pk)
+            CirculationEvent.record(CirculationEvent.WISHED, user.pk, book.pk)
         return Response(
             {"detail": "Your wish has been recorded. You will be notified when the book becomes available."},
             status=status.HTTP_200_OK)
@@ -184,44 +358,244 @@ class BookViewSet(viewsets.ModelViewSet):
         book = self.get_object()
         user = request.user
 
-        if not book.wished_by.filter(id=user.id).exists():
+        if not book.wished_by.filter(id=user.pk).exists():
             return Response({"detail": "You have not wished for this book, so it cannot be removed."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        book.wished_by.remove(user)
+        with transaction.atomic():
+            book.wished_by.remove(user.pk)
+            CirculationEvent.record(CirculationEvent.UNWISHED, user.pk, book.pk)
         return Response({"detail": "Your wish for this book has been removed."}, status=status.HTTP_200_OK)
 
 
-class StatisticsViewSet(viewsets.ViewSet):
+class BorrowViewSet(viewsets.GenericViewSet):
+    """
+    ViewSet for librarians processing many borrows at once.
+    """
+    serializer_class = BulkBorrowSerializer
+    permission_classes = [IsLibrarian]
+
+    @action(detail=False, methods=['post'])
+    def bulk_return(self, request):
+        """
+        Custom action to mark many borrows as returned in one transaction.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        count = bulk_return_borrows(serializer.validated_data['ids'])
+        return Response({"returned": count}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    def bulk_extend(self, request):
+        """
+        Custom action to extend the due date of many borrows at once.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        count = bulk_extend_borrows(serializer.validated_data['ids'], serializer.validated_data.get('days'))
+        return Response({"extended": count}, status=status.HTTP_200_OK)
+
+
+class CirculationViewSet(viewsets.GenericViewSet):
+    """
+    ViewSet for the librarian circulation desk. Each action takes a batch of (user, book) operations,
+    e.g. from barcode scanners, and returns a result per operation.
+    """
+    serializer_class = CirculationBatchSerializer
+    permission_classes = [IsLibrarian]
+
+    def run(self, request, operation):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        desk = CirculationDesk(serializer.validated_data['operations'])
+        return Response({"results": getattr(desk, operation)()}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    def checkout(self, request):
+        """
+        Custom action to lend books to users.
+        """
+        return self.run(request, 'checkout')
+
+    @action(detail=False, methods=['post'])
+    def checkin(self, request):
+        """
+        Custom action to take back borrowed books.
+        """
+        return self.run(request, 'checkin')
+
+    @action(detail=False, methods=['post'])
+    def renew(self, request):
+        """
+        Custom action to extend the due date of borrowed books.
+        """
+        return self.run(request, 'renew')
+
+
+class FineViewSet(viewsets.GenericViewSet):
+    """
+    ViewSet for overdue fines, in cents. Readers see their own balance, librarians see who owes and settle payments.
+    """
+    serializer_class = FineSerializer
+    permission_classes = [IsLibrarian]
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
+    def mine(self, request):
+        """
+        Custom action to get the user's outstanding balance and unpaid fines.
+        """
+        owed = fines.outstanding().filter(user_id=request.user.pk).order_by('-updated_at', 'id')
+        return Response({"balance": fines.balance(request.user.pk),
+                         "fines": FineSerializer(owed, many=True).data})
+
+    @action(detail=False, methods=['get'])
+    def balances(self, request):
+        """
+        Custom action to get the users owing fines, highest balance first.
+        """
+        page = self.paginate_queryset(fines.balances())
+        rows = [{"user": row['user'], "email": row['user__email'], "balance": row['balance']} for row in page]
+        return self.get_paginated_response(rows)
+
+    @action(detail=False, methods=['post'], serializer_class=SettleFinesSerializer)
+    def settle(self, request):
+        """
+        Custom action to mark all fines of a user as paid.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        settled = fines.settle(serializer.validated_data['user'])
+        return Response({"settled": settled}, status=status.HTTP_200_OK)
+
+
+class StatisticsViewSet(SparseFieldsViewMixin, ReplicaReadsMixin, viewsets.ViewSet):
     """
     ViewSet for library statistics.
     """
+    replica_actions = ['popular_books', 'late_returns', 'late_returning_users']
+
     @action(detail=False, methods=['get'])
     def popular_books(self, request):
         """
         Custom action to get 10 most popular books based on borrow count.
         """
-        books = Book.objects.annotate(borrow_count=Count('borrow')).order_by('-borrow_count')[:10]
-        serializer = BookSerializer(books, many=True)
+        fields = self.sparse_field_names(BookSerializer)
+        books = sparse_books(Book.objects.all(), fields).order_by('-popularity', 'id')[:10]
+        serializer = BookSerializer(books, many=True, **self.sparse_kwargs())
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'])
     def late_returns(self, request):
         """
         Custom action to get the list of top 100 late returned books.
+        Archived borrows are included with ?include_archived=true.
         """
-        late_borrows = Borrow.objects.filter(returned_at__gt=F('due_date')).order_by('-returned_at')[:100]
-        serializer = BorrowSerializer(late_borrows, many=True)
+        fields = self.sparse_field_names(BorrowSerializer)
+        querysets = late_borrow_querysets(include_archived=include_archived(request))
+        late_borrows = union_latest([only_fields(queryset, fields, 'returned_at') for queryset in querysets],
+                                    'returned_at', 100)
+        serializer = BorrowSerializer(late_borrows, many=True, **self.sparse_kwargs())
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'])
     def late_returning_users(self, request):
         """
-        Custom action to get the list of top 100 users who returned books late.
+        Custom action to get the list of top 100 users who returned books late, most late returns first.
         """
-        late_returns = Borrow.objects.filter(returned_at__gt=F('due_date')).values('user'). \
-            annotate(late_count=Count('id')).order_by('-late_count')[:100]
-        user_ids = [entry['user'] for entry in late_returns]
-        users = CustomUser.objects.filter(id__in=user_ids)
-        serializer = CustomUserSerializer(users, many=True)
+        # Late returns that were archived are kept per user in the archive summary; both are added up and ranked in
+        # one query
+        late_count = Count('borrow', filter=Q(borrow__returned_at__gt=F('borrow__due_date'))) \
+            + Coalesce('archive_summary__late_return_count', 0)
+        users = CustomUser.objects.annotate(late_count=late_count).filter(late_count__gt=0) \
+            .order_by('-late_count', 'id')[:100]
+        users = only_fields(users, self.sparse_field_names(CustomUserSerializer))
+        serializer = CustomUserSerializer(users, many=True, **self.sparse_kwargs())
         return Response(serializer.data)
+
+
+class AnalyticsViewSet(viewsets.ViewSet):
+    """
+    ViewSet for librarians analysing circulation. Answers come from the latest columnar snapshot of
+    library.snapshot rather than the live tables, so they lag behind by up to a day.
+    """
+    permission_classes = [IsLibrarian]
+
+    def snapshot(self):
+        try:
+            return load_snapshot()
+        except SnapshotNotFound as error:
+            raise NotFound(str(error))
+
+    def list(self, request):
+        """
+        Describe the current snapshot.
+        """
+        return Response(self.snapshot().meta)
+
+    @action(detail=False, methods=['get'])
+    def utilization(self, request):
+        """
+        Custom action to get the share of each genre's copies on loan per month, for the last ?months=12 months.
+        """
+        months = positive_int(request, 'months', 12, maximum=120)
+        return Response(analytics.utilization_by_genre_month(self.snapshot(), months))
+
+    @action(detail=False, methods=['get'])
+    def durations(self, request):
+        """
+        Custom action to get the distribution of loan periods of returned borrows.
+        """
+        return Response(analytics.borrow_durations(self.snapshot()))
+
+    @action(detail=False, methods=['get'])
+    def late_return_rates(self, request):
+        """
+        Custom action to get the late return rate per author, for authors with at least ?min_returns= returns.
+        """
+        limit = positive_int(request, 'limit', 100, maximum=10000)
+        min_returns = positive_int(request, 'min_returns', 1, maximum=1000000)
+        return Response(analytics.late_return_rates(self.snapshot(), limit, min_returns))
+
+    def capacity_report(self, request):
+        """Return the capacity report for ?days=365, with titles, the books that need copies most first."""
+        days = positive_int(request, 'days', 365, maximum=3650)
+        report = analytics.capacity_report(self.snapshot(), days)
+        report = report.sort_values(['change', 'zero_availability_share', 'book'], ascending=[False, False, True])
+        return report
+
+    @staticmethod
+    def with_titles(report, titles):
+        """Insert the `titles` (book id -> title) into `report`, dropping the books deleted since the snapshot."""
+        report = report[report['book'].isin(list(titles))].copy()
+        report.insert(1, 'title', report['book'].map(titles))
+        return report
+
+    @action(detail=False, methods=['get'])
+    def capacity(self, request):
+        """
+        Custom action to get the ?limit=100 books with the largest suggested quantity increase, from the peak
+        concurrent loans, the time with no copy available and the waitlist over the last ?days=365 days.
+        """
+        limit = positive_int(request, 'limit', 100, maximum=10000)
+        report = self.capacity_report(request)
+        titles = {}
+        end = 0
+        # Books deleted since the snapshot have no title, read further down the report until `limit` books remain
+        while len(titles) < limit and end < len(report):
+            ids = report['book'].iloc[end:end + limit].tolist()
+            end += limit
+            titles.update(Book.objects.filter(id__in=ids).values_list('id', 'title'))
+        report = self.with_titles(report.head(end), titles).head(limit)
+        return Response(report.to_dict('records'))
+
+    @action(detail=False, methods=['get'])
+    def capacity_csv(self, request):
+        """
+        Custom action to download the capacity report of all books as CSV.
+        """
+        report = self.capacity_report(request)
+        titles = dict(Book.objects.values_list('id', 'title').iterator(chunk_size=10000))
+        report = self.with_titles(report, titles)
+        response = HttpResponse(report.to_csv(index=False), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="capacity.csv"'
+        return response
@@ -0,0 +1,37 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+
+from monitoring import metrics
+
+_MISSING = object()
+
+
+class InstrumentedCacheMixin:
+    """
+    Count cache hits and misses in the metrics registry. Series are labelled with the cache's KEY_PREFIX, so give
+    every configured cache a distinct prefix to tell them apart.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self.metrics_label = params.get('KEY_PREFIX') or 'default'
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        metrics.CACHE_REQUESTS.inc(cache=self.metrics_label, result='miss' if value is _MISSING else 'hit')
+        return default if value is _MISSING else value
+
+
+class InstrumentedLocMemCache(InstrumentedCacheMixin, LocMemCache):
+    """Local memory cache with hit/miss metrics. get_many() falls back to get(), so it is counted as well."""
+
+
+class InstrumentedRedisCache(InstrumentedCacheMixin, RedisCache):
+    """Redis cache with hit/miss metrics."""
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        found = super().get_many(keys, version)
+        metrics.CACHE_REQUESTS.inc(len(found), cache=self.metrics_label, result='hit')
+        metrics.CACHE_REQUESTS.inc(len(keys) - len(found), cache=self.metrics_label, result='miss')
+        return found
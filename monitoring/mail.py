@@ -0,0 +1,16 @@
+import time
+
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+
+from monitoring import metrics
+
+
+class EmailBackend(SMTPEmailBackend):
+    """SMTP email backend that records send latency and the number of sent emails."""
+
+    def send_messages(self, email_messages):
+        start = time.perf_counter()
+        sent = super().send_messages(email_messages)
+        metrics.EMAIL_SEND_DURATION.observe(time.perf_counter() - start)
+        metrics.EMAILS_SENT.inc(sent or 0)
+        return sent
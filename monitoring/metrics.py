@@ -0,0 +1,225 @@
+"""
+A small in-process metrics registry rendered in the Prometheus text exposition format.
+
+Metrics live in the memory of the process that records them: every web worker and every Celery worker keeps its own
+registry. Processes that do not serve /metrics/ themselves, i.e. Celery workers, dump their registry to a shared
+directory with dump(), and the metrics view adds the dumped series of all of them to its own. Memory is bounded by a
+fixed number of buckets per histogram and a cap on the label combinations per metric; observations beyond the cap are
+folded into a single overflow series.
+"""
+import bisect
+import json
+import os
+import threading
+from pathlib import Path
+
+OVERFLOW = '__overflow__'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class handling registration, labels and the series cap."""
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), max_series=500, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def key(self, *values):
+        """
+        Return the series key of the label `values`, given in label order, for callers recording the same series over
+        and over without building a label dict every time.
+        """
+        key = tuple(map(str, values))
+        if key not in self._series and len(self._series) >= self.max_series:
+            key = (OVERFLOW,) * len(self.label_names)
+        return key
+
+    def _key(self, labels):
+        return self.key(*(labels.get(name, '') for name in self.label_names))
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def snapshot(self):
+        """Return the series as JSON compatible [labels, value] pairs."""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._series.items()]
+
+    def render(self, merged=()):
+        """Render the series, adding the snapshots of other processes in `merged` to this process's values."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            series = {key: self._copy(value) for key, value in self._series.items()}
+        for snapshot in merged:
+            for key, value in snapshot:
+                key = tuple(key)
+                series[key] = self._combine(series[key], value) if key in series else value
+        for key, value in sorted(series.items()):
+            lines.extend(self._render_series(key, value))
+        return lines
+
+
+class Counter(Metric):
+    """A monotonically increasing value."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._series.get(self._key(labels), 0)
+
+    def _copy(self, value):
+        return value
+
+    def _combine(self, value, other):
+        return value + other
+
+    def _render_series(self, key, value):
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_number(value)}']
+
+
+class Histogram(Metric):
+    """Counts observations into fixed cumulative buckets and tracks their sum."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, documentation, labels, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.observe_key(value, self._key(labels))
+
+    def observe_key(self, value, key):
+        """Observe `value` in the series `key` returned by key()."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts, then the +Inf bucket, the observation count and their sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return series[-2] if series else 0
+
+    def _copy(self, value):
+        return list(value)
+
+    def _combine(self, value, other):
+        return [own + theirs for own, theirs in zip(value, other)]
+
+    def _render_series(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, f'le="{_format_number(bound)}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.label_names, key)
+        lines.append(f'{self.name}_sum{labels} {_format_number(value[-1])}')
+        lines.append(f'{self.name}_count{labels} {value[-2]}')
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+
+    def render(self, snapshots=()):
+        """Render all metrics, adding the registry snapshots of other processes in `snapshots`."""
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render([snapshot.get(name, []) for snapshot in snapshots]))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+
+def dump(directory, name, registry=None):
+    """Write the registry's snapshot to `directory`/`name`.json, replacing the previous dump atomically."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    partial = directory / f'.{name}.{os.getpid()}.partial'
+    partial.write_text(json.dumps((registry if registry is not None else REGISTRY).snapshot()))
+    os.replace(partial, directory / f'{name}.json')
+
+
+def load_dumps(directory):
+    """
+    Return the registry snapshots dumped to `directory`. Dumps of stopped processes are kept, so their counters do not
+    go backwards; clearing the directory resets them.
+    """
+    snapshots = []
+    for path in sorted(Path(directory).glob('*.json')):
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):  # Removed or unreadable since listing
+            continue
+    return snapshots
+
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Request latency by view.', labels=('view', 'method', 'status'))
+REQUEST_SQL_DURATION = Histogram(
+    'http_request_sql_duration_seconds', 'Time spent in SQL per request by view.', labels=('view',))
+REQUEST_SQL_QUERIES = Histogram(
+    'http_request_sql_queries', 'SQL queries per request by view.', labels=('view',),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Cache lookups by cache alias and result (hit or miss).', labels=('cache', 'result'))
+TASK_DURATION = Histogram(
+    'celery_task_duration_seconds', 'Celery task run time by task and final state.', labels=('task', 'state'),
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0))
+TASK_FAILURES = Counter('celery_task_failures_total', 'Failed Celery tasks by task.', labels=('task',))
+EMAIL_SEND_DURATION = Histogram('email_send_duration_seconds', 'Time to hand a batch of emails to the backend.')
+EMAILS_SENT = Counter('emails_sent_total', 'Emails handed to the mail server.')
+CIRCULATION_EVENTS = Counter(
+    'library_circulation_events_total', 'Reservation and borrow state changes by event.', labels=('event',))
+THROTTLED_REQUESTS = Counter(
+    'library_throttled_requests_total', 'API requests rejected by rate limiting by throttle scope.', labels=('scope',))
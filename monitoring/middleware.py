@@ -0,0 +1,165 @@
+import cProfile
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from monitoring import metrics
+from monitoring.profiling import profile_dir, profile_filename
+from monitoring.sql import QueryTimer, QueryTracker
+
+logger = logging.getLogger('monitoring.sql')
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a request runs more SQL queries than SQL_QUERY_BUDGET allows."""
+
+
+def view_name(request):
+    """Return the name of the view that handled the request, or its path if it was not resolved."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return request.path
+    return match.view_name or match._func_path
+
+
+def add_server_timing(response, metric):
+    if response.has_header('Server-Timing'):
+        metric = f"{response['Server-Timing']}, {metric}"
+    response['Server-Timing'] = metric
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Record the number of SQL queries and the total SQL time of each request when SQL_INSTRUMENTATION is enabled.
+
+    The figures are returned in a Server-Timing header and logged. Query shapes executed at least
+    SQL_N_PLUS_ONE_THRESHOLD times within one request are logged as N+1 suspects with the view and the stack that
+    repeated them. When SQL_QUERY_BUDGET is set, requests exceeding it are logged as errors, or fail with
+    QueryBudgetExceeded if SQL_QUERY_BUDGET_RAISE is enabled (meant for test runs).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.SQL_INSTRUMENTATION:
+            return self.get_response(request)
+
+        tracker = QueryTracker()
+        with tracker.installed():
+            response = self.get_response(request)
+
+        view = view_name(request)
+        duration_ms = tracker.duration * 1000
+        add_server_timing(response, f'sql;dur={duration_ms:.2f};desc="{tracker.count} queries"')
+        logger.info('%s %s: %d queries in %.2f ms', request.method, view, tracker.count, duration_ms, extra={
+            'data': {
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                'queries': tracker.count,
+                'sql_ms': round(duration_ms, 3),
+            }
+        })
+
+        for shape, count in tracker.repeated(settings.SQL_N_PLUS_ONE_THRESHOLD):
+            logger.warning('Possible N+1 in %s: query repeated %d times: %s', view, count, shape, extra={
+                'data': {
+                    'view': view,
+                    'count': count,
+                    'query': shape,
+                    'stack': tracker.stacks.get(shape, []),
+                }
+            })
+
+        budget = settings.SQL_QUERY_BUDGET
+        if budget is not None and tracker.count > budget:
+            message = f'{request.method} {view} ran {tracker.count} queries, budget is {budget}'
+            if settings.SQL_QUERY_BUDGET_RAISE:
+                raise QueryBudgetExceeded(message)
+            logger.error(message, extra={'data': {'view': view, 'queries': tracker.count, 'budget': budget}})
+
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Record request latency, SQL time and SQL query count per view in the metrics registry when METRICS_ENABLED is set.
+
+    The series keys of every (view, method, status class) are looked up once and kept, up to the series cap of
+    REQUEST_DURATION, so a request only observes its three histograms.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._keys = {}
+
+    def series_keys(self, view, method, status):
+        keys = self._keys.get((view, method, status))
+        if keys is None:
+            keys = (metrics.REQUEST_DURATION.key(view, method, f'{status}xx'), metrics.REQUEST_SQL_DURATION.key(view),
+                    metrics.REQUEST_SQL_QUERIES.key(view))
+            if len(self._keys) < metrics.REQUEST_DURATION.max_series:
+                self._keys[view, method, status] = keys
+        return keys
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with timer.installed():
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        duration_key, sql_duration_key, sql_queries_key = self.series_keys(
+            match.view_name if match else '<unresolved>', request.method, response.status_code // 100)
+        metrics.REQUEST_DURATION.observe_key(elapsed, duration_key)
+        metrics.REQUEST_SQL_DURATION.observe_key(timer.duration, sql_duration_key)
+        metrics.REQUEST_SQL_QUERIES.observe_key(timer.count, sql_queries_key)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests from staff users with cProfile when PROFILING_ENABLED is set.
+
+    A request is profiled when it carries the PROFILING_HEADER header or the PROFILING_QUERY_PARAM query parameter,
+    and then only for a PROFILING_SAMPLE_RATE share of those requests. Profiles are written to PROFILING_DIR and can
+    be browsed on the admin profiles page. Must come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def should_profile(self, request):
+        if not settings.PROFILING_ENABLED or not request.user.is_staff:
+            return False
+        requested = (request.headers.get(settings.PROFILING_HEADER)
+                     or settings.PROFILING_QUERY_PARAM in request.GET)
+        return bool(requested) and random.random() < settings.PROFILING_SAMPLE_RATE
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        directory = profile_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        filename = profile_filename(view_name(request), elapsed_ms)
+        profiler.dump_stats(directory / filename)
+        response['X-Profile'] = filename
+        return response
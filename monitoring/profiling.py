@@ -0,0 +1,59 @@
+import pstats
+import re
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+_FILENAME = re.compile(r'^(?P<stamp>\d{8}T\d{6}\.\d{6})-(?P<view>.+)-(?P<ms>\d+(?:\.\d+)?)ms\.prof$')
+
+
+def profile_dir():
+    return Path(settings.PROFILING_DIR)
+
+
+def profile_filename(view, elapsed_ms):
+    """Build a file name carrying the capture time, the view name and the request duration."""
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S.%f')
+    return f'{stamp}-{_UNSAFE.sub("_", view)}-{elapsed_ms:.1f}ms.prof'
+
+
+def list_profiles():
+    """Return the captured profiles, newest first, with the details encoded in their file names."""
+    directory = profile_dir()
+    if not directory.is_dir():
+        return []
+    profiles = []
+    for path in directory.glob('*.prof'):
+        match = _FILENAME.match(path.name)
+        if match is None:
+            continue
+        profiles.append({
+            'name': path.name,
+            'view': match['view'],
+            'captured_at': datetime.strptime(match['stamp'], '%Y%m%dT%H%M%S.%f').replace(tzinfo=timezone.utc),
+            'duration_ms': float(match['ms']),
+            'size': path.stat().st_size,
+        })
+    return sorted(profiles, key=lambda profile: profile['captured_at'], reverse=True)
+
+
+def summarize_profile(name, limit=40):
+    """
+    Return the total call count and time of a captured profile and its `limit` most expensive functions by
+    cumulative time. Only names of existing profiles are accepted.
+    """
+    if name not in {profile['name'] for profile in list_profiles()}:
+        raise FileNotFoundError(name)
+    stats = pstats.Stats(str(profile_dir() / name))
+    rows = []
+    for (filename, line, function), (primitive_calls, calls, own_time, cumulative_time, _) in stats.stats.items():
+        rows.append({
+            'function': f'{function} ({filename}:{line})' if line else function,
+            'calls': calls if calls == primitive_calls else f'{calls}/{primitive_calls}',
+            'own_ms': own_time * 1000,
+            'cumulative_ms': cumulative_time * 1000,
+        })
+    rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+    return {'total_calls': stats.total_calls, 'total_ms': stats.total_tt * 1000, 'functions': rows[:limit]}
@@ -0,0 +1,65 @@
+import os
+import socket
+import time
+
+from celery.signals import task_prerun, task_postrun, task_failure
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from library.models import Reservation, Borrow, CirculationEvent
+from library.signals import circulation_recorded
+from monitoring import metrics
+
+_task_started = {}
+
+# Circulation event kinds counted by record_closing_events, kind -> event label
+CLOSING_EVENTS = {CirculationEvent.RETURNED: 'returned', CirculationEvent.CANCELLED: 'reservation_closed'}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    start = _task_started.pop(task_id, None)
+    if start is not None:
+        metrics.TASK_DURATION.observe(time.perf_counter() - start, task=task.name, state=state or 'UNKNOWN')
+    if not task.request.is_eager:  # Eager tasks ran in a web process, which serves its own registry
+        dump_worker_metrics()
+
+
+def dump_worker_metrics():
+    """Dump this worker process's registry for the web processes serving /metrics/."""
+    if settings.METRICS_DUMP_DIR:
+        metrics.dump(settings.METRICS_DUMP_DIR, f'worker-{socket.gethostname()}-{os.getpid()}')
+
+
+@task_failure.connect
+def record_task_failure(sender=None, **kwargs):
+    metrics.TASK_FAILURES.inc(task=sender.name if sender else 'unknown')
+
+
+@receiver(post_save, sender=Reservation)
+def record_reservation_event(instance, created, **kwargs):
+    if created:
+        metrics.CIRCULATION_EVENTS.inc(event='reserved')
+
+
+@receiver(post_save, sender=Borrow)
+def record_borrow_event(instance, created, **kwargs):
+    if created:
+        metrics.CIRCULATION_EVENTS.inc(event='borrowed')
+
+
+@receiver(circulation_recorded)
+def record_closing_events(events, **kwargs):
+    """
+    Count returns and cancellations from the circulation events, which are only recorded when a borrow or reservation
+    actually closes, unlike saves of already closed ones.
+    """
+    for event in events:
+        if event.kind in CLOSING_EVENTS:
+            metrics.CIRCULATION_EVENTS.inc(event=CLOSING_EVENTS[event.kind])
@@ -0,0 +1,87 @@
+import re
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+_IN_LIST = re.compile(r'IN \((?:%s|\?)(?:, (?:%s|\?))*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def query_shape(sql):
+    """
+    Normalize a SQL statement so that queries differing only in their parameters compare equal.
+    """
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def project_stack(limit=12):
+    """Return the current stack trace restricted to frames from project code."""
+    base_dir = str(settings.BASE_DIR)
+    frames = [frame for frame in traceback.extract_stack()[:-3]
+              if frame.filename.startswith(base_dir) and 'site-packages' not in frame.filename]
+    return traceback.format_list(frames[-limit:])
+
+
+class QueryTimer:
+    """Database execute wrapper that counts queries and sums their duration."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, duration):
+        self.count += 1
+        self.duration += duration
+
+    @contextmanager
+    def installed(self):
+        """Track the queries run on every configured database while the context is active."""
+        # What connection.execute_wrapper() does, without a context manager per database on every request
+        wrapped = [connections[alias] for alias in connections]
+        for connection in wrapped:
+            connection.execute_wrappers.append(self)
+        try:
+            yield self
+        finally:
+            for connection in wrapped:
+                connection.execute_wrappers.pop()
+
+
+class QueryTracker(QueryTimer):
+    """
+    Query timer that also groups the executed statements by shape.
+
+    The stack of the first repeated execution of every shape is kept, which is where an N+1 pattern starts.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.shapes = Counter()
+        self.stacks = {}
+        self.statements = []
+
+    def record(self, sql, duration):
+        super().record(sql, duration)
+        self.statements.append(sql)
+        shape = query_shape(sql)
+        self.shapes[shape] += 1
+        if self.shapes[shape] == 2:
+            self.stacks[shape] = project_stack()
+
+    def repeated(self, threshold):
+        """Return (shape, count) pairs for the shapes executed at least `threshold` times."""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
@@ -0,0 +1,250 @@
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from library.models import Author, Book, Borrow, Genre, Reservation
+from monitoring import metrics
+from monitoring.middleware import MetricsMiddleware, QueryBudgetExceeded, QueryInstrumentationMiddleware
+from monitoring.profiling import list_profiles
+from monitoring.sql import QueryTracker, query_shape
+
+User = get_user_model()
+
+
+def run_queries(count):
+    """Return a view running `count` single-row lookups, the shape of an N+1 loop."""
+    def view(request):
+        for pk in range(count):
+            list(User.objects.filter(pk=pk))
+        return HttpResponse()
+    return view
+
+
+class QueryShapeTests(TestCase):
+    def test_parameters_and_in_lists_are_normalized(self):
+        self.assertEqual(query_shape('SELECT * FROM t WHERE id IN (%s, %s, %s) AND x = 5 LIMIT 21'),
+                         query_shape('SELECT  *  FROM t WHERE id IN (%s) AND x = 9 LIMIT 21'))
+
+    def test_tracker_reports_repeated_shapes_with_their_stack(self):
+        tracker = QueryTracker()
+        with tracker.installed():
+            run_queries(4)(None)
+            list(User.objects.all())
+        self.assertEqual(tracker.count, 5)
+        [(shape, count)] = tracker.repeated(3)
+        self.assertEqual(count, 4)
+        self.assertTrue(any('monitoring/tests.py' in frame for frame in tracker.stacks[shape]))
+
+
+@override_settings(SQL_INSTRUMENTATION=True, SQL_N_PLUS_ONE_THRESHOLD=3, SQL_QUERY_BUDGET=None)
+class QueryInstrumentationMiddlewareTests(TestCase):
+    def get(self, view):
+        return QueryInstrumentationMiddleware(view)(RequestFactory().get('/books/'))
+
+    def test_server_timing_counts_the_queries(self):
+        response = self.get(run_queries(2))
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+
+    def test_repeated_queries_are_logged_as_n_plus_one(self):
+        with self.assertLogs('monitoring.sql', 'WARNING') as logs:
+            self.get(run_queries(3))
+        self.assertIn('Possible N+1', logs.output[0])
+
+    def test_queries_below_the_threshold_are_not_reported(self):
+        with self.assertNoLogs('monitoring.sql', 'WARNING'):
+            self.get(run_queries(2))
+
+    @override_settings(SQL_QUERY_BUDGET=2, SQL_QUERY_BUDGET_RAISE=True)
+    def test_exceeding_the_budget_raises(self):
+        self.get(run_queries(2))
+        with self.assertRaises(QueryBudgetExceeded):
+            self.get(run_queries(3))
+
+
+class RegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.requests = metrics.Counter('requests_total', 'Requests.', labels=('view',), max_series=2,
+                                        registry=self.registry)
+        self.latency = metrics.Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1), registry=self.registry)
+
+    def test_render_uses_cumulative_buckets(self):
+        self.latency.observe(0.05)
+        self.latency.observe(0.5)
+        self.latency.observe(5)
+        rendered = self.registry.render()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', rendered)
+        self.assertIn('latency_seconds_bucket{le="1"} 2\n', rendered)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3\n', rendered)
+        self.assertIn('latency_seconds_count 3\n', rendered)
+
+    def test_label_combinations_beyond_the_cap_overflow(self):
+        for view in ('a', 'b', 'c', 'd'):
+            self.requests.inc(view=view)
+        self.assertEqual(self.requests.value(view=metrics.OVERFLOW), 2)
+        self.assertIn(f'requests_total{{view="{metrics.OVERFLOW}"}} 2', self.registry.render())
+
+    def test_dumps_of_other_processes_are_added(self):
+        worker = metrics.Registry()
+        metrics.Counter('requests_total', 'Requests.', labels=('view',), registry=worker).inc(3, view='a')
+        metrics.Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1), registry=worker).observe(0.5)
+        self.requests.inc(view='a')
+        self.requests.inc(view='b')
+        self.latency.observe(0.5)
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.dump(directory, 'worker-1', worker)
+            rendered = self.registry.render(metrics.load_dumps(directory))
+        self.assertIn('requests_total{view="a"} 4\n', rendered)
+        self.assertIn('requests_total{view="b"} 1\n', rendered)
+        self.assertIn('latency_seconds_bucket{le="1"} 2\n', rendered)
+        self.assertIn('latency_seconds_sum 1.0\n', rendered)
+
+
+class MetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        metrics.REGISTRY.clear()
+
+    def get(self):
+        request = RequestFactory().get('/books/')
+        return MetricsMiddleware(run_queries(2))(request)
+
+    def test_requests_are_observed(self):
+        self.get()
+        self.assertEqual(metrics.REQUEST_DURATION.count(view='<unresolved>', method='GET', status='2xx'), 1)
+        self.assertEqual(metrics.REQUEST_SQL_QUERIES.count(view='<unresolved>'), 1)
+        self.assertIn('http_request_sql_queries_bucket{view="<unresolved>",le="2"} 1', metrics.REGISTRY.render())
+
+    def test_series_keys_are_reused(self):
+        middleware = MetricsMiddleware(run_queries(0))
+        middleware(RequestFactory().get('/books/'))
+        middleware(RequestFactory().get('/books/'))
+        middleware(RequestFactory().post('/books/'))
+
+        self.assertEqual(len(middleware._keys), 2)
+        self.assertEqual(metrics.REQUEST_DURATION.count(view='<unresolved>', method='GET', status='2xx'), 2)
+        self.assertEqual(metrics.REQUEST_DURATION.count(view='<unresolved>', method='POST', status='2xx'), 1)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_nothing_is_recorded_when_disabled(self):
+        self.get()
+        self.assertEqual(metrics.REQUEST_DURATION.count(view='<unresolved>', method='GET', status='2xx'), 0)
+
+
+class CirculationMetricsTests(TestCase):
+    def setUp(self):
+        metrics.REGISTRY.clear()
+        author = Author.objects.create(full_name='Author')
+        genre = Genre.objects.create(name='Genre')
+        self.book = Book.objects.create(title='Book', author=author, genre=genre, release_year=2000, quantity=2)
+        self.user = User.objects.create_user(email='reader@example.com', personal_id_number='1',
+                                             birth_date='1990-01-01')
+
+    def test_closed_reservations_are_counted_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = Reservation.objects.create(user=self.user, book=self.book)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.is_active = False
+            reservation.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.save()  # E.g. the admin saving an inactive reservation again
+
+        self.assertEqual(metrics.CIRCULATION_EVENTS.value(event='reserved'), 1)
+        self.assertEqual(metrics.CIRCULATION_EVENTS.value(event='reservation_closed'), 1)
+
+    def test_returned_borrows_are_counted_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            borrow = Borrow.objects.create(user=self.user, book=self.book)
+        with self.captureOnCommitCallbacks(execute=True):
+            borrow.returned_at = timezone.now()
+            borrow.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            borrow.save()
+
+        self.assertEqual(metrics.CIRCULATION_EVENTS.value(event='borrowed'), 1)
+        self.assertEqual(metrics.CIRCULATION_EVENTS.value(event='returned'), 1)
+
+
+@override_settings(METRICS_TOKEN='scrape-token', METRICS_DUMP_DIR=None)
+class MetricsViewTests(TestCase):
+    def test_anonymous_and_non_staff_users_are_forbidden(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.client.force_login(User.objects.create_user(
+            email='reader@example.com', password='x', personal_id_number='1', birth_date='1990-01-01'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+    def test_staff_users_are_served(self):
+        self.client.force_login(User.objects.create_user(
+            email='staff@example.com', password='x', personal_id_number='2', birth_date='1990-01-01', is_staff=True))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE http_request_duration_seconds histogram', response.content)
+
+    def test_local_addresses_and_wrong_tokens_are_forbidden(self):
+        # Behind a reverse proxy on the same host every request comes from a local address
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong-token')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_no_token_is_accepted_without_a_configured_one(self):
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+
+    def test_scrapers_with_the_token_are_served_with_the_worker_dumps(self):
+        worker = metrics.Registry()
+        metrics.Counter(metrics.TASK_FAILURES.name, 'Failures.', labels=metrics.TASK_FAILURES.label_names,
+                        registry=worker).inc(task='library.tasks.send_email')
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DUMP_DIR=directory):
+            metrics.dump(directory, 'worker-1', worker)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'{metrics.TASK_FAILURES.name}{{task="library.tasks.send_email"}} 1', response.content.decode())
+
+
+class ProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(
+            email='staff@example.com', password='x', personal_id_number='1', birth_date='1990-01-01', is_staff=True)
+        cls.reader = User.objects.create_user(
+            email='reader@example.com', password='x', personal_id_number='2', birth_date='1990-01-01')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1.0, PROFILING_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_staff_requests_asking_for_a_profile_are_profiled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('genre-list'), headers={'X-Profile': '1'})
+        [profile] = list_profiles()
+        self.assertEqual(response['X-Profile'], profile['name'])
+        self.assertEqual(profile['view'], 'genre-list')
+
+        response = self.client.get(reverse('profile_detail', args=[profile['name']]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('profile_detail', args=['missing.prof'])).status_code, 404)
+
+    def test_requests_not_asking_for_a_profile_are_not_profiled(self):
+        self.client.force_login(self.staff)
+        self.assertNotIn('X-Profile', self.client.get(reverse('genre-list')))
+        self.assertEqual(list_profiles(), [])
+
+    def test_non_staff_users_cannot_profile_or_browse_profiles(self):
+        self.client.force_login(self.reader)
+        self.assertNotIn('X-Profile', self.client.get(reverse('genre-list'), {'profile': '1'}))
+        self.assertEqual(list_profiles(), [])
+        self.assertRedirects(self.client.get(reverse('profile_list')),
+                             f"{reverse('admin:login')}?next={reverse('profile_list')}")
+
+    @override_settings(PROFILING_ENABLED=False)
+    def test_nothing_is_profiled_when_disabled(self):
+        self.client.force_login(self.staff)
+        self.assertNotIn('X-Profile', self.client.get(reverse('genre-list'), headers={'X-Profile': '1'}))
+        self.assertEqual(list_profiles(), [])
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from monitoring.views import metrics_view, profile_list_view, profile_detail_view
+
+urlpatterns = [
+    path('metrics/', metrics_view, name='metrics'),
+    path('admin/profiles/', profile_list_view, name='profile_list'),
+    path('admin/profiles/<str:name>/', profile_detail_view, name='profile_detail'),
+]
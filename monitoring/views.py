@@ -0,0 +1,59 @@
+import hmac
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseForbidden, Http404
+from django.shortcuts import render
+
+from monitoring.metrics import REGISTRY, load_dumps
+from monitoring.profiling import list_profiles, summarize_profile
+
+
+def _has_metrics_token(request):
+    token = settings.METRICS_TOKEN
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+
+def metrics_view(request):
+    """
+    Expose the metrics registry in the Prometheus text format to scrapers sending METRICS_TOKEN as a bearer token and
+    to staff users, with the series Celery workers dumped to METRICS_DUMP_DIR added. The client address is not trusted:
+    behind a reverse proxy on the same host every request comes from a local address.
+    """
+    if not _has_metrics_token(request) and not request.user.is_staff:
+        return HttpResponseForbidden()
+    snapshots = load_dumps(settings.METRICS_DUMP_DIR) if settings.METRICS_DUMP_DIR else []
+    return HttpResponse(REGISTRY.render(snapshots), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profile_list_view(request):
+    """
+    Admin page listing the request profiles captured by ProfilingMiddleware.
+    """
+    context = dict(
+        admin.site.each_context(request),
+        title='Request profiles',
+        profiles=list_profiles(),
+        enabled=settings.PROFILING_ENABLED,
+    )
+    return render(request, 'admin/profiles.html', context)
+
+
+@staff_member_required
+def profile_detail_view(request, name):
+    """
+    Admin page summarizing a captured profile by the cumulative time of its most expensive functions.
+    """
+    try:
+        summary = summarize_profile(name)
+    except FileNotFoundError:
+        raise Http404('Profile not found')
+    context = dict(
+        admin.site.each_context(request),
+        title=name,
+        name=name,
+        summary=summary,
+    )
+    return render(request, 'admin/profile_detail.html', context)
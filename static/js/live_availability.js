@@ -0,0 +1,22 @@
+// Keeps the availability on the book detail page current through the live availability stream
+(function () {
+    const element = document.getElementById('live-availability');
+    if (!element || !window.EventSource) {
+        return;
+    }
+    const copies = element.querySelector('[data-field="available_copies"]');
+    const queue = element.querySelector('[data-field="queue_position"]');
+    const source = new EventSource(element.dataset.streamUrl);
+
+    source.addEventListener('availability', function (event) {
+        const update = JSON.parse(event.data);
+        copies.textContent = update.available_copies;
+        queue.textContent = update.queue_position === null ? '' :
+            'Your position in the wish queue: ' + update.queue_position;
+        // The reserve and wish buttons depend on the availability, so reload them when it flips
+        if (String(update.is_available) !== element.dataset.isAvailable) {
+            source.close();
+            window.location.reload();
+        }
+    });
+})();
@@ -0,0 +1,18 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from users.tokens import is_revoked
+
+
+class RevocableJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    Bearer token authentication without a user query: the user is built from the token claims, including is_staff
+    for IsLibrarian. Tokens on the deny list are rejected.
+    """
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if is_revoked(token):
+            raise InvalidToken({'detail': _('Token has been revoked'), 'code': 'token_revoked'})
+        return token
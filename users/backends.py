@@ -0,0 +1,49 @@
+import copy
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+
+from monitoring import metrics
+
+_users = {}
+_lock = threading.Lock()
+
+
+def forget_user(user_id):
+    """Drop `user_id` from this process's user cache."""
+    with _lock:
+        _users.pop(user_id, None)
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    Model backend keeping the users it loads for a session in a per-process cache for USER_CACHE_TIMEOUT seconds,
+    so authenticated requests do not read the user row every time.
+
+    Entries are dropped when the user is saved (which covers password changes) or logs out in this process; changes
+    made elsewhere, e.g. with QuerySet.update() or in another process, show up once the entry expires. Every request
+    gets its own copy of the cached user.
+    """
+
+    def get_user(self, user_id):
+        timeout = settings.USER_CACHE_TIMEOUT
+        if not timeout:
+            return super().get_user(user_id)
+
+        now = time.monotonic()
+        with _lock:
+            entry = _users.get(user_id)
+        if entry is not None and entry[0] > now:
+            metrics.CACHE_REQUESTS.inc(cache='users', result='hit')
+            return copy.copy(entry[1])
+
+        metrics.CACHE_REQUESTS.inc(cache='users', result='miss')
+        user = super().get_user(user_id)
+        if user is not None:
+            with _lock:
+                if len(_users) >= settings.USER_CACHE_MAX_ENTRIES:
+                    _users.pop(next(iter(_users)))  # Evict the oldest entry
+                _users[user_id] = (now + timeout, copy.copy(user))
+        return user
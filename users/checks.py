@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, register
+
+# Backends keeping their entries in the memory of one process
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+@register()
+def check_deny_list_cache(app_configs, **kwargs):
+    """Refuse to start with a deny list that other processes cannot see, as they would accept revoked tokens."""
+    if isinstance(caches[settings.JWT_DENY_LIST_CACHE], PROCESS_LOCAL_CACHES):
+        return [Error(
+            f'JWT_DENY_LIST_CACHE {settings.JWT_DENY_LIST_CACHE!r} is local to each process, so a token revoked in '
+            f'one process stays valid in the others.',
+            hint='Point it at a cache shared by all processes, e.g. the database cache of the shared alias.',
+            id='users.E001',
+        )]
+    return []
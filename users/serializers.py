@@ -0,0 +1,44 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework import serializers
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from users.tokens import is_revoked, revoke
+
+
+class LibraryTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Token pair serializer adding the is_staff claim, which access tokens refreshed from the pair inherit.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['is_staff'] = user.is_staff
+        return token
+
+
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Refresh serializer refusing refresh tokens on the deny list.
+    """
+
+    def validate(self, attrs):
+        if is_revoked(RefreshToken(attrs['refresh'])):
+            raise TokenError(_('Token has been revoked'))
+        return super().validate(attrs)
+
+
+class TokenRevokeSerializer(serializers.Serializer):
+    """
+    Serializer putting a refresh token and, optionally, an access token on the deny list.
+    """
+    refresh = serializers.CharField(write_only=True)
+    access = serializers.CharField(write_only=True, required=False)
+
+    def validate(self, attrs):
+        revoke(RefreshToken(attrs['refresh']))
+        if 'access' in attrs:
+            revoke(AccessToken(attrs['access']))
+        return {}
@@ -1,3 +1,204 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users import backends, tokens
+from users.backends import CachedModelBackend
+from users.checks import check_deny_list_cache
+
+User = get_user_model()
+
+
+class TokenTests(TestCase):
+    password = 'secret-password'
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='reader@example.com', password=self.password,
+                                             personal_id_number='12345678901', birth_date='1990-01-01')
+        tokens._checked.clear()
+        self.addCleanup(tokens._checked.clear)
+
+    def obtain(self, user):
+        response = self.client.post(reverse('token_obtain_pair'), {'email': user.email, 'password': self.password})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get(self, url, access):
+        return self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def test_access_token_carries_is_staff(self):
+        librarian = User.objects.create_user(email='librarian@example.com', password=self.password, is_staff=True,
+                                             personal_id_number='10987654321', birth_date='1990-01-01')
+        reader_access = self.obtain(self.user)['access']
+        librarian_access = self.obtain(librarian)['access']
+
+        self.assertIs(AccessToken(reader_access)['is_staff'], False)
+        self.assertIs(AccessToken(librarian_access)['is_staff'], True)
+        # IsLibrarian reads the claim
+        self.assertEqual(self.get(reverse('fine-balances'), librarian_access).status_code, 200)
+        self.assertEqual(self.get(reverse('fine-balances'), reader_access).status_code, 403)
+
+    def test_refreshed_access_token_keeps_is_staff(self):
+        self.user.is_staff = True
+        self.user.save()
+        refresh = self.obtain(self.user)['refresh']
+
+        response = self.client.post(reverse('token_refresh'), {'refresh': refresh})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(AccessToken(response.json()['access'])['is_staff'], True)
+
+    def test_revoked_access_token_is_rejected(self):
+        tokens = self.obtain(self.user)
+        self.assertEqual(self.get(reverse('fine-mine'), tokens['access']).status_code, 200)
+
+        response = self.client.post(reverse('token_revoke'), tokens)
+
+        self.assertEqual(response.status_code, 200)
+        response = self.get(reverse('fine-mine'), tokens['access'])
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['code'], 'token_revoked')
+
+    def test_refresh_after_revoke_is_rejected(self):
+        tokens = self.obtain(self.user)
+        self.client.post(reverse('token_revoke'), {'refresh': tokens['refresh']})
+
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']})
+
+        self.assertEqual(response.status_code, 401)
+        # Only the refresh token was revoked
+        self.assertEqual(self.get(reverse('fine-mine'), tokens['access']).status_code, 200)
+
+    def test_revocation_is_seen_by_other_processes(self):
+        pair = self.obtain(self.user)
+        self.client.post(reverse('token_revoke'), pair)
+
+        # Another process starts with empty local caches but reads the same deny list
+        tokens._checked.clear()
+        other_process = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'other-process'}
+        with override_settings(CACHES={**settings.CACHES, 'default': other_process}):
+            self.assertEqual(self.get(reverse('fine-mine'), pair['access']).status_code, 401)
+
+
+class DenyListLocalCacheTests(TestCase):
+
+    def setUp(self):
+        self.token = AccessToken()
+        tokens._checked.clear()
+        self.addCleanup(tokens._checked.clear)
+
+    def revoke_elsewhere(self):
+        """Revoke the token as another process does, without touching this process's answers."""
+        caches[settings.JWT_DENY_LIST_CACHE].set(tokens._key(self.token['jti']), True, 300)
+
+    def test_answers_are_remembered(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(tokens.is_revoked(self.token))
+            self.assertFalse(tokens.is_revoked(self.token))
+
+    @override_settings(JWT_DENY_LIST_LOCAL_SECONDS=5)
+    def test_other_processes_see_a_revocation_within_the_interval(self):
+        with mock.patch('users.tokens.time.monotonic', return_value=100.0):
+            self.assertFalse(tokens.is_revoked(self.token))
+            self.revoke_elsewhere()
+            self.assertFalse(tokens.is_revoked(self.token))
+
+        with mock.patch('users.tokens.time.monotonic', return_value=105.0):
+            self.assertTrue(tokens.is_revoked(self.token))
+
+    def test_the_revoking_process_rejects_at_once(self):
+        self.assertFalse(tokens.is_revoked(self.token))
+
+        tokens.revoke(self.token)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(tokens.is_revoked(self.token))
+
+    @override_settings(JWT_DENY_LIST_LOCAL_SECONDS=0)
+    def test_disabled_local_cache_reads_every_time(self):
+        self.assertFalse(tokens.is_revoked(self.token))
+        self.revoke_elsewhere()
+
+        self.assertTrue(tokens.is_revoked(self.token))
+
+
+class DenyListCheckTests(TestCase):
+
+    def test_shared_cache_passes(self):
+        self.assertEqual(check_deny_list_cache(None), [])
+
+    @override_settings(JWT_DENY_LIST_CACHE='default')
+    def test_process_local_cache_fails(self):
+        errors = check_deny_list_cache(None)
+
+        self.assertEqual([error.id for error in errors], ['users.E001'])
+
+
+class CachedModelBackendTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='reader@example.com', password='old-password',
+                                             personal_id_number='12345678901', birth_date='1990-01-01')
+        self.backend = CachedModelBackend()
+        backends._users.clear()
+        self.addCleanup(backends._users.clear)
+
+    def test_user_is_loaded_once(self):
+        with self.assertNumQueries(1):
+            first = self.backend.get_user(self.user.pk)
+            second = self.backend.get_user(self.user.pk)
+
+        self.assertEqual(first, self.user)
+        self.assertEqual(second, self.user)
+        self.assertIsNot(first, second)  # Each request gets its own copy
+
+    @override_settings(USER_CACHE_TIMEOUT=0)
+    def test_disabled_cache_loads_every_time(self):
+        with self.assertNumQueries(2):
+            self.backend.get_user(self.user.pk)
+            self.backend.get_user(self.user.pk)
+
+    def test_password_change_drops_the_user(self):
+        self.backend.get_user(self.user.pk)
+
+        self.user.set_password('new-password')
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            cached = self.backend.get_user(self.user.pk)
+        self.assertTrue(cached.check_password('new-password'))
+
+    def test_password_change_ends_other_sessions(self):
+        self.client.login(email=self.user.email, password='old-password')
+        self.assertEqual(self.client.get(reverse('fine-mine')).status_code, 200)
+
+        self.user.set_password('new-password')
+        self.user.save()
+
+        # The cached user would still carry the old password hash and keep the session alive
+        self.assertEqual(self.client.get(reverse('fine-mine')).status_code, 401)
+
+    def test_logout_drops_the_user(self):
+        self.client.login(email=self.user.email, password='old-password')
+        self.client.get(reverse('fine-mine'))
+        self.assertIn(self.user.pk, backends._users)
+
+        self.client.get(reverse('logout'))
+
+        self.assertNotIn(self.user.pk, backends._users)
+
+    def test_sessions_saved_with_model_backend_stay_logged_in(self):
+        session = SessionStore()
+        session[SESSION_KEY] = str(self.user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = self.user.get_session_auth_hash()
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+        self.assertEqual(self.client.get(reverse('fine-mine')).status_code, 200)
@@ -0,0 +1,59 @@
+"""
+Deny list of revoked JSON web tokens.
+
+Revoked tokens are remembered by their jti in the JWT_DENY_LIST_CACHE cache until they expire on their own, so the list
+only ever holds tokens that would otherwise still be accepted. Every process checking tokens must see the same list,
+so the cache must be shared; a per-process backend fails the users.E001 system check at startup.
+
+The shared cache is a database table by default, so each process remembers the answers it read for
+JWT_DENY_LIST_LOCAL_SECONDS: a token sending many requests costs one lookup per interval rather than one per request,
+and a revocation reaches the other processes within that interval. The revoking process rejects the token at once.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+_checked = {}
+_lock = threading.Lock()
+
+
+def _key(jti):
+    return f'jwt:revoked:{jti}'
+
+
+def _deny_list():
+    return caches[settings.JWT_DENY_LIST_CACHE]
+
+
+def _remember(jti, revoked):
+    """Keep the answer for `jti` in this process for JWT_DENY_LIST_LOCAL_SECONDS."""
+    timeout = settings.JWT_DENY_LIST_LOCAL_SECONDS
+    if not timeout:
+        return
+    with _lock:
+        _checked.pop(jti, None)
+        if len(_checked) >= settings.JWT_DENY_LIST_LOCAL_MAX_ENTRIES:
+            _checked.pop(next(iter(_checked)))  # Evict the oldest entry
+        _checked[jti] = (time.monotonic() + timeout, revoked)
+
+
+def revoke(token):
+    """Reject `token` (an access or refresh token) until it expires."""
+    remaining = int(token['exp'] - timezone.now().timestamp())
+    if remaining > 0:
+        _deny_list().set(_key(token['jti']), True, remaining)
+        _remember(token['jti'], True)
+
+
+def is_revoked(token):
+    jti = token['jti']
+    with _lock:
+        entry = _checked.get(jti)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    revoked = _deny_list().get(_key(jti), False)
+    _remember(jti, revoked)
+    return revoked
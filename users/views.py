@@ -3,9 +3,11 @@ from django.contrib.auth.views import LoginView
 from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views.generic import CreateView
+from rest_framework_simplejwt.views import TokenViewBase
 from django.contrib.auth import get_user_model
 
 from users.forms import CustomUserCreationForm
+from users.serializers import TokenRevokeSerializer
 from django.contrib.auth import logout
 
 CustomUser = get_user_model()
@@ -34,3 +36,10 @@ class LogInView(LoginView):
 def log_out(request):
     logout(request)
     return redirect('home')
+
+
+class TokenRevokeView(TokenViewBase):
+    """
+    Takes a refresh token, and optionally an access token, and rejects them from now on until they expire.
+    """
+    serializer_class = TokenRevokeSerializer
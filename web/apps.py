@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class StartConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'web'
+
+    def ready(self):
+        import web.signals  # noqa: F401
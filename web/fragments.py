@@ -0,0 +1,70 @@
+"""
+Versioned caching of the rendered template fragments of the web views.
+
+A fragment is cached under a key built from its name, the versions of the data it shows and the query parameters it
+depends on. Saving or deleting a book, author or genre bumps the catalog version, and circulation events bump the
+version of their books (see web.signals), so changed data is simply rendered under a new key and stale fragments
+expire unread. A fragment's context is a callable evaluated only on a cache miss, so a hit skips the API calls behind
+it.
+
+The versions are kept in WEB_FRAGMENT_VERSION_CACHE, which must be shared by all web and worker processes: a change
+saved by one process, e.g. a Celery worker recording a return, has to invalidate the fragments of every other one.
+The fragments themselves can stay in a per-process cache, as their keys hold the shared versions.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+CATALOG_VERSION_KEY = 'web:catalog-version'
+
+
+def _cache():
+    return caches[settings.WEB_FRAGMENT_CACHE]
+
+
+def _version_cache():
+    return caches[settings.WEB_FRAGMENT_VERSION_CACHE]
+
+
+def _book_version_key(book_id):
+    return f'web:book-version:{book_id}'
+
+
+# Versions are timestamps rather than counters, so a version evicted from the cache never comes back with an old value
+def catalog_version():
+    return _version_cache().get_or_set(CATALOG_VERSION_KEY, time.time_ns, None)
+
+
+def book_version(book_id):
+    return _version_cache().get_or_set(_book_version_key(book_id), time.time_ns, None)
+
+
+def bump_catalog_version():
+    _version_cache().set(CATALOG_VERSION_KEY, time.time_ns(), None)
+
+
+def bump_book_versions(book_ids):
+    version = time.time_ns()
+    _version_cache().set_many({_book_version_key(book_id): version for book_id in book_ids}, None)
+
+
+def render_fragment(request, template, vary_on, get_context, fallback):
+    """
+    Return `template` rendered and cached per `vary_on` values. `get_context` is only called on a cache miss and
+    returns the template context, or None when its data is unavailable, in which case the `fallback` context is
+    rendered and nothing is cached.
+    """
+    cache = _cache()
+    key = make_template_fragment_key(template, vary_on)
+    html = cache.get(key)
+    if html is None:
+        context = get_context()
+        if context is None:
+            return render_to_string(template, fallback, request)
+        html = render_to_string(template, context, request)
+        cache.set(key, str(html), settings.WEB_FRAGMENT_CACHE_SECONDS)
+    return mark_safe(html)
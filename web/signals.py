@@ -0,0 +1,23 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from library.models import Author, Genre, Book
+from library.signals import circulation_recorded
+from web.fragments import bump_catalog_version, bump_book_versions
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def bump_changed_catalog(sender, instance, **kwargs):
+    bump_catalog_version()
+    if sender is Book:
+        bump_book_versions([instance.pk])
+
+
+@receiver(circulation_recorded)
+def bump_circulated_books(events, **kwargs):
+    bump_book_versions({event.book_id for event in events})
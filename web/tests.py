@@ -1,3 +1,65 @@
+from unittest import mock
+
+import requests
+from django.core.cache import cache, caches
 from django.test import TestCase
+from django.urls import reverse
+
+from library.benchmarks import LoopbackAdapter, generate_dataset
+from library.models import Book, Borrow
+from web.fragments import CATALOG_VERSION_KEY
+
+
+class FragmentCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(20)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.dataset.reader)
+        self.adapter = LoopbackAdapter()
+        self.api_calls = []
+
+    def get(self, url):
+        """GET a web view, recording the paths of the API calls it makes."""
+        def get_adapter(session, url):
+            self.api_calls.append(url.split('/api')[-1].split('?')[0])
+            return self.adapter
+
+        self.api_calls.clear()
+        with mock.patch.object(requests.Session, 'get_adapter', get_adapter):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_home_renders_from_cache_until_the_catalog_changes(self):
+        first = self.get(reverse('home'))
+        self.assertTrue(self.api_calls)
+        self.assertEqual(self.get(reverse('home')), first)
+        self.assertEqual(self.api_calls, [])
+
+        book = Book.objects.order_by('id').first()
+        book.title = 'Renamed Book'
+        book.save()
+        self.assertIn('Renamed Book', self.get(reverse('home')))
+
+    def test_versions_bumped_by_other_processes_invalidate_fragments(self):
+        self.get(reverse('home'))
+        # Another process renames the book; its bump reaches this process only through the shared version cache
+        Book.objects.filter(pk=Book.objects.order_by('id').first().pk).update(title='Renamed Elsewhere')
+        caches['shared'].set(CATALOG_VERSION_KEY, 1, None)
+
+        self.assertIn('Renamed Elsewhere', self.get(reverse('home')))
+
+    def test_book_detail_fetches_only_the_user_status_from_cache(self):
+        book = self.dataset.available_book
+        url = reverse('book_detail', args=[book.pk])
+        self.get(url)
+        self.get(url)
+        self.assertEqual(self.api_calls, [f'/library/user_book_status/{book.pk}/'])
 
-# Create your tests here.
+        with self.captureOnCommitCallbacks(execute=True):
+            Borrow.objects.create(user=self.dataset.librarian, book=book)
+        self.assertIn('Currently Borrowed Count: 1', self.get(url))
+        self.assertIn(f'/library/books/{book.pk}/', self.api_calls)
@@ -1,9 +1,12 @@
+import functools
+
 from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 import requests
 from django.conf import settings
 
+from web.fragments import catalog_version, book_version, render_fragment
 from web.utils import fetch_all_pages
 
 
@@ -26,54 +29,62 @@ def home(request):
     session = requests.Session()
     session.cookies.update(request.COOKIES)
     csrf_token = get_token(request)
-    response = session.get(api_url, headers={'X-CSRFToken': csrf_token}, params=params)
 
-    if response.status_code == 200:
+    # The fragments below are cached per catalog version, so the API is only called to render a missing one
+    @functools.cache
+    def load_books():
+        response = session.get(api_url, headers={'X-CSRFToken': csrf_token}, params=params)
+        if response.status_code != 200:
+            return None
         data = response.json()
-        books = data.get('results', [])
-        pagination = {
-            'count': data.get('count', 0),
-            'next': data.get('next'),
-            'previous': data.get('previous'),
-            'page': int(page),
-            'total_pages': (data.get('count', 0) + 4) // 5,  # Assuming 5 books per page
+        return {
+            'books': data.get('results', []),
+            'pagination': {
+                'count': data.get('count', 0),
+                'next': data.get('next'),
+                'previous': data.get('previous'),
+                'page': int(page),
+                'total_pages': (data.get('count', 0) + 4) // 5,  # Assuming 5 books per page
+            },
         }
-    else:
-        books = []
-        pagination = {
+
+    def load_filters():
+        # Fetch all authors and genres for filtering options, formatted as (id, name) tuples
+        try:
+            authors_data = fetch_all_pages(session, f"{settings.API_URL}/library/authors/",
+                                           {'X-CSRFToken': csrf_token})
+            genres_data = fetch_all_pages(session, f"{settings.API_URL}/library/genres/", {'X-CSRFToken': csrf_token})
+        except Exception:
+            return None
+        return {
+            'authors': [(author['id'], author['full_name']) for author in authors_data],
+            'genres': [(genre['id'], genre['name']) for genre in genres_data],
+            'author': author,
+            'genre': genre,
+        }
+
+    no_books = {
+        'books': [],
+        'pagination': {
             'count': 0,
             'next': None,
             'previous': None,
             'page': int(page),
             'total_pages': 1,
-        }
-
-    # Fetch all authors and genres for filtering options
-    authors = []
-    genres = []
-
-    try:
-        # Fetch authors from API and format as (id, full_name) tuples
-        authors_data = fetch_all_pages(session, f"{settings.API_URL}/library/authors/", {'X-CSRFToken': csrf_token})
-        authors = [(author['id'], author['full_name']) for author in authors_data]
-    except Exception as e:
-        pass
-
-    try:
-        # Fetch genres from API and format as (id, name) tuples
-        genres_data = fetch_all_pages(session, f"{settings.API_URL}/library/genres/", {'X-CSRFToken': csrf_token})
-        genres = [(genre['id'], genre['name']) for genre in genres_data]
-    except Exception as e:
-        pass
+        },
+    }
+    version = catalog_version()
+    listing = [version, page, search, author, genre]
+    fragments = {
+        'filters': render_fragment(request, 'web/fragments/catalog_filters.html', [version, author, genre],
+                                   load_filters, {'authors': [], 'genres': []}),
+        'books': render_fragment(request, 'web/fragments/book_list.html', listing, load_books, no_books),
+        'pagination': render_fragment(request, 'web/fragments/pagination.html', listing, load_books, no_books),
+    }
 
     context = {
-        'books': books,
-        'pagination': pagination,
+        'fragments': fragments,
         'search': search,
-        'author': author,
-        'genre': genre,
-        'authors': authors,
-        'genres': genres,
     }
     return render(request, 'index.html', context)
 
@@ -121,13 +132,18 @@ def book_detail(request, pk):
             else:
                 error_message = response.json().get('detail', 'Removing wish failed.')
 
-    response = session.get(api_url, headers={'X-CSRFToken': csrf_token})
+    def load_book():
+        response = session.get(api_url, headers={'X-CSRFToken': csrf_token})
+        return {'book': response.json()} if response.status_code == 200 else None
+
+    # The book's details are cached per book version, only the user's status is fetched on every request
+    book_info = render_fragment(request, 'web/fragments/book_info.html', [pk, catalog_version(), book_version(pk)],
+                                load_book, {'book': {}})
     user_status_response = session.get(user_status_url, headers={'X-CSRFToken': csrf_token})
 
-    if response.status_code == 200 and user_status_response.status_code == 200:
-        book = response.json()
+    if user_status_response.status_code == 200:
         user_status = user_status_response.json()
-        book['is_available'] = book['quantity'] > (book['currently_borrowed_count'] + book['active_reservations_count'])
+        book = {'id': pk, 'is_available': user_status['is_available']}
         book['user_has_reservation'] = user_status['has_active_reservation']
         book['user_has_borrowing'] = user_status['has_active_borrowing']
         book['user_has_wish'] = user_status['has_wish']
@@ -137,5 +153,6 @@ def book_detail(request, pk):
 
     context = {
         'book': book,
+        'book_info': book_info,
     }
     return render(request, 'web/book_detail.html', context)